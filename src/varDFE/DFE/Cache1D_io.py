@@ -0,0 +1,300 @@
+"""
+Read and write Cache1D reference spectra.
+
+The spectra are saved as a raw `.npy` array next to a versioned JSON header with
+the gamma grid, the neutral spectrum and the demographic settings. The array is
+loaded with `np.load(mmap_mode='r')`, so concurrent jobs on one node share a
+single page-cached copy. Low-rank spectra (`Cache1D.compress`) are saved as their
+two factors, folded or float32 spectra (`Cache1D.compact`) as they are stored. Pickled `.bpkl` caches can still be read.
+
+`cached_Cache1D` keeps built caches in a local content-addressed store, keyed by
+a hash of everything the spectra depend on, so identical caches are built once.
+"""
+
+import hashlib
+import importlib
+import importlib.metadata
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import numpy as np
+from dadi import Spectrum
+from varDFE.DFE.Cache1D_mod2 import Cache1D
+from varDFE.Misc import LoggerDFE, Util
+
+FORMAT_NAME = 'varDFE.Cache1D'
+FORMAT_VERSION = 4
+# header file name inside each entry of the content-addressed store
+STORE_HEADER = 'DFESpectrum.json'
+
+def spectra_path(header_file):
+    """
+    Path to the `.npy` spectra array that belongs to a `.json` header.
+    """
+    return os.path.splitext(header_file)[0] + '.npy'
+
+def factor_path(header_file):
+    """
+    Path to the `.npy` array of the right low-rank factor of the spectra that
+    belongs to a `.json` header.
+    """
+    return os.path.splitext(header_file)[0] + '_V.npy'
+
+def dadi_version():
+    """
+    Installed dadi version, recorded with saved spectra.
+    """
+    try:
+        return importlib.metadata.version('dadi')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+def import_func(funcname):
+    """
+    Import a function from its `module.name`, return None if it is not importable.
+    """
+    modname, _, name = funcname.rpartition('.')
+    try:
+        return getattr(importlib.import_module(modname), name)
+    except (ImportError, AttributeError):
+        LoggerDFE.logWARN('Cannot import demo_sel_func {0}'.format(funcname))
+        return None
+
+def save_spectra(ref_spectra, outfile):
+    """
+    Save a Cache1D as a `.json` header (outfile) and a `.npy` spectra array,
+    or the two `.npy` factors of low-rank spectra.
+    """
+    npyfile = spectra_path(outfile)
+    if ref_spectra.demo_sel_func is None:
+        funcname = None
+    else:
+        funcname = Util.GetFuncName(ref_spectra.demo_sel_func)
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'dadi_version': dadi_version(),
+        'spectra': os.path.basename(npyfile),
+        'demo_sel_func': funcname,
+        'params': [float(x) for x in ref_spectra.params],
+        'ns': [int(x) for x in ref_spectra.ns],
+        'pts_l': [int(x) for x in ref_spectra.pts_l],
+        'gammas': ref_spectra.gammas.tolist(),
+        'neg_gammas': ref_spectra.neg_gammas.tolist(),
+        'quadrature': ref_spectra.quadrature,
+        'gauss_order': int(ref_spectra.gauss_order),
+        'refinement': ref_spectra.refinement,
+        'lowrank': ref_spectra.lowrank,
+        'folded': bool(ref_spectra.folded),
+        'neu_spec': ref_spectra.neu_spec.data.tolist(),
+        'neu_spec_mask': np.ma.getmaskarray(ref_spectra.neu_spec).tolist()
+    }
+    # write the arrays before the header, so an existing header means a complete cache
+    if ref_spectra.spectra_factors is None:
+        np.save(npyfile, np.ascontiguousarray(ref_spectra.spectra))
+    else:
+        left, right = ref_spectra.spectra_factors
+        np.save(npyfile, np.ascontiguousarray(left))
+        np.save(factor_path(outfile), np.ascontiguousarray(right))
+        header['spectra_V'] = os.path.basename(factor_path(outfile))
+    with open(outfile, 'w') as outf:
+        json.dump(header, outf)
+    return None
+
+def load_spectra(infile, mmap_mode='r'):
+    """
+    Load a Cache1D saved by `save_spectra`, or pickled to a `.bpkl` file.
+    mmap_mode: passed to np.load for the spectra array. None reads it into memory.
+    """
+    if infile.endswith('.bpkl'):
+        with open(infile, 'rb') as inf:
+            return pickle.load(inf)
+
+    with open(infile, 'r') as inf:
+        header = json.load(inf)
+    if header.get('format') != FORMAT_NAME:
+        raise IOError('{0} is not a varDFE reference spectra file'.format(infile))
+    if header['version'] > FORMAT_VERSION:
+        raise IOError('{0} has format version {1}, newer than the supported version {2}'.format(
+            infile, header['version'], FORMAT_VERSION))
+
+    npyfile = os.path.join(os.path.dirname(infile), header['spectra'])
+    spectra = np.load(npyfile, mmap_mode=mmap_mode)
+    if header.get('lowrank') is not None:
+        # the left factor, one row per gamma
+        spectra = (spectra, np.load(os.path.join(os.path.dirname(infile), header['spectra_V'])))
+    folded = header.get('folded', False)
+    neu_spec = Spectrum(header['neu_spec'], mask=header['neu_spec_mask'], data_folded=folded)
+    if header['demo_sel_func'] is None:
+        demo_sel_func = None
+    else:
+        demo_sel_func = import_func(header['demo_sel_func'])
+
+    return Cache1D.from_arrays(
+        params=header['params'],
+        ns=header['ns'],
+        pts_l=header['pts_l'],
+        gammas=header['gammas'],
+        neg_gammas=header['neg_gammas'],
+        spectra=spectra,
+        neu_spec=neu_spec,
+        demo_sel_func=demo_sel_func,
+        # version 1 files only had the trapezoid rule
+        quadrature=header.get('quadrature', 'trapz'),
+        gauss_order=header.get('gauss_order', 5),
+        refinement=header.get('refinement'),
+        lowrank=header.get('lowrank'),
+        folded=folded)
+
+def load_spectra_for(infile, data, mmap_mode='r'):
+    """
+    Load a Cache1D with `load_spectra` for the data Spectrum. Spectra cached at
+    a larger sample size are projected down to that of the data, and the
+    spectra are checked against the data with `Cache1D.check_data`.
+    """
+    ref_spectra = load_spectra(infile, mmap_mode=mmap_mode)
+    ns = [int(x) for x in data.sample_sizes]
+    if [int(x) for x in ref_spectra.ns] != ns:
+        LoggerDFE.logINFO('Projecting reference spectra from ns={0} to ns={1}'.format(list(ref_spectra.ns), ns))
+        ref_spectra = ref_spectra.project(ns)
+    ref_spectra.check_data(data=data, ns=ns)
+    return ref_spectra
+
+def default_store():
+    """
+    Directory of the content-addressed store, $VARDFE_CACHE_DIR or ~/.cache/varDFE
+    """
+    return os.environ.get('VARDFE_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'varDFE'))
+
+def cache_key(demo_sel_func, params, ns, pts_l, gamma_bounds, gamma_pts, additional_gammas,
+              quadrature='trapz', gauss_order=5, refine_tol=None, refine_max_pts=None,
+              refine_max_step=0.1, lowrank_tol=None, fold_spectra=False, spectra_dtype='float64'):
+    """
+    Hash of all the inputs the cached spectra depend on, including the dadi version.
+    """
+    settings = {
+        'demo_sel_func': Util.GetFuncName(demo_sel_func),
+        'params': [float(x) for x in params],
+        'ns': [int(x) for x in ns],
+        'pts_l': [int(x) for x in pts_l],
+        'gamma_bounds': [float(x) for x in gamma_bounds],
+        'gamma_pts': int(gamma_pts),
+        'additional_gammas': [float(x) for x in additional_gammas],
+        'dadi_version': dadi_version()
+    }
+    # the defaults keep the keys of stores built before these options
+    if quadrature != 'trapz':
+        settings['quadrature'] = quadrature
+        settings['gauss_order'] = int(gauss_order)
+    if refine_tol is not None:
+        settings['refine_tol'] = float(refine_tol)
+        settings['refine_max_pts'] = refine_max_pts
+        settings['refine_max_step'] = refine_max_step
+    if lowrank_tol is not None:
+        settings['lowrank_tol'] = float(lowrank_tol)
+    if fold_spectra:
+        settings['fold_spectra'] = True
+    if np.dtype(spectra_dtype) != np.float64:
+        settings['spectra_dtype'] = np.dtype(spectra_dtype).name
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def store_entry(store, key):
+    """
+    Header file of the store entry for *key*.
+    """
+    return os.path.join(store, key, STORE_HEADER)
+
+def evict_store(store, max_size, keep=None, stale_age=7*24*3600):
+    """
+    Remove the least recently used entries until the store is at most
+    *max_size* bytes. The entry *keep* is never removed.
+
+    The temporary directories of `cached_Cache1D` (.tmp-*) are entries still
+    being written by another job and are left alone, unless they were last
+    modified more than *stale_age* seconds ago, i.e. left behind by a killed job.
+    """
+    entries = []
+    for key in os.listdir(store):
+        if key.startswith('.tmp-'):
+            tmpdir = os.path.join(store, key)
+            try:
+                age = time.time() - os.path.getmtime(tmpdir)
+            except OSError:
+                # renamed to its entry in the meantime
+                continue
+            if age > stale_age:
+                LoggerDFE.logINFO('Removing stale temporary directory {0} from the store'.format(tmpdir))
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            continue
+        header = store_entry(store, key)
+        if not os.path.isfile(header):
+            continue
+        entrydir = os.path.dirname(header)
+        size = sum(os.path.getsize(os.path.join(entrydir, ii)) for ii in os.listdir(entrydir))
+        entries.append((os.path.getmtime(header), size, key))
+    total = sum(entry[1] for entry in entries)
+    # oldest first
+    for used, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        if key == keep:
+            continue
+        entrydir = os.path.join(store, key)
+        LoggerDFE.logINFO('Evicting reference spectra {0} from the store'.format(entrydir))
+        shutil.rmtree(entrydir, ignore_errors=True)
+        total -= size
+    return None
+
+def cached_Cache1D(params, ns, demo_sel_func, pts_l,
+                   gamma_bounds=(1e-4, 2000), gamma_pts=500, additional_gammas=[],
+                   quadrature='trapz', gauss_order=5, refine_tol=None, refine_max_pts=None,
+                   refine_max_step=0.1, lowrank_tol=None, fold_spectra=False,
+                   spectra_dtype='float64', store=None, max_size=None, **kwargs):
+    """
+    Same as `Cache1D(params, ns, demo_sel_func, pts_l, ...)`, but return the
+    spectra from the content-addressed store if they were built before, and add
+    them to the store otherwise.
+
+    store: store directory. Default: `default_store()`
+    max_size: If not None, maximum store size in bytes. The least recently used
+              entries are removed after a new entry is added.
+    kwargs: passed to Cache1D when the spectra need to be built (e.g. mp, cpus, checkpoint)
+    """
+    if store is None:
+        store = default_store()
+    key = cache_key(demo_sel_func, params, ns, pts_l, gamma_bounds, gamma_pts, additional_gammas,
+                    quadrature, gauss_order, refine_tol, refine_max_pts, refine_max_step, lowrank_tol,
+                    fold_spectra, spectra_dtype)
+    header = store_entry(store, key)
+    if os.path.isfile(header):
+        LoggerDFE.logINFO('Loading reference spectra from store {0}'.format(header))
+        # record the use for eviction
+        os.utime(header)
+        return load_spectra(header)
+
+    ref_spectra = Cache1D(params, ns, demo_sel_func, pts_l,
+                          gamma_bounds=gamma_bounds, gamma_pts=gamma_pts,
+                          additional_gammas=additional_gammas, quadrature=quadrature,
+                          gauss_order=gauss_order, refine_tol=refine_tol,
+                          refine_max_pts=refine_max_pts, refine_max_step=refine_max_step,
+                          lowrank_tol=lowrank_tol, fold_spectra=fold_spectra,
+                          spectra_dtype=spectra_dtype, **kwargs)
+
+    # write to a temporary directory and rename, so concurrent jobs never see partial entries
+    Util.CreateNewDir(store)
+    tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=store)
+    save_spectra(ref_spectra, os.path.join(tmpdir, STORE_HEADER))
+    try:
+        os.rename(tmpdir, os.path.dirname(header))
+        LoggerDFE.logINFO('Saved reference spectra to store {0}'.format(header))
+    except OSError:
+        # another job stored the same spectra first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if max_size is not None:
+        evict_store(store, max_size, keep=key)
+    return ref_spectra
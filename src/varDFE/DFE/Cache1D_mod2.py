@@ -5,22 +5,40 @@ Modified version of the script found at: https://doi.org/10.1534/genetics.116.19
 Based on scripts from:
 https://groups.google.com/forum/#!topic/dadi-user/4xspqlITcvc .
 
-Add method `integrate_continuous_pos`. Everything else is the same as dadi.DFE.Cache1D_mod
+Add method `integrate_continuous_pos`. The quadrature weights over the gamma grid
+(trapezoid, or Simpson/Gauss-Legendre in log(gamma) for coarser grids) are
+precomputed once, so each integration is a single weights x spectra product.
+The spectra can be stored folded or in float32 (`Cache1D.compact`), or as
+low-rank factors (`Cache1D.compress`).
+Everything else is the same as dadi.DFE.Cache1D_mod
 """
 
 import operator
 import sys, traceback
+from collections import OrderedDict
 import numpy as np
 import scipy.stats.distributions
 import scipy.integrate
+import scipy.interpolate
 import dadi
 from dadi import Numerics, Spectrum
+from varDFE.DFE import PDFs2
+from varDFE.DFE.Cache1D_util import gamma_grid, quad_weights, batch_ll, central_diff, merge_gammas, \
+    interp_errors, lowrank_factors, fold_data, dot_float64, projection_matrix, pdf_matrix, init_checkpoint, save_checkpoint, load_checkpoint
 
 class Cache1D:
+    # Number of spectra kept in the LRU memo of `integrate` and `integrate_continuous_pos`
+    integrate_memo_size = 256
+    # Number of exactly solved point mass spectra kept by `integrate_point_pos`
+    point_memo_size = 64
+
     def __init__(self, params, ns, demo_sel_func, pts_l,
                  gamma_bounds=(1e-4, 2000), gamma_pts=500,
                  additional_gammas=[],
-                 mp=False, cpus=None, gpus=0, verbose=False):
+                 mp=False, cpus=None, gpus=0, verbose=False, checkpoint=None,
+                 batch_func=None, batch_size=20, quadrature='trapz', gauss_order=5,
+                 refine_tol=None, refine_max_pts=None, refine_max_step=0.1, lowrank_tol=None,
+                 fold_spectra=False, spectra_dtype='float64'):
         """
         params: Optimized demographic parameters
         ns: Sample size(s) for cached spectra
@@ -37,99 +55,624 @@ class Cache1D:
         cpus: For multiprocessing, number of CPU jobs to launch.
         gpus: For multiprocessing, number of GPU jobs to launch.
         verbose: If True, print messages to track progress of cache generation.
+        checkpoint: If not None, directory where each finished spectrum is saved
+                    as soon as it is computed. Spectra already in the directory
+                    are reused, so a rerun with the same settings only
+                    computes the missing gammas.
+        batch_func: Optional version of demo_sel_func for a block of gammas, e.g.
+                    DemogSelModels2.three_epoch_gammas. Its last parameter is
+                    an array of gammas and it returns a 2D array of spectra.
+                    If given, gammas are computed batch_size at a time.
+        batch_size: Number of gammas per call of batch_func.
+        quadrature: Rule for integrating over gamma. 'trapz' (trapezoid rule in
+                    gamma), 'simpson' (Simpson's rule in log(gamma)) or 'gauss'
+                    (Gauss-Legendre panels in log(gamma)). The higher-order rules
+                    reach the same accuracy with far fewer gamma_pts. For 'gauss',
+                    additional_gammas must come from `Cache1D_util.positive_gammas`
+                    with the same quadrature.
+        gauss_order: Number of Gauss-Legendre nodes per panel for 'gauss'.
+        refine_tol: If not None, the gamma_pts negative gammas and the
+                    additional_gammas are a coarse grid, adaptively refined
+                    where neighbouring spectra differ by more than refine_tol.
+                    See `refine`.
+        refine_max_pts: Budget of cached gammas for the adaptive refinement.
+        refine_max_step: Widest interval in log10(gamma) after the adaptive refinement.
+        lowrank_tol: If not None, store the spectra as low-rank factors within
+                     lowrank_tol relative error. See `compress`.
+        fold_spectra: If True, store only the folded spectra. See `compact`.
+        spectra_dtype: dtype of the stored spectra, 'float64' or 'float32'.
+                       See `compact`.
         """
+        if refine_tol is not None and quadrature == 'gauss':
+            raise ValueError('Cache1D with gauss quadrature cannot be refined, use trapz or simpson')
         self.params, self.ns, self.pts_l = tuple(params), tuple(ns), tuple(pts_l)
+        self.quadrature, self.gauss_order = quadrature, gauss_order
+        self.refinement = None
+        self.folded, self.spectra_dtype = fold_spectra, np.dtype(spectra_dtype).name
 
         #Create a vector of gammas that are log-spaced over an interval
-        self.gammas = -np.logspace(np.log10(gamma_bounds[1]),
-                                   np.log10(gamma_bounds[0]), gamma_pts)
+        self.gammas = -gamma_grid(gamma_bounds, gamma_pts, quadrature, gauss_order, descending=True)
 
         # Record negative gammas, for later use
         self.neg_gammas = self.gammas
+        # Check the additional gammas before any spectrum is computed
+        self._check_gammas(self.neg_gammas, additional_gammas)
         # Add additional gammas to cache
         self.gammas = np.concatenate((self.gammas, additional_gammas))
-        self.spectra = [None]*len(self.gammas)
         self.demo_sel_func = demo_sel_func
         self.params = params
         self.ns = ns
         self.pts_l = pts_l
+        self.spectra = np.zeros((len(self.gammas), self._stored_bins()), dtype=self.spectra_dtype)
+
+        self._compute_spectra(list(range(len(self.gammas))), mp, cpus, gpus, verbose, checkpoint,
+                              batch_func, batch_size)
+
+        self.neu_spec = None
+        if checkpoint is not None:
+            neu_data = load_checkpoint(checkpoint, 0)
+            if neu_data is not None:
+                self.neu_spec = Spectrum(neu_data)
+        if self.neu_spec is None:
+            demo_sel_extrap_func = Numerics.make_extrap_func(self.demo_sel_func)
+            self.neu_spec = demo_sel_extrap_func(tuple(self.params)+(0,), self.ns, self.pts_l)
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, 0, self.neu_spec)
+        if self.folded:
+            self.neu_spec = self.neu_spec.fold()
+        self._set_quad_weights()
+        if refine_tol is not None:
+            self.refine(refine_tol, refine_max_pts, refine_max_step, mp=mp, cpus=cpus, gpus=gpus, verbose=verbose,
+                        checkpoint=checkpoint, batch_func=batch_func, batch_size=batch_size)
+        if lowrank_tol is not None:
+            self.compress(lowrank_tol, verbose=verbose)
+
+    @classmethod
+    def from_arrays(cls, params, ns, pts_l, gammas, neg_gammas, spectra, neu_spec,
+                    demo_sel_func=None, quadrature='trapz', gauss_order=5, refinement=None,
+                    lowrank=None, folded=False):
+        """
+        Assemble a Cache1D from precomputed spectra, without solving any PDE.
+
+        params, ns, pts_l: Same as for Cache1D
+        gammas: All cached gammas, the negative gammas first
+        neg_gammas: The negative gammas
+        spectra: 2D array of spectra, one row per gamma in gammas, or its
+                 low-rank factors (U, V) if lowrank is given. Their dtype is kept.
+        neu_spec: Neutral Spectrum, folded if folded
+        demo_sel_func: DaDi demographic function with selection, if known.
+                       Only needed by `integrate_point_pos`.
+        quadrature, gauss_order: Same as for Cache1D
+        refinement: Settings of the adaptive refinement of the gammas, see `refine`
+        lowrank: Settings and accuracy of the low-rank factors, see `compress`
+        folded: True if the spectra are folded (ns//2+1 bins), see `compact`
+        """
+        self = cls.__new__(cls)
+        self.params, self.ns, self.pts_l = params, ns, pts_l
+        self.quadrature, self.gauss_order = quadrature, gauss_order
+        self.refinement = refinement
+        self.folded = folded
+        self.gammas = np.asarray(gammas, dtype=float)
+        self.neg_gammas = np.asarray(neg_gammas, dtype=float)
+        if lowrank is None:
+            self.spectra = spectra
+            self.spectra_dtype = spectra.dtype.name
+        else:
+            self._spectra, self.spectra_factors = None, tuple(spectra)
+            self.lowrank = lowrank
+            self.spectra_dtype = spectra[0].dtype.name
+        self.neu_spec = neu_spec
+        self.demo_sel_func = demo_sel_func
+        self._set_quad_weights()
+        return self
+
+    def __getstate__(self):
+        # the memos of integrated and solved spectra, and of the projections
+        # to smaller sample sizes, are rebuilt on load
+        state = self.__dict__.copy()
+        state.pop('_integrate_memo', None)
+        state.pop('_point_memo', None)
+        state.pop('_projections', None)
+        return state
+
+    def __setstate__(self, state):
+        # caches pickled before the quadrature weights existed
+        self.__dict__.setdefault('quadrature', 'trapz')
+        self.__dict__.setdefault('gauss_order', 5)
+        self.__dict__.setdefault('refinement', None)
+        self.__dict__.setdefault('lowrank', None)
+        self.__dict__.setdefault('spectra_factors', None)
+        self.__dict__.setdefault('folded', False)
+        self.__dict__.setdefault('spectra_dtype', 'float64')
+        # caches pickled before the spectra could be low-rank
+        if 'spectra' in state:
+            state = dict(state)
+            state['_spectra'] = state.pop('spectra')
+        self.__dict__.update(state)
+        self._set_quad_weights()
+
+    @property
+    def spectra(self):
+        """
+        2D array of the cached spectra, one row per gamma. Rebuilt from
+        self.spectra_factors if the cache is low-rank, see `compress`.
+        """
+        if self.spectra_factors is None:
+            return self._spectra
+        left, right = self.spectra_factors
+        return np.dot(left, right)
+
+    @spectra.setter
+    def spectra(self, spectra):
+        # new spectra are stored in full, compress again if needed
+        self._spectra = spectra
+        self.spectra_factors = None
+        self.lowrank = None
+
+    def compress(self, tol, verbose=False):
+        """
+        Store the spectra as low-rank factors (U, V) in self.spectra_factors, with the smallest
+        rank reproducing every spectrum within tol relative to the largest entry
+        of its bin. See `Cache1D_util.lowrank_factors`. The integrations then
+        cost (weights.U).V, which is cheaper for large ns and large gamma grids.
+
+        tol: Largest relative error of the spectra, e.g. 1e-6
+        verbose: If True, print the rank and the error of the factors.
+
+        The rank and the error are recorded in self.lowrank. Spectra computed
+        afterwards (e.g. by `extend` or `refine`) are stored in full again.
+        """
+        spectra = np.asarray(self.spectra, dtype=float)
+        left, right, max_rel_error = lowrank_factors(spectra, tol)
+        self._spectra, self.spectra_factors = None, (left.astype(self.spectra_dtype), right)
+        self.lowrank = {'tol': float(tol), 'rank': int(left.shape[1]),
+                        'max_rel_error': max_rel_error,
+                        'size_ratio': float((left.size + right.size)/spectra.size)}
+        if verbose:
+            print('Compressed Cache1D spectra {0} to rank {1}, max relative error {2:.3g}'.format(
+                spectra.shape, self.lowrank['rank'], max_rel_error))
+        # integrated spectra change within tol
+        self.__dict__.pop('_projections', None)
+        self._set_quad_weights()
+
+    def compact(self, fold=False, dtype=None):
+        """
+        Shrink the stored spectra in place. The integrations return the same
+        unfolded model spectra as before, in float64.
+
+        fold: If True, keep only the folded spectra (the ns//2+1 bins of the
+              minor allele frequencies), half the size. The model spectra then
+              have zeros above ns//2 and are only valid for folded data, as
+              used by every workflow. `integrate` returns them folded.
+        dtype: If not None, dtype of the stored spectra (the left factor if
+               they are low-rank), e.g. 'float32' for half the size. The
+               integrations still accumulate in float64.
+        """
+        if fold and not self.folded:
+            if self.spectra_factors is None:
+                self._spectra = fold_data(self._spectra, self.ns[0]).astype(self.spectra_dtype)
+            else:
+                left, right = self.spectra_factors
+                self.spectra_factors = (left, fold_data(right, self.ns[0]))
+            self.neu_spec = self.neu_spec.fold()
+            self.folded = True
+        if dtype is not None:
+            self.spectra_dtype = np.dtype(dtype).name
+            if self.spectra_factors is None:
+                self._spectra = np.asarray(self._spectra, dtype=self.spectra_dtype)
+            else:
+                left, right = self.spectra_factors
+                self.spectra_factors = (np.asarray(left, dtype=self.spectra_dtype), right)
+        # integrated spectra change within the float32 precision
+        self.__dict__.pop('_projections', None)
+        self._set_quad_weights()
+
+    def _stored_bins(self):
+        """
+        Number of bins of the stored spectra, ns//2+1 if they are folded.
+        """
+        return self.ns[0]//2 + 1 if self.folded else self.ns[0] + 1
+
+    def _to_stored(self, data):
+        """
+        Computed spectra (unfolded, float64) as stored: folded and in spectra_dtype.
+        """
+        if self.folded:
+            data = fold_data(data, self.ns[0])
+        return np.asarray(data, dtype=self.spectra_dtype)
+
+    def _to_model(self, fs):
+        """
+        Integrated stored spectra (bins on the last axis) as unfolded model
+        spectra, zeros above ns//2 if the spectra are folded.
+        """
+        if not self.folded:
+            return fs
+        model = np.zeros(fs.shape[:-1] + (self.ns[0]+1,))
+        model[...,:fs.shape[-1]] = fs
+        return model
+
+    def _to_spectrum(self, model):
+        """
+        Spectrum of a model from `_to_model`, folded if the spectra are.
+        """
+        fs = Spectrum(model)
+        return fs.fold() if self.folded else fs
+
+    def check_data(self, data=None, ns=None):
+        """
+        Raise ValueError if the model spectra cannot be compared to data or to
+        the sample size(s) ns: the spectra are folded and the data are not, or
+        ns differs from the sample size of the folded spectra.
+        """
+        if not self.folded:
+            return None
+        if data is not None and not data.folded:
+            raise ValueError('Cache1D spectra are folded, the data must be folded too')
+        if ns is not None and tuple(int(x) for x in ns) != tuple(int(x) for x in self.ns):
+            raise ValueError('Cache1D spectra are folded for sample size {0}, not {1}'.format(self.ns, ns))
+        return None
+
+    def _neu_data(self):
+        """
+        Neutral spectrum in the bins of the stored spectra, float64.
+        """
+        return np.asarray(self.neu_spec.data[:self._stored_bins()], dtype=float)
+
+    def _dot_spectra(self, weights, start=0, stop=None):
+        """
+        np.dot(weights, self.spectra[start:stop]) in float64, as (weights.U).V
+        if the spectra are low-rank.
+        """
+        if self.spectra_factors is None:
+            return dot_float64(weights, self._spectra[start:stop])
+        left, right = self.spectra_factors
+        return np.dot(dot_float64(weights, left[start:stop]), right)
+
+    def _spectrum(self, ii):
+        """
+        Stored spectrum ii in float64, without rebuilding all spectra if they are low-rank.
+        """
+        if self.spectra_factors is None:
+            return np.asarray(self._spectra[ii], dtype=float)
+        left, right = self.spectra_factors
+        return np.dot(np.asarray(left[ii], dtype=float), right)
+
+    def _set_quad_weights(self):
+        """
+        Precompute quadrature weights over the negative and positive gamma grids,
+        and the partition of self.gammas into negative and positive gammas used
+        by `integrate_continuous_pos`. Must be called again whenever self.gammas changes.
+        """
+        Nneg = len(self.neg_gammas)
+        # the order is not checked here, caches pickled by earlier versions
+        # may have unsorted positive gammas
+        self._check_gammas(self.gammas[:Nneg], self.gammas[Nneg:], check_order=False)
+        self.neg_weights = quad_weights(self.neg_gammas, self.quadrature, self.gauss_order)
+        self.pos_weights = quad_weights(self.gammas[Nneg:], self.quadrature, self.gauss_order)
+        # weights over all cached gammas, for the signed sel_dist of integrate_continuous_pos
+        self.signed_weights = np.concatenate((self.neg_weights, self.pos_weights))
+        # upper end of the effectively neutral portion of integrate_continuous_pos
+        self.smallest_posgamma = self.gammas[Nneg:].min() if len(self.gammas) > Nneg else None
+        # integrated spectra are only valid for the current gammas
+        self._integrate_memo = OrderedDict()
+        self._integrate_hits, self._integrate_misses = 0, 0
 
+    @staticmethod
+    def _check_gammas(neg_gammas, pos_gammas, check_order=True):
+        """
+        Raise ValueError unless neg_gammas are negative and pos_gammas positive,
+        each in increasing order (if check_order), as the quadrature weights
+        need. Checked before computing any spectrum, so bad gammas fail early.
+        """
+        neg_gammas = np.asarray(neg_gammas, dtype=float)
+        pos_gammas = np.asarray(pos_gammas, dtype=float)
+        if np.any(neg_gammas >= 0) or np.any(pos_gammas <= 0):
+            raise ValueError('Cache1D gammas must be the negative gammas followed by the positive gammas')
+        if check_order and (np.any(np.diff(neg_gammas) <= 0) or np.any(np.diff(pos_gammas) <= 0)):
+            raise ValueError('Cache1D gammas must be sorted in increasing order without duplicates')
+        return None
+
+    def extend(self, gamma_bounds, gamma_pts, additional_gammas=[],
+               mp=False, cpus=None, gpus=0, verbose=False, checkpoint=None,
+               batch_func=None, batch_size=20):
+        """
+        Extend the cached gamma grid in place. Only the spectra of gammas not
+        already cached are computed, then all spectra are merged in sorted order.
+
+        gamma_bounds, gamma_pts: New grid of negative gammas, as for Cache1D.
+                                 Merged with the cached negative gammas.
+        additional_gammas: Positive gammas, merged with the cached positive gammas.
+        mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size: Same as for Cache1D
+        """
+        if self.demo_sel_func is None:
+            raise ValueError('demo_sel_func of the Cache1D is unknown, cannot compute new spectra')
+        if self.quadrature == 'gauss':
+            # merged panels of nodes are not a Gauss-Legendre rule anymore
+            raise ValueError('Cache1D with gauss quadrature cannot be extended, build a new one')
+
+        Nneg = len(self.neg_gammas)
+        new_neg_gammas = -gamma_grid(gamma_bounds, gamma_pts, self.quadrature, self.gauss_order, descending=True)
+        neg_gammas = merge_gammas(self.neg_gammas, new_neg_gammas)
+        pos_gammas = merge_gammas(self.gammas[Nneg:], additional_gammas)
+        if verbose:
+            print('Extending Cache1D from {0} to {1} gammas'.format(len(self.gammas), len(neg_gammas) + len(pos_gammas)))
+        self._set_gammas(neg_gammas, pos_gammas, mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size)
+
+    def refine(self, tol, max_pts=None, max_step=0.1, min_step=1e-3, max_rounds=None, mp=False, cpus=None, gpus=0,
+               verbose=False, checkpoint=None, batch_func=None, batch_size=20):
+        """
+        Adaptive refinement of the cached gamma grid in place. Every interval
+        between neighbouring cached gammas (of the same sign) where the spectra
+        differ from the interpolation of their neighbours by more than tol is
+        bisected in log(gamma), and the new spectra computed, until no interval
+        does, the cache holds max_pts gammas or max_rounds rounds were made. The intervals with the largest
+        errors are bisected first. Intervals wider than max_step are always
+        bisected, as the spectra are integrated against DFEs that can vary
+        faster than the spectra themselves.
+
+        tol: Largest relative interpolation error of the spectra, see
+             `Cache1D_util.interp_errors`
+        max_pts: Budget of cached gammas (negative and positive). None for no budget.
+        max_step: Widest interval in log10(gamma). None for no limit.
+        min_step: Intervals narrower than min_step in log10(gamma) are not bisected,
+                  so the numerical noise of the spectra cannot refine forever.
+        max_rounds: Largest number of bisection rounds. None for no limit.
+        mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size: Same as for Cache1D
+
+        The settings and the number of rounds are recorded in self.refinement.
+        """
+        if self.demo_sel_func is None:
+            raise ValueError('demo_sel_func of the Cache1D is unknown, cannot compute new spectra')
+        if self.quadrature == 'gauss':
+            raise ValueError('Cache1D with gauss quadrature cannot be refined, use trapz or simpson')
+
+        rounds = 0
+        while max_rounds is None or rounds < max_rounds:
+            Nneg = len(self.neg_gammas)
+            new_gammas, errors = [], []
+            cached_spectra = self.spectra
+            for gammas, spectra in [(self.gammas[:Nneg], cached_spectra[:Nneg]),
+                                    (self.gammas[Nneg:], cached_spectra[Nneg:])]:
+                interval_errors = interp_errors(gammas, spectra)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    widths = np.abs(np.diff(np.log10(np.abs(gammas))))
+                if max_step is not None:
+                    interval_errors = np.where(widths > max_step, np.inf, interval_errors)
+                coarse = np.nonzero((interval_errors > tol) & (widths >= min_step))[0]
+                # midpoints in log(gamma), same sign
+                new_gammas.append(np.sign(gammas[coarse])*np.sqrt(gammas[coarse]*gammas[coarse+1]))
+                errors.append(interval_errors[coarse])
+            new_gammas, errors = np.concatenate(new_gammas), np.concatenate(errors)
+            if max_pts is not None:
+                # worst intervals first within the budget
+                budget = max(max_pts - len(self.gammas), 0)
+                new_gammas = new_gammas[np.argsort(-errors, kind='stable')[:budget]]
+            neg_gammas = merge_gammas(self.neg_gammas, new_gammas[new_gammas < 0])
+            pos_gammas = merge_gammas(self.gammas[Nneg:], new_gammas[new_gammas > 0])
+            if len(neg_gammas) + len(pos_gammas) == len(self.gammas):
+                break
+            rounds += 1
+            if verbose:
+                print('Refining Cache1D from {0} to {1} gammas'.format(len(self.gammas), len(neg_gammas) + len(pos_gammas)))
+            self._set_gammas(neg_gammas, pos_gammas, mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size)
+        self.refinement = {'tol': float(tol), 'max_pts': max_pts, 'max_step': max_step,
+                           'min_step': float(min_step), 'max_rounds': max_rounds, 'rounds': rounds}
+
+    def _set_gammas(self, neg_gammas, pos_gammas, mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size):
+        """
+        Replace the cached gammas by the sorted neg_gammas and pos_gammas, which
+        include all the cached gammas. Only the spectra of the new gammas are computed.
+        """
+        self._check_gammas(neg_gammas, pos_gammas)
+        gammas = np.concatenate((neg_gammas, pos_gammas))
+
+        # copy the cached spectra to their new rows
+        cached = dict(zip(self.gammas.tolist(), range(len(self.gammas))))
+        cached_spectra = self.spectra
+        spectra = np.zeros((len(gammas),) + cached_spectra.shape[1:], dtype=self.spectra_dtype)
+        todo = []
+        for ii, gamma in enumerate(gammas):
+            if gamma in cached:
+                spectra[ii] = cached_spectra[cached[gamma]]
+            else:
+                todo.append(ii)
+
+        self.gammas = gammas
+        self.neg_gammas = neg_gammas
+        self.spectra = spectra
+        self._compute_spectra(todo, mp, cpus, gpus, verbose, checkpoint, batch_func, batch_size)
+        self._set_quad_weights()
+
+    def project(self, ns):
+        """
+        Cache1D with all spectra projected down to the smaller sample size ns,
+        as in `dadi.Spectrum.project`. Projections are memoized per ns, so one
+        cache built at a large sample size serves every smaller one.
+
+        ns: Sample size(s) to project to
+        """
+        ns = tuple(int(x) for x in ns)
+        if ns == tuple(int(x) for x in self.ns):
+            return self
+        if len(ns) != 1 or ns[0] > self.ns[0]:
+            raise ValueError('Cannot project Cache1D with sample size {0} to {1}'.format(self.ns, ns))
+
+        projections = self.__dict__.setdefault('_projections', {})
+        if ns not in projections:
+            projector = projection_matrix(self.ns[0], ns[0])
+            if self.folded:
+                # folded spectra are the lower bins of unfolded ones with zeros above
+                projector = fold_data(projector[:self._stored_bins()], ns[0])
+            if self.spectra_factors is None:
+                spectra = np.dot(np.asarray(self.spectra, dtype=float), projector).astype(self.spectra_dtype)
+            else:
+                # the projection keeps the rank
+                left, right = self.spectra_factors
+                spectra = (left, np.dot(right, projector))
+            projections[ns] = Cache1D.from_arrays(
+                params=self.params,
+                ns=list(ns),
+                pts_l=self.pts_l,
+                gammas=self.gammas,
+                neg_gammas=self.neg_gammas,
+                spectra=spectra,
+                neu_spec=self.neu_spec.project(ns),
+                demo_sel_func=self.demo_sel_func,
+                quadrature=self.quadrature,
+                gauss_order=self.gauss_order,
+                refinement=self.refinement,
+                lowrank=self.lowrank,
+                folded=self.folded)
+        return projections[ns]
+
+    def _compute_spectra(self, todo, mp, cpus, gpus, verbose, checkpoint,
+                         batch_func=None, batch_size=20):
+        """
+        Compute the spectra for the indices of self.gammas in todo, reusing the
+        spectra found in the checkpoint directory.
+        """
+        if checkpoint is not None:
+            todo = self._load_checkpoint(checkpoint, verbose, todo)
+
+        if batch_func is None:
+            batch_size = 1
         if not mp: #for running with a single thread
-            self._single_process(verbose)
+            self._single_process(verbose, todo, checkpoint, batch_func, batch_size)
         else: #for running with with multiple cores
-            self._multiple_processes(cpus, gpus, verbose)
+            self._multiple_processes(cpus, gpus, verbose, todo, checkpoint, batch_func, batch_size)
 
-        demo_sel_extrap_func = Numerics.make_extrap_func(self.demo_sel_func)
-        self.neu_spec = demo_sel_extrap_func(tuple(self.params)+(0,), self.ns, self.pts_l)
-        self.spectra = np.array(self.spectra)
+    def _load_checkpoint(self, checkpoint, verbose, todo):
+        """
+        Fill self.spectra with the spectra in todo found in the checkpoint directory.
+        Returns the indices of the gammas that are still missing.
+        """
+        settings = {
+            'demo_sel_func': '{0}.{1}'.format(self.demo_sel_func.__module__, self.demo_sel_func.__name__),
+            'params': [float(x) for x in self.params],
+            'ns': [int(x) for x in self.ns],
+            'pts_l': [int(x) for x in self.pts_l]
+        }
+        init_checkpoint(checkpoint, settings)
+        missing = []
+        for ii in todo:
+            sfs = load_checkpoint(checkpoint, self.gammas[ii])
+            if sfs is None:
+                missing.append(ii)
+            else:
+                self.spectra[ii] = self._to_stored(sfs)
+        if verbose:
+            print('Checkpoint {0}: {1} of {2} gammas found'.format(
+                checkpoint, len(todo)-len(missing), len(todo)))
+        return missing
 
-    def _single_process(self, verbose):
-        demo_sel_extrap_func = Numerics.make_extrap_func(self.demo_sel_func)
-        for ii, gamma in enumerate(self.gammas):
-            self.spectra[ii] = demo_sel_extrap_func(tuple(self.params)+(gamma,), self.ns,
-                                             self.pts_l)
-            if verbose:
-               print('{0}: {1}'.format(ii, gamma))
+    @staticmethod
+    def _block_func(popn_func_ex, batch_func, params, ns, pts_l):
+        """
+        Extrapolating function returning the spectra of a list of gammas as a
+        2D array, through batch_func if given, otherwise one gamma at a time.
+        """
+        if batch_func is not None:
+            # batch_func returns plain arrays, so give the x values explicitly
+            extrap_x_l = [Numerics.default_grid(pts)[1] for pts in pts_l]
+            batch_func_ex = Numerics.make_extrap_func(batch_func, extrap_x_l=extrap_x_l)
+            def block_func(gammas):
+                return batch_func_ex(tuple(params)+(np.asarray(gammas),), ns, pts_l)
+        else:
+            popn_func_ex = Numerics.make_extrap_func(popn_func_ex)
+            def block_func(gammas):
+                return np.array([popn_func_ex(tuple(params)+(gamma,), ns, pts_l).data
+                                 for gamma in gammas])
+        return block_func
 
-    def _multiple_processes(self, cpus, gpus, verbose):
-        from multiprocessing import Manager, Process, cpu_count
+    def _single_process(self, verbose, todo, checkpoint, batch_func, batch_size):
+        block_func = self._block_func(self.demo_sel_func, batch_func, self.params, self.ns, self.pts_l)
+        for jj in range(0, len(todo), batch_size):
+            block = todo[jj:jj+batch_size]
+            block_spectra = block_func(self.gammas[block])
+            self.spectra[block] = self._to_stored(block_spectra)
+            for ii, sfs in zip(block, block_spectra):
+                gamma = self.gammas[ii]
+                # checkpoints keep the unfolded float64 spectra
+                if checkpoint is not None:
+                    save_checkpoint(checkpoint, gamma, sfs)
+                if verbose:
+                   print('{0}: {1}'.format(ii, gamma))
+
+    def _multiple_processes(self, cpus, gpus, verbose, todo, checkpoint, batch_func, batch_size):
+        from multiprocessing import Process, RawArray, Value, cpu_count
 
         if cpus is None:
             cpus = cpu_count() - 1
 
-        with Manager() as manager:
-            work = manager.Queue(cpus)
-            results = manager.list()
-
-            # Assemble pool of workers
-            pool = []
-            for ii in range(cpus):
-                p = Process(target=self._worker_sfs,
-                            args=(work, results, self.demo_sel_func, self.params, self.ns, self.pts_l, verbose, False))
-                p.start()
-                pool.append(p)
-            for ii in range(gpus):
-                p = Process(target=self._worker_sfs,
-                            args=(work, results, self.demo_sel_func, self.params, self.ns, self.pts_l, verbose, True))
-                p.start()
-                pool.append(p)
-
-            # Put all jobs on queue
-            for ii, gamma in enumerate(self.gammas):
-                work.put((ii, gamma))
-            # Put commands on queue to close out workers
-            for jj in range(cpus+gpus):
-                work.put(None)
-            # Stop workers
-            for p in pool:
-                p.join()
-            # Collect results
-            for ii, sfs in results:
-                self.spectra[ii] = sfs
-
-    def _worker_sfs(self, in_queue, outlist, popn_func_ex, params, ns, pts_l, verbose, usegpu):
+        # Workers write their spectra straight into this shared buffer
+        shape = self.spectra.shape
+        buffer = RawArray(np.ctypeslib.as_ctypes_type(np.dtype(self.spectra_dtype)), int(np.prod(shape)))
+        spectra = np.frombuffer(buffer, dtype=self.spectra_dtype).reshape(shape)
+        spectra[:] = self.spectra
+        # 0: not computed, 1: done, -1: failed
+        status = RawArray('b', len(self.gammas))
+        # index of the next entry in todo to compute
+        counter = Value('i', 0)
+
+        # Assemble pool of workers
+        pool = []
+        for ii in range(cpus):
+            p = Process(target=self._worker_sfs,
+                        args=(buffer, shape, status, counter, todo, self.demo_sel_func, self.params, self.ns, self.pts_l, verbose, False, checkpoint, batch_func, batch_size))
+            p.start()
+            pool.append(p)
+        # batch_func does not run on GPUs
+        for ii in range(gpus):
+            p = Process(target=self._worker_sfs,
+                        args=(buffer, shape, status, counter, todo, self.demo_sel_func, self.params, self.ns, self.pts_l, verbose, True, checkpoint, None, batch_size))
+            p.start()
+            pool.append(p)
+
+        # Stop workers
+        for p in pool:
+            p.join()
+
+        failed = [self.gammas[ii] for ii in todo if status[ii] != 1]
+        if len(failed) > 0:
+            raise RuntimeError('Failed to compute the spectra for {0} gammas: {1}'.format(len(failed), [float(x) for x in failed]))
+        self.spectra = spectra
+
+    def _worker_sfs(self, buffer, shape, status, counter, todo, popn_func_ex, params, ns, pts_l, verbose, usegpu, checkpoint,
+                    batch_func=None, batch_size=1):
         """
         Worker function -- used to generate SFSes for
-        single values of gamma.
+        blocks of batch_size gammas, written into the shared spectra buffer.
         """
-        popn_func_ex = Numerics.make_extrap_func(popn_func_ex)
+        spectra = np.frombuffer(buffer, dtype=self.spectra_dtype).reshape(shape)
+        block_func = self._block_func(popn_func_ex, batch_func, params, ns, pts_l)
         dadi.cuda_enabled(usegpu)
         while True:
-            item = in_queue.get()
-            if item is None:
+            # Take the next block of gammas to compute
+            with counter.get_lock():
+                jj = counter.value
+                counter.value += batch_size
+            if jj >= len(todo):
                 return
-            ii, gamma = item
+            block = todo[jj:jj+batch_size]
             try:
-                sfs = popn_func_ex(tuple(params)+(gamma,), ns, pts_l)
-                if verbose:
-                    print('{0}: {1}'.format(ii, gamma))
-                outlist.append((ii, sfs))
+                block_spectra = block_func(self.gammas[block])
+                spectra[block] = self._to_stored(block_spectra)
+                for ii, sfs in zip(block, block_spectra):
+                    gamma = self.gammas[ii]
+                    if checkpoint is not None:
+                        save_checkpoint(checkpoint, gamma, sfs)
+                    status[ii] = 1
+                    if verbose:
+                        print('{0}: {1}'.format(ii, gamma))
             except BaseException as inst:
                 # If an exception occurs in the worker function, print an error
-                # and populate the outlist with an item that will cause a later crash.
+                # and flag the gammas as failed, the parent process reports them.
                 tb = sys.exc_info()[2]
                 traceback.print_tb(tb)
-                outlist.append(inst)
+                for ii in block:
+                    if status[ii] != 1:
+                        status[ii] = -1
 
     def integrate(self, params, ns, sel_dist, theta, pts=None, exterior_int=True):
         """
@@ -147,39 +690,253 @@ class Cache1D:
         present for compatibility with other dadi functions that apply to
         demographic models.
         """
+        return self._to_spectrum(self._memoized(self._integrate, params, sel_dist, theta, exterior_int))
+
+    def integrate_array(self, params, ns, sel_dist, theta, pts=None, exterior_int=True, data=None):
+        """
+        Same as `integrate`, but return the model spectrum as a plain array
+        (corners not masked), for the log-likelihood fast path of `Cache1D_util.PoissonLL`.
+
+        The model of folded spectra is only valid for folded data, see
+        `check_data`: ns, and data if given, are checked against the spectra.
+        """
+        self.check_data(data, ns)
+        return self._memoized(self._integrate, params, sel_dist, theta, exterior_int)
+
+    def _integrate(self, params, sel_dist, theta, exterior_int):
         # Restrict ourselves to negative gammas
         Nneg = len(self.neg_gammas)
-        spectra = self.spectra[:Nneg]
 
         # Weights for integration
         weights = sel_dist(-self.neg_gammas, params)
 
-        weighted_spectra = 0*spectra
-        for ii, w in enumerate(weights):
-            weighted_spectra[ii] = w*spectra[ii]
-
-        fs = np.trapz(weighted_spectra, self.neg_gammas, axis=0)
+        fs = self._dot_spectra(weights*self.neg_weights, 0, Nneg)
         if not exterior_int:
-            return Spectrum(theta*fs)
+            return theta*self._to_model(fs)
+
+        weight_neu, weight_del = self._exterior_weights(params, sel_dist)
 
+        fs += self._neu_data()*weight_neu
+        fs += self._spectrum(0)*weight_del
+
+        return theta*self._to_model(fs)
+
+    def integrate_jac(self, params, ns, sel_dist, theta, pts=None, exterior_int=True):
+        """
+        Same as `integrate`, but return (model, jac), where jac is the Jacobian
+        of the model spectrum with respect to params, one row per param.
+
+        The model is linear in the weights of sel_dist, so jac is the gradient
+        of the weights times the cached spectra. The gradient registered for
+        sel_dist in PDFs2.grad_functions is used, otherwise finite differences of
+        sel_dist. The derivatives of the exterior weights are finite differences.
+        """
+        model = self.integrate(params, ns, sel_dist, theta, pts, exterior_int)
+        Nneg = len(self.neg_gammas)
+        jac = self._weights_jac(-self.neg_gammas, self.neg_weights, Nneg,
+                                params, sel_dist, exterior_int and self._exterior_weights)
+        return model, theta*jac
+
+    def integrate_continuous_pos_jac(self, params, ns, sel_dist, theta, pts=None, exterior_int=True):
+        """
+        Same as `integrate_continuous_pos`, but return (model, jac) as in `integrate_jac`.
+        """
+        model = self.integrate_continuous_pos(params, ns, sel_dist, theta, pts, exterior_int)
+        jac = self._weights_jac(self.gammas, self.signed_weights, len(self.gammas),
+                                params, sel_dist, exterior_int and self._exterior_weights_pos)
+        return model, theta*jac
+
+    def _weights_jac(self, xx, quad_weights, stop, params, sel_dist, exterior_weights):
+        """
+        Jacobian of the integrated spectra (before scaling by theta) over the
+        gammas xx, the first stop cached gammas, with quadrature weights quad_weights. exterior_weights is the
+        method giving the weights outside the cached gammas, or False.
+        """
+        params = np.asarray(params, dtype=float)
+        grad = PDFs2.grad_functions.get(sel_dist)
+        if grad is not None:
+            dweights = grad(xx, params)
+        else:
+            dweights = central_diff(lambda pp: sel_dist(xx, pp), params)
+        jac = self._dot_spectra(dweights*quad_weights, 0, stop)
+        if exterior_weights:
+            dexterior = central_diff(lambda pp: exterior_weights(pp, sel_dist), params)
+            jac += np.outer(dexterior[:,0], self._neu_data())
+            jac += np.outer(dexterior[:,1], self._spectrum(0))
+        return self._to_model(jac)
+
+    def _memoized(self, method, params, sel_dist, theta, exterior_int):
+        """
+        Return method(params, sel_dist, theta, exterior_int) from a bounded LRU
+        memo of integrated spectra, computing it on a miss. The memo is keyed by
+        (sel_dist, params, theta, method, exterior_int) and cleared whenever the
+        cached gammas change.
+        """
+        key = (sel_dist, tuple(np.asarray(params, dtype=float).ravel().tolist()),
+               float(theta), method.__name__, exterior_int)
+        memo = self._integrate_memo
+        if key in memo:
+            memo.move_to_end(key)
+            self._integrate_hits += 1
+            # copies, so callers can modify the returned spectra
+            return memo[key].copy()
+        self._integrate_misses += 1
+        fs = method(params, sel_dist, theta, exterior_int)
+        memo[key] = fs.copy()
+        while len(memo) > self.integrate_memo_size:
+            memo.popitem(last=False)
+        return fs
+
+    def integrate_memo_info(self):
+        """
+        Hits, misses and size of the memo of integrated spectra, counted since
+        the cached gammas last changed.
+        """
+        return {'hits': self._integrate_hits, 'misses': self._integrate_misses,
+                'maxsize': self.integrate_memo_size, 'currsize': len(self._integrate_memo)}
+
+    def _exterior_weights(self, params, sel_dist):
+        """
+        Weights of sel_dist outside the sampled negative gammas, returned as
+        (weight_neu, weight_del) for the effectively neutral and the effectively
+        lethal portions.
+        """
+        weight_neu, weight_del = self._exterior_weights_batch(np.atleast_2d(params), sel_dist)[0]
+        return float(weight_neu), float(weight_del)
+
+    def _exterior_weights_batch(self, params_matrix, sel_dist):
+        """
+        Same as `_exterior_weights` for each row of params_matrix, as a 2D array
+        with columns (weight_neu, weight_del).
+        """
         smallest_gamma = self.neg_gammas[-1]
         largest_gamma = self.neg_gammas[0]
-        # Compute weight for the effectively neutral portion. Not using
-        # CDF function because want this to be able to compute weight
-        # for arbitrary mass functions
-        weight_neu, err_neu = scipy.integrate.quad(sel_dist, 0, -smallest_gamma,
+        # Use the CDF of sel_dist if one is registered in PDFs2.cdf_functions,
+        # for all parameter sets at once as the CDFs broadcast over their params,
+        # otherwise integrate numerically to allow arbitrary mass functions
+        cdfs = PDFs2.cdf_functions.get(sel_dist)
+        if cdfs is not None:
+            cdf, sf = cdfs
+            columns = np.asarray(params_matrix, dtype=float).T
+            weight_neu = cdf(-smallest_gamma, columns) - cdf(0, columns)
+            weight_del = sf(-largest_gamma, columns)
+            return np.column_stack(np.broadcast_arrays(weight_neu, weight_del)).astype(float)
+        weights = []
+        for params in params_matrix:
+            # Compute weight for the effectively neutral portion.
+            weight_neu, err_neu = scipy.integrate.quad(sel_dist, 0, -smallest_gamma,
+                                                       args=params)
+            # compute weight for the effectively lethal portion
+            weight_del, err = scipy.integrate.quad(sel_dist, -largest_gamma, np.inf,
                                                    args=params)
-        # compute weight for the effectively lethal portion
-        weight_del, err = scipy.integrate.quad(sel_dist, -largest_gamma, np.inf,
-                                               args=params)
+            weights.append((weight_neu, weight_del))
+        return np.array(weights, dtype=float)
+
+    def _exterior_weights_pos(self, params, sel_dist):
+        """
+        Same as `_exterior_weights` for `integrate_continuous_pos`, where sel_dist
+        takes signed gammas. The effectively neutral portion spans from the
+        smallest negative to the smallest positive gamma.
+        """
+        weight_neu, weight_del = self._exterior_weights_pos_batch(np.atleast_2d(params), sel_dist)[0]
+        return float(weight_neu), float(weight_del)
 
-        fs += self.neu_spec*weight_neu
-        fs += spectra[0]*weight_del
+    def _exterior_weights_pos_batch(self, params_matrix, sel_dist):
+        """
+        Same as `_exterior_weights_pos` for each row of params_matrix, as in
+        `_exterior_weights_batch`.
+        """
+        smallest_gamma = self.neg_gammas[-1]
+        largest_gamma = self.neg_gammas[0]
+        smallest_posgamma = self.smallest_posgamma
+        cdfs = PDFs2.cdf_functions.get(sel_dist)
+        if cdfs is not None:
+            cdf, sf = cdfs
+            columns = np.asarray(params_matrix, dtype=float).T
+            weight_neu = cdf(smallest_posgamma, columns) - cdf(smallest_gamma, columns)
+            weight_del = cdf(largest_gamma, columns)
+            return np.column_stack(np.broadcast_arrays(weight_neu, weight_del)).astype(float)
+        weights = []
+        for params in params_matrix:
+            # Integrate over negative effectively neutral to positive effectively neutral
+            weight_neu, err_neu = scipy.integrate.quad(sel_dist, smallest_gamma, smallest_posgamma,
+                                                    args=params, points=[0.])
+            # compute weight for the effectively lethal portion
+            weight_del, err_del = scipy.integrate.quad(sel_dist, -np.inf, largest_gamma,
+                                                    args=params)
+            weights.append((weight_neu, weight_del))
+        return np.array(weights, dtype=float)
 
-        return Spectrum(theta*fs)
+    def integrate_batch(self, params_matrix, sel_dist, theta, data=None, exterior_int=True):
+        """
+        Integrate spectra over a univariate prob. dist. for negative gammas,
+        for many parameter sets at once.
+
+        params_matrix: 2D array with one set of sel_dist parameters per row
+        sel_dist: Univariate probability distribution,
+                  taking in arguments (xx, params)
+        theta: Population-scaled mutation rate
+        data: If given, a dadi Spectrum or its `Cache1D_util.PoissonLL`. Return the
+              Poisson log-likelihood of the data given each model instead of the model spectra.
+        exterior_int: If False, do not integrate outside sampled domain.
+
+        Returns a 2D array of model spectra data (one row per parameter set,
+        same as `integrate`), or a 1D array of log-likelihoods if data is given.
+        """
+        self.check_data(data)
+        params_matrix = np.atleast_2d(params_matrix)
+        Nneg = len(self.neg_gammas)
+
+        # Weights for integration, one row per parameter set, from one call of sel_dist
+        weights = pdf_matrix(sel_dist, -self.neg_gammas, params_matrix)
+        weights *= self.neg_weights
+
+        # one matrix multiply for all parameter sets
+        fs = self._dot_spectra(weights, 0, Nneg)
+
+        if exterior_int:
+            weights_ext = self._exterior_weights_batch(params_matrix, sel_dist)
+            fs += np.outer(weights_ext[:,0], self._neu_data())
+            fs += np.outer(weights_ext[:,1], self._spectrum(0))
+
+        fs = theta*self._to_model(fs)
+        if data is None:
+            return fs
+        return batch_ll(fs, data)
+
+    def integrate_continuous_pos_batch(self, params_matrix, sel_dist, theta, data=None, exterior_int=True):
+        """
+        Same as `integrate_batch` for `integrate_continuous_pos`, integrating
+        sel_dist over the negative and positive gammas.
+        """
+        self.check_data(data)
+        if self.smallest_posgamma is None:
+            raise IndexError('Cache1D object has no positive gammas')
+        params_matrix = np.atleast_2d(params_matrix)
+
+        # Weights for integration, one row per parameter set, from one call of sel_dist
+        weights = pdf_matrix(sel_dist, self.gammas, params_matrix)
+        weights *= self.signed_weights
+
+        if exterior_int:
+            weights_ext = self._exterior_weights_pos_batch(params_matrix, sel_dist)
+            # the effectively lethal portion uses the spectrum of the largest negative gamma
+            weights[:,0] += weights_ext[:,1]
+
+        # one matrix multiply for all parameter sets
+        fs = self._dot_spectra(weights)
+
+        if exterior_int:
+            fs += np.outer(weights_ext[:,0], self._neu_data())
+
+        fs = theta*self._to_model(fs)
+        if data is None:
+            return fs
+        return batch_ll(fs, data)
 
     def integrate_point_pos(self, params, ns, sel_dist, theta, demo_sel_func=None,
-                            Npos=1, pts=None, exterior_int=True):
+                            Npos=1, pts=None, exterior_int=True, exact=False, interp_tol=None,
+                            scale_pos=False):
         """
         Integrate spectra over a univariate prob. dist. for negative gammas,
         plus one or more point masses of positive selection.
@@ -193,42 +950,139 @@ class Cache1D:
                   taking in arguments (xx, params)
         theta: Population-scaled mutation rate
         demo_sel_func: DaDi demographic function with selection.
-                       gamma must be the last argument.
+                       gamma must be the last argument. If given, gammapos
+                       that are not cached are solved exactly, as in dadi.
         Npos: Number of positive point masses to model.
         pts: Ignored, evaluation of demo_self_func will use pts_l from orignal
                caching.
         exterior_int: If False, do not integrate outside sampled domain.
+        exact: If True, solve every gammapos that is not cached exactly, with
+               the demo_sel_func of the cache if demo_sel_func is not given.
+        interp_tol: If not None, solve exactly where the error estimate of the
+                    interpolation is larger than interp_tol.
+        scale_pos: If True, scale the spectra of every point mass by theta, like
+                   the continuous part. By default only the exactly solved ones
+                   are, as in dadi and earlier versions.
+
+        Without demo_sel_func, the spectra of gammapos that are not cached are
+        interpolated from the cached positive gammas, see `interpolate_spectrum`,
+        so gammapos can be optimized at the cost of a few cached spectra. Exact
+        solves are kept in an LRU memo of point_memo_size spectra, the cached
+        gammas do not change.
+
+        The cached spectra are for theta=1, as in `integrate`. dadi scales the
+        spectra of the gammapos it solves by theta, but not the cached (or, here,
+        interpolated) ones, which scale_pos=True corrects. The ppos fitted with
+        scale_pos=True are not comparable to those of dadi.
 
         Note also that the ns and pts arguments are ignored. They are only
         present for compatibility with other dadi functions that apply to
         demographic models.
         """
-        pdf_params, ppos, gammapos = params[:-2*Npos], params[-2], params[-1]
+        pdf_params = params[:-2*Npos]
         ppos_l, gammapos_l = params[-2*Npos::2], params[-2*Npos+1::2]
 
         pdf_fs = self.integrate(pdf_params, None, sel_dist, theta, None,
                                 exterior_int=exterior_int)
         result = (1-np.sum(ppos_l))*pdf_fs
 
-        if demo_sel_func is not None:
-            demo_sel_func = Numerics.make_extrap_func(demo_sel_func)
-
         for ppos, gammapos in zip(ppos_l, gammapos_l):
-            if gammapos not in self.gammas:
-                if demo_sel_func is None:
+            solve = (exact or demo_sel_func is not None) and gammapos not in self.gammas
+            if not solve:
+                try:
+                    pos_data, error = self.interpolate_spectrum(gammapos)
+                except ValueError:
                     raise IndexError('Failed to find requested gammapos={0:.4f} '
-                                     'in Cache1D spectra. Was it included in '
+                                     'in the range of Cache1D spectra. Was it included in '
                                      'additional_gammas during cache generation?'.format(gammapos))
-                pos_fs = theta*demo_sel_func(tuple(self.params) + (gammapos,),
-                                             self.ns, self.pts_l)
-                self.gammas = np.append(self.gammas, gammapos)
-                self.spectra = np.append(self.spectra, [pos_fs.data], axis=0)
-            ii = list(self.gammas).index(gammapos)
-            pos_fs = Spectrum(self.spectra[ii])
-            result += ppos*pos_fs
+                solve = interp_tol is not None and error > interp_tol and gammapos not in self.gammas
+            scale = theta if scale_pos else 1
+            if solve:
+                pos_data = self._solve_spectrum(gammapos, demo_sel_func)
+                scale = theta
+            result += ppos*scale*self._to_spectrum(pos_data)
 
         return result
 
+    def interpolate_spectrum(self, gamma):
+        """
+        Spectrum of gamma interpolated from the cached spectra of the same sign,
+        by monotone cubic (PCHIP) interpolation in log(|gamma|), bin by bin. It
+        is the same as interpolating over all cached gammas, but only the few
+        cached spectra around gamma are used.
+
+        Returns (spectrum, error), the spectrum unscaled and unfolded like the
+        model spectra of `integrate_array`. error estimates the relative error:
+        the larger error of interpolating either of the two cached spectra
+        around gamma from their own neighbours, at twice the grid spacing, so
+        it is usually an overestimate. It is the summed absolute difference
+        over the bins other than the corners, relative to the summed spectrum.
+        error is 0 for a cached gamma and nan if it cannot be estimated.
+
+        Raises ValueError if gamma is outside the cached gammas of its sign.
+        """
+        if gamma == 0:
+            return self._to_model(self._neu_data()), 0.
+        Nneg = len(self.neg_gammas)
+        block = np.arange(Nneg, len(self.gammas)) if gamma > 0 else np.arange(Nneg)
+        cached = np.nonzero(self.gammas[block] == gamma)[0]
+        if len(cached) > 0:
+            return self._to_model(self._spectrum(block[cached[0]])), 0.
+        xx = np.log(np.abs(self.gammas[block]))
+        order = np.argsort(xx)
+        block, xx = block[order], xx[order]
+        x = np.log(np.abs(gamma))
+        if len(xx) < 2 or x < xx[0] or x > xx[-1]:
+            raise ValueError('gamma={0} is outside the cached gammas'.format(gamma))
+
+        # interval [kk, kk+1] around gamma, and the spectra the interpolation
+        # and its error estimate depend on
+        kk = min(np.searchsorted(xx, x, side='right') - 1, len(xx) - 2)
+        lo, hi = max(kk - 2, 0), min(kk + 4, len(xx))
+        xw = xx[lo:hi]
+        rows = np.array([self._spectrum(ii) for ii in block[lo:hi]])
+        ss = kk - lo
+        window = slice(max(ss - 1, 0), ss + 3)
+        spectrum = scipy.interpolate.PchipInterpolator(xw[window], rows[window], axis=0)(x)
+
+        errors = []
+        for jj in [ss, ss + 1]:
+            # only inner cached spectra can be interpolated from their neighbours
+            if lo + jj == 0 or lo + jj == len(xx) - 1:
+                continue
+            neighbours = [ii for ii in range(jj - 2, jj + 3) if ii != jj and 0 <= ii < len(xw)]
+            predicted = scipy.interpolate.PchipInterpolator(xw[neighbours], rows[neighbours], axis=0)(xw[jj])
+            scale = np.abs(rows[jj,1:-1]).sum()
+            if scale > 0:
+                errors.append(np.abs(predicted[1:-1] - rows[jj,1:-1]).sum()/scale)
+        error = max(errors) if len(errors) > 0 else np.nan
+        return self._to_model(spectrum), float(error)
+
+    def _solve_spectrum(self, gamma, demo_sel_func=None):
+        """
+        Spectrum of gamma from an exact solve of demo_sel_func (default: the
+        demo_sel_func of the cache), unscaled and unfolded like the model
+        spectra of `integrate_array`. The last point_memo_size solves are kept.
+        """
+        if demo_sel_func is None:
+            demo_sel_func = self.demo_sel_func
+        if demo_sel_func is None:
+            raise ValueError('demo_sel_func of the Cache1D is unknown, cannot solve gamma={0}'.format(gamma))
+        memo = self.__dict__.setdefault('_point_memo', OrderedDict())
+        key = (demo_sel_func, float(gamma))
+        if key in memo:
+            memo.move_to_end(key)
+            return memo[key].copy()
+        func_ex = Numerics.make_extrap_func(demo_sel_func)
+        data = func_ex(tuple(self.params) + (gamma,), self.ns, self.pts_l).data
+        if self.folded:
+            data = fold_data(data, self.ns[0])
+        spectrum = self._to_model(np.asarray(data, dtype=float))
+        memo[key] = spectrum.copy()
+        while len(memo) > self.point_memo_size:
+            memo.popitem(last=False)
+        return spectrum
+
     def integrate_continuous_pos(self, params, ns, sel_dist, theta, pts=None, exterior_int=True):
         """
         Adapted from Huber et al. 2017. and `Cache1D.integrate` methods.
@@ -250,62 +1104,35 @@ class Cache1D:
         present for compatibility with other dadi functions that apply to
         demographic models.
         """
+        return self._to_spectrum(self._memoized(self._integrate_continuous_pos, params, sel_dist, theta, exterior_int))
 
-        # Get negative gammas
-        Nneg = len(self.neg_gammas)
-        spectra_neg = self.spectra[:Nneg]
+    def integrate_continuous_pos_array(self, params, ns, sel_dist, theta, pts=None, exterior_int=True, data=None):
+        """
+        Same as `integrate_continuous_pos`, but return the model spectrum as a plain array
+        (corners not masked), for the log-likelihood fast path of `Cache1D_util.PoissonLL`.
+        ns and data are checked as in `integrate_array`.
+        """
+        self.check_data(data, ns)
+        return self._memoized(self._integrate_continuous_pos, params, sel_dist, theta, exterior_int)
 
-        # Get positive gammas
-        pos_gammas = self.gammas.copy()
-        pos_gammas = pos_gammas[pos_gammas > 0]
-        Npos = len(pos_gammas)
-        spectra_pos = self.spectra[Nneg:]
-        # confirm Nneg filters
-        if spectra_pos.shape[0] != Npos:
-            raise IndexError('Cache1D object does not sort gamma')
+    def _integrate_continuous_pos(self, params, sel_dist, theta, exterior_int):
+        if self.smallest_posgamma is None:
+            raise IndexError('Cache1D object has no positive gammas')
 
-        # Weights for integration
+        # Weights for integration over the negative and positive gammas at once,
         # don't convert sign in neg gamma
-        weights_neg = sel_dist(self.gammas[:Nneg], params)
-        weights_pos = sel_dist(self.gammas[Nneg:], params)
-
-        # trapz for negative values
-        weighted_spectra_neg = 0*spectra_neg
-        for ii, w in enumerate(weights_neg):
-            weighted_spectra_neg[ii] = w*spectra_neg[ii]
-
-        fs_neg = np.trapz(weighted_spectra_neg, self.gammas[:Nneg], axis=0)
-
-        # trapz for positive values
-        weighted_spectra_pos = 0*spectra_pos
-        for ii, w in enumerate(weights_pos):
-            weighted_spectra_pos[ii] = w*spectra_pos[ii]
-
-        fs_pos = np.trapz(weighted_spectra_pos, self.gammas[Nneg:], axis=0)
+        weights = sel_dist(self.gammas, params)*self.signed_weights
+        if not exterior_int:
+            return theta*self._to_model(self._dot_spectra(weights))
 
-        # combine fs (in computed regions)
-        fs = fs_neg + fs_pos
+        # the effectively lethal portion shares the spectrum of the largest
+        # negative gamma, so it is part of the same reduction
+        weight_neu, weight_del = self._exterior_weights_pos(params, sel_dist)
+        weights[0] += weight_del
 
-        if not exterior_int:
-            return Spectrum(theta*fs)
+        fs = self._dot_spectra(weights)
+        fs += self._neu_data()*weight_neu
 
-        smallest_gamma = self.neg_gammas[-1]
-        largest_gamma = self.neg_gammas[0]
-        smallest_posgamma = min(pos_gammas)
-
-        # Compute weight for the effectively neutral portion. Not using
-        # CDF function because want this to be able to compute weight
-        # for arbitrary mass functions
-        # Integrate over negative effectively neutral to positive effectively neutral
-        weight_neu, err_neu = scipy.integrate.quad(sel_dist, smallest_gamma, smallest_posgamma,
-                                                args=params, points=[0.])
-        # compute weight for the effectively lethal portion
-        weight_del, err_del = scipy.integrate.quad(sel_dist, -np.inf, largest_gamma,
-                                                args=params)
-
-        fs += self.neu_spec*weight_neu
-        fs += spectra_neg[0]*weight_del
-
-        return Spectrum(theta*fs)
+        return theta*self._to_model(fs)
 
 
@@ -3,21 +3,443 @@ Additional Cache1D module utility scripts to include positive gammas systematica
 Keeping separate for clarity purposes.
 """
 
+import json
+import os
+import shutil
 import numpy as np
+import scipy.integrate
+from scipy.special import gammaln
+from scipy.stats import hypergeom
 
-def positive_gammas(pos_gamma_bounds, pos_gamma_pts):
+# quadrature rules over the gamma grid of Cache1D
+QUADRATURES = ('trapz', 'simpson', 'gauss')
+
+def positive_gammas(pos_gamma_bounds, pos_gamma_pts, quadrature='trapz', gauss_order=5):
     """
-    Define values to input to `additional_gammas` for Cache1D
+    Define values to input to `additional_gammas` for Cache1D.
+    quadrature, gauss_order: Same as for Cache1D, see `gamma_grid`
     """
      #Create a vector of positive gammas that are log-spaced over an interval
-    pos_gammas = np.logspace(np.log10(pos_gamma_bounds[0]),
-                             np.log10(pos_gamma_bounds[1]),
-                             pos_gamma_pts)
+    pos_gammas = gamma_grid(pos_gamma_bounds, pos_gamma_pts, quadrature, gauss_order)
     return pos_gammas
 
+def gamma_grid(gamma_bounds, gamma_pts, quadrature='trapz', gauss_order=5, descending=False):
+    """
+    Grid of gamma_pts absolute gammas over gamma_bounds for a quadrature rule,
+    in increasing order (decreasing if descending).
+
+    trapz, simpson: log-spaced gammas, including both bounds
+    gauss: the log(gamma) range is split into ceil(gamma_pts/gauss_order)
+           equal panels, each with the gauss_order Gauss-Legendre nodes. Both
+           bounds are included too, with zero weight, as the spectra at the
+           edges of the grid are needed outside the sampled domain.
+    """
+    lo, hi = np.log10(gamma_bounds[0]), np.log10(gamma_bounds[1])
+    if quadrature in ('trapz', 'simpson'):
+        if descending:
+            return np.logspace(hi, lo, gamma_pts)
+        return np.logspace(lo, hi, gamma_pts)
+    if quadrature != 'gauss':
+        raise ValueError('Unknown quadrature {0}, use one of {1}'.format(quadrature, QUADRATURES))
+    npanels = max(1, int(np.ceil(gamma_pts/gauss_order)))
+    edges = np.linspace(lo, hi, npanels+1)
+    nodes = np.polynomial.legendre.leggauss(gauss_order)[0]
+    mids, halfs = (edges[1:] + edges[:-1])/2, (edges[1:] - edges[:-1])/2
+    grid = 10**np.concatenate(([lo], (mids[:,np.newaxis] + halfs[:,np.newaxis]*nodes).ravel(), [hi]))
+    return grid[::-1] if descending else grid
+
+def merge_gammas(gammas, new_gammas, rtol=1e-10):
+    """
+    Sorted union of two gamma grids. Values of *new_gammas* within rtol of a
+    value in *gammas* are treated as already present, so that recomputed
+    log-spaced grids match the cached values.
+    """
+    gammas = np.asarray(gammas, dtype=float)
+    new_gammas = np.asarray(new_gammas, dtype=float)
+    present = np.array([np.any(np.isclose(gammas, gamma, rtol=rtol, atol=0))
+                        for gamma in new_gammas], dtype=bool)
+    return np.sort(np.concatenate((gammas, np.unique(new_gammas[~present]))))
+
+def interp_errors(gammas, spectra):
+    """
+    Local error indicator of a grid of gammas (all of one sign, sorted) with
+    their spectra (one 1D spectrum per row), one value per interval between
+    neighbouring gammas.
+
+    Each inner spectrum is compared to the interpolation of its two neighbours,
+    linear in log(spectrum) over log(|gamma|), which is exact where the spectra
+    follow a power law of gamma (e.g. the 1/gamma decay under strong
+    selection). The relative error is the summed absolute difference over the
+    bins other than the corners, relative to the summed spectrum, so bins with
+    tiny entries weigh little. An interval gets the larger error of its two ends.
+    """
+    gammas, spectra = np.asarray(gammas, dtype=float), np.asarray(spectra, dtype=float)
+    errors = np.zeros(len(gammas))
+    if len(gammas) < 3:
+        return errors[:-1]
+    uu = np.log(np.abs(gammas))
+    inner = spectra[:,1:-1]
+    log_inner = np.log(np.maximum(inner, np.finfo(float).tiny))
+    tt = ((uu[1:-1] - uu[:-2])/(uu[2:] - uu[:-2]))[:,np.newaxis]
+    predicted = np.exp((1 - tt)*log_inner[:-2] + tt*log_inner[2:])
+    scale = np.maximum(np.abs(inner[1:-1]), predicted).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors[1:-1] = np.where(scale > 0, np.abs(inner[1:-1] - predicted).sum(axis=1)/scale, 0)
+    return np.maximum(errors[:-1], errors[1:])
+
+def lowrank_factors(spectra, tol):
+    """
+    Low-rank factorization U, V of a 2D array of spectra (one per row), with
+    the smallest rank such that every entry of np.dot(U, V) is within tol of
+    the spectra, relative to the largest entry of its bin (column).
+
+    The columns are scaled by their largest entry before the truncated SVD, so
+    the bins with small entries (e.g. high frequencies under strong selection)
+    are as accurate as the others. The error of an integrated spectrum is then
+    at most tol relative to the largest entry of each bin, which bounds its
+    relative error except in the bins a DFE leaves almost empty (e.g. high
+    frequencies when all mass is strongly deleterious). Returns (U, V, max_rel_error).
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    scale = np.abs(spectra).max(axis=0)
+    scale[scale == 0] = 1
+    scaled = spectra/scale
+    left, sing, right = np.linalg.svd(scaled, full_matrices=False)
+    # remove one singular triplet at a time until the residual is within tol
+    residual = scaled.copy()
+    max_rel_error = np.abs(residual).max()
+    rank = 0
+    while rank < len(sing) and max_rel_error > tol:
+        residual -= np.outer(left[:,rank]*sing[rank], right[rank])
+        max_rel_error = np.abs(residual).max()
+        rank += 1
+    return left[:,:rank]*sing[:rank], right[:rank]*scale, float(max_rel_error)
+
+def trapz_weights(xx):
+    """
+    Trapezoid rule weights for the sample points *xx*, such that
+    `np.dot(trapz_weights(xx), yy)` equals `np.trapz(yy, xx, axis=0)`.
+    """
+    xx = np.asarray(xx, dtype=float)
+    weights = np.zeros(len(xx))
+    if len(xx) < 2:
+        return weights
+    dx = np.diff(xx)
+    weights[:-1] += dx/2.
+    weights[1:] += dx/2.
+    return weights
+
+def quad_weights(xx, quadrature='trapz', gauss_order=5):
+    """
+    Quadrature weights for the gammas *xx*, all of one sign, such that
+    `np.dot(weights, yy)` integrates yy over gamma, from the smallest to the
+    largest absolute gamma.
+
+    trapz: trapezoid rule in gamma, same as `trapz_weights`
+    simpson: Simpson's rule in log(|gamma|), any spacing
+    gauss: Gauss-Legendre rule in log(|gamma|). xx must be the panels of
+           gauss_order nodes and the two bounds of `gamma_grid`.
+    """
+    xx = np.asarray(xx, dtype=float)
+    if quadrature == 'trapz' or len(xx) == 0:
+        return trapz_weights(xx)
+    absxx = np.abs(xx)
+
+    # integrate over log(|gamma|), d(gamma) = |gamma| d(log(|gamma|))
+    order = np.argsort(absxx)
+    uu = np.log(absxx[order])
+    weights = np.zeros(len(xx))
+    if quadrature == 'simpson':
+        weights[order] = scipy.integrate.simpson(np.eye(len(uu)), x=uu)*absxx[order]
+        return weights
+    if quadrature != 'gauss':
+        raise ValueError('Unknown quadrature {0}, use one of {1}'.format(quadrature, QUADRATURES))
+    nodes, gl_weights = np.polynomial.legendre.leggauss(gauss_order)
+    if (len(uu) - 2) % gauss_order != 0 or len(uu) < 2:
+        raise ValueError('{0} gammas are not panels of {1} Gauss-Legendre nodes and the bounds'.format(
+            len(uu), gauss_order))
+    # recover each panel from its nodes, the bounds keep zero weight
+    panels = uu[1:-1].reshape(-1, gauss_order)
+    halfs = (panels[:,-1] - panels[:,0])/(nodes[-1] - nodes[0])
+    mids = panels[:,0] - halfs*nodes[0]
+    edges = np.concatenate((mids - halfs, mids[-1:] + halfs[-1:]))
+    if not (np.allclose(mids[:,np.newaxis] + halfs[:,np.newaxis]*nodes, panels, rtol=0, atol=1e-8) and
+            np.allclose(edges[1:-1], (mids + halfs)[:-1], rtol=0, atol=1e-8) and
+            np.allclose(edges[[0, -1]], uu[[0, -1]], rtol=0, atol=1e-8)):
+        raise ValueError('The gammas are not panels of {0} Gauss-Legendre nodes and the bounds'.format(gauss_order))
+    weights[order[1:-1]] = (halfs[:,np.newaxis]*gl_weights).ravel()*absxx[order[1:-1]]
+    return weights
+
+def fold_matrix(n):
+    """
+    Matrix that folds 1D spectra of sample size *n*, such that
+    `np.dot(fs, fold_matrix(n))` equals the data of `dadi.Spectrum.fold()`.
+    """
+    jj = np.arange(n+1)
+    folder = np.zeros((n+1, n+1))
+    folder[jj, np.minimum(jj, n-jj)] = 1
+    return folder
+
+def fold_data(data, n):
+    """
+    Folded 1D spectra of sample size *n* (bins on the last axis), keeping only
+    the n//2+1 bins of the minor allele frequencies. Same as the first n//2+1
+    columns of `np.dot(data, fold_matrix(n))`.
+    """
+    data = np.asarray(data, dtype=float)
+    folded = data[...,:n//2+1].copy()
+    folded[...,:(n+1)//2] += data[...,n:n//2:-1]
+    return folded
+
+def dot_float64(weights, rows, chunk_size=1024):
+    """
+    np.dot(weights, rows) accumulated in float64, also for rows stored in
+    float32. Those are converted chunk_size rows at a time, so no float64
+    copy of all rows is made.
+    """
+    if rows.dtype == np.float64:
+        return np.dot(weights, rows)
+    weights = np.asarray(weights, dtype=float)
+    result = np.zeros(weights.shape[:-1] + rows.shape[1:])
+    for jj in range(0, rows.shape[0], chunk_size):
+        result += np.dot(weights[...,jj:jj+chunk_size], np.asarray(rows[jj:jj+chunk_size], dtype=float))
+    return result
+
+def projection_matrix(n_from, n_to):
+    """
+    Matrix that projects 1D spectra from sample size *n_from* down to *n_to*,
+    such that `np.dot(fs, projection_matrix(n_from, n_to))` equals the data of
+    `dadi.Spectrum.project([n_to])`.
+    """
+    hits = np.arange(n_from+1)[:,np.newaxis]
+    hits_to = np.arange(n_to+1)[np.newaxis,:]
+    # hypergeometric sampling of n_to out of n_from chromosomes
+    return hypergeom.pmf(hits_to, n_from, hits, n_to)
+
+def pdf_matrix(sel_dist, xx, params_matrix):
+    """
+    sel_dist(xx, params) for each row of *params_matrix*, as a 2D array with
+    one row per parameter set.
+
+    The PDFs of dadi and PDFs2 are numpy-vectorized, so the parameters are
+    broadcast against xx in a single call, as arrays of shape (N, 1). A
+    sel_dist that does not broadcast is called row by row instead.
+    """
+    xx = np.asarray(xx, dtype=float)
+    params_matrix = np.atleast_2d(np.asarray(params_matrix, dtype=float))
+    shape = (params_matrix.shape[0], len(xx))
+    try:
+        with np.errstate(all='ignore'):
+            pdf = np.asarray(sel_dist(xx, params_matrix.T[:,:,np.newaxis]), dtype=float)
+        if pdf.size == np.prod(shape):
+            return pdf.reshape(shape)
+    except (ValueError, TypeError, IndexError):
+        pass
+    return np.array([sel_dist(xx, params) for params in params_matrix], dtype=float).reshape(shape)
+
+class PoissonLL:
+    """
+    Poisson log-likelihood of 1D model spectra given fixed data, the same as
+    `dadi.Inference.ll` on the model as a Cache1D Spectrum (corners masked).
+
+    The folding and masking are worked out once for the data, so each call only
+    takes plain arrays of model spectra: no Spectrum or masked array is built.
+
+    data: 1D dadi Spectrum, folded or unfolded
+    """
+    def __init__(self, data):
+        n = data.sample_sizes[0]
+        # model spectra from Cache1D always have their corners masked
+        mask = np.ma.getmaskarray(data).copy()
+        mask[[0, n]] = True
+        bins = np.arange(n+1)
+        if data.folded:
+            # folding adds bin n-j to bin j < n/2, the middle bin stays as is
+            mask |= (bins > n//2)
+        self.n = n
+        self.folded = data.folded
+        self.bins = bins[~mask]
+        self.partners = n - self.bins
+        self.paired = self.bins < self.partners
+        self.data = np.ascontiguousarray(data.data[self.bins], dtype=float)
+        self.gammaln_data = gammaln(self.data + 1.)
+
+    def fold(self, models):
+        """
+        Entries of *models* (unfolded, model bins on the last axis) in the bins
+        entering the log-likelihood, folded if the data are.
+        """
+        models = np.asarray(np.ma.getdata(models), dtype=float)
+        folded = models[...,self.bins]
+        if self.folded:
+            folded = folded + np.where(self.paired, models[...,self.partners], 0)
+        return folded
+
+    def __call__(self, models):
+        """
+        Log-likelihood of the data given *models*: a float for one model
+        spectrum, an array for a 2D array with one model spectrum per row.
+        """
+        models = np.asarray(np.ma.getdata(models), dtype=float)
+        mm = self.fold(models)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_mm = np.log(mm)
+            ll_per_bin = -mm + self.data*log_mm - self.gammaln_data
+        # np.ma.log masks the bins where the log is not finite, skip them the same way.
+        # Summed over all n+1 bins, zeros elsewhere, for the same rounding as dadi.
+        ll = np.zeros(models.shape[:-1] + (self.n+1,))
+        ll[...,self.bins] = np.where(np.isfinite(log_mm), ll_per_bin, 0)
+        ll = ll.sum(axis=-1)
+        return ll if ll.ndim else float(ll)
+
+    def ll_grad(self, model, jac):
+        """
+        Log-likelihood of the data given one model spectrum and its gradient,
+        for jac the Jacobian of the model, one row per parameter.
+        """
+        mm, jac = self.fold(model), self.fold(np.atleast_2d(jac))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = np.isfinite(np.log(mm))
+        dd, mm = self.data[valid], mm[valid]
+        ll = np.sum(-mm + dd*np.log(mm) - self.gammaln_data[valid])
+        return ll, np.dot(jac[:,valid], dd/mm - 1)
+
+def batch_ll(models, data):
+    """
+    Poisson log-likelihood of the data given each row of *models*.
+    Same as calling `dadi.Inference.ll` on each row as a Spectrum.
+
+    models: 2D array of unfolded 1D model spectra, one spectrum per row
+    data: 1D dadi Spectrum, folded or unfolded, or its PoissonLL
+    """
+    if not isinstance(data, PoissonLL):
+        data = PoissonLL(data)
+    return data(np.atleast_2d(models))
+
+def ll_grad(model, jac, data):
+    """
+    Poisson log-likelihood of the data given one model spectrum, same as
+    `dadi.Inference.ll`, and its gradient.
+
+    model: unfolded 1D model spectrum
+    jac: Jacobian of the model, one row per parameter
+    data: 1D dadi Spectrum, folded or unfolded, or its PoissonLL
+    """
+    if not isinstance(data, PoissonLL):
+        data = PoissonLL(data)
+    return data.ll_grad(model, jac)
+
+def quadrature_error(ref_spectra, dense_spectra, sel_dist, params_list, theta, data=None,
+                     method='integrate'):
+    """
+    Integration error of the gamma grid of *ref_spectra* against *dense_spectra*,
+    a Cache1D with the same settings but a dense gamma grid, for each parameter
+    set of sel_dist in params_list.
+
+    method: 'integrate' or 'integrate_continuous_pos'
+    data: If given, also compare the Poisson log-likelihoods of the data
+
+    Returns a dict of arrays, one entry per parameter set:
+    max_rel_error: largest relative error over the bins of the integrated spectra
+    ll, ll_dense, ll_error: log-likelihoods of the data given each model, and ll - ll_dense
+    """
+    models, dense_models = [], []
+    for params in params_list:
+        models.append(getattr(ref_spectra, method+'_array')(params, None, sel_dist, theta))
+        dense_models.append(getattr(dense_spectra, method+'_array')(params, None, sel_dist, theta))
+    models, dense_models = np.array(models), np.array(dense_models)
+    # the corners are not part of the spectra
+    rel_error = np.abs(models[:,1:-1]/dense_models[:,1:-1] - 1)
+    error = {'max_rel_error': np.max(rel_error, axis=1)}
+    if data is not None:
+        poisson_ll = PoissonLL(data)
+        error['ll'], error['ll_dense'] = poisson_ll(models), poisson_ll(dense_models)
+        error['ll_error'] = error['ll'] - error['ll_dense']
+    return error
+
+def central_diff(func, params, rel_step=1e-6):
+    """
+    Central finite differences of the array returned by func(params), one row per param.
+    """
+    params = np.asarray(params, dtype=float)
+    rows = []
+    for ii in range(len(params)):
+        step = rel_step*max(abs(params[ii]), 1e-3)
+        up, down = params.copy(), params.copy()
+        up[ii] += step
+        down[ii] -= step
+        rows.append((np.asarray(func(up)) - np.asarray(func(down)))/(2*step))
+    return np.array(rows)
+
+def init_checkpoint(checkpoint, settings):
+    """
+    Create the checkpoint directory for Cache1D generation, or check that an
+    existing one was made with the same settings.
+    checkpoint: directory holding one `.npy` spectrum per finished gamma
+    settings: dict of json-serializable inputs the spectra depend on
+    """
+    infofile = os.path.join(checkpoint, 'checkpoint.json')
+    if os.path.isfile(infofile):
+        with open(infofile, 'r') as inf:
+            saved = json.load(inf)
+        if saved != settings:
+            raise IOError('Checkpoint {0} was made with different settings: {1}'.format(checkpoint, saved))
+    else:
+        os.makedirs(checkpoint, exist_ok=True)
+        with open(infofile, 'w') as outf:
+            json.dump(settings, outf)
+    return None
+
+def checkpoint_file(checkpoint, gamma):
+    """
+    File for the spectrum of *gamma* in the checkpoint directory. Named after the
+    exact float value so that any grid containing gamma can reuse it.
+    """
+    return os.path.join(checkpoint, '{0}.npy'.format(float(gamma).hex()))
+
+def save_checkpoint(checkpoint, gamma, sfs):
+    """
+    Persist one finished spectrum. Written to a temporary file first, so that a
+    killed job never leaves a truncated spectrum behind.
+    """
+    outfile = checkpoint_file(checkpoint, gamma)
+    tmpfile = '{0}.{1}.tmp'.format(outfile, os.getpid())
+    with open(tmpfile, 'wb') as outf:
+        np.save(outf, np.asarray(sfs))
+    os.replace(tmpfile, outfile)
+    return None
+
+def load_checkpoint(checkpoint, gamma):
+    """
+    Spectrum data of *gamma* from the checkpoint directory, or None if missing.
+    """
+    infile = checkpoint_file(checkpoint, gamma)
+    if not os.path.isfile(infile):
+        return None
+    return np.load(infile)
+
+def remove_checkpoint(checkpoint):
+    """
+    Remove a checkpoint directory once its spectra are saved. Directories
+    without the `checkpoint.json` of `init_checkpoint` are left alone.
+    Returns True if the directory was removed.
+    """
+    if not os.path.isfile(os.path.join(checkpoint, 'checkpoint.json')):
+        return False
+    shutil.rmtree(checkpoint)
+    return True
+
 def dict_spectra(spectra_cache):
-    dictspectra=dict(zip(spectra_cache.gammas, spectra_cache.spectra))
-    dictspectra[0]=spectra_cache.neu_spec
+    spectra = np.asarray(spectra_cache.spectra, dtype=float)
+    neu_spec = spectra_cache.neu_spec
+    if spectra_cache.folded:
+        # folded spectra have zeros above ns//2, the neutral spectrum too
+        unfolded = np.zeros((len(spectra)+1, spectra_cache.ns[0]+1))
+        unfolded[:-1,:spectra.shape[1]] = spectra
+        unfolded[-1,:spectra.shape[1]] = neu_spec.data[:spectra.shape[1]]
+        spectra, neu_spec = unfolded[:-1], unfolded[-1]
+    dictspectra=dict(zip(spectra_cache.gammas, spectra))
+    dictspectra[0]=neu_spec
     return dictspectra
 
 
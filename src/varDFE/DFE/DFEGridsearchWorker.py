@@ -1,17 +1,193 @@
 """
-multiprocessing DFE grid search worker script
+multiprocessing DFE grid search worker script,
+and the coarse-to-fine adaptive grid search driving it
 """
-import dadi
+import itertools
+import time
 import numpy as np
+from varDFE.DFE.Cache1D_util import PoissonLL
 
-def DFEGridsearchWorker(inputlist):
-    ref_spectra, popt, pdf, theta_nonsyn, fs = inputlist
-    model=ref_spectra.integrate(
-                params=popt,
-                ns=None,
+# inputs shared by every task of a worker process, set once by init_worker
+gridsearch_inputs = None
+
+def init_worker(ref_spectra, pdf, theta_nonsyn, fs, integrate_methods='integrate', axes=None):
+    """
+    Pool initializer. Hand the reference spectra and the other fixed inputs to
+    each worker process once, so the tasks only carry their grid points.
+    integrate_methods: integrate method of the PDF in PDFValidation, its
+                       `*_batch` method evaluates the grid points
+    axes: grid_axes of the grid evaluated by DFEGridsearchRange
+    """
+    global gridsearch_inputs
+    # fold and mask the data once for all the tasks
+    integrate_batch = getattr(ref_spectra, integrate_methods+'_batch')
+    gridsearch_inputs = (integrate_batch, pdf, theta_nonsyn, PoissonLL(fs), axes)
+
+def DFEGridsearchWorker(popts):
+    integrate_batch, pdf, theta_nonsyn, poisson_ll, axes = gridsearch_inputs
+    # evaluate one chunk of grid points in a single batched integration
+    ll_model = integrate_batch(
+                params_matrix=popts,
                 sel_dist=pdf,
                 theta=theta_nonsyn,
-                pts=None)
-    ll_model = dadi.Inference.ll(model, fs)
-    output = np.append(popt, ll_model)
+                data=poisson_ll)
+    output = np.column_stack((popts, ll_model))
     return output
+
+def DFEGridsearchRange(index_range):
+    """
+    Evaluate the grid points start to stop (index_range) of the grid of the
+    axes given to init_worker, in the order of `grid_points`.
+    Returns (start, output), output as for DFEGridsearchWorker.
+    """
+    start, stop = index_range
+    axes = gridsearch_inputs[-1]
+    return start, DFEGridsearchWorker(grid_points(axes, start, stop))
+
+def grid_axes(lower, upper, Npts, log_axes):
+    """
+    Values of each parameter of a grid, Npts[ii] values from lower[ii] to
+    upper[ii], log-spaced if log_axes[ii], otherwise linear. A parameter with
+    Npts 1 is fixed at lower.
+    """
+    axes = []
+    for lo, up, npts, log in zip(lower, upper, Npts, log_axes):
+        if npts == 1:
+            axes.append(np.array([lo], dtype=float))
+        elif log:
+            axes.append(np.geomspace(lo, up, npts))
+        else:
+            axes.append(np.linspace(lo, up, npts))
+    return axes
+
+def grid_points(axes, start, stop):
+    """
+    Grid points start to stop of the grid of axes, one row per point, the
+    last parameter varying fastest.
+    """
+    indices = np.unravel_index(np.arange(start, stop), [len(axis) for axis in axes])
+    return np.column_stack([axis[ii] for axis, ii in zip(axes, indices)])
+
+def stream_gridsearch(pool, axes, outnpy, chunk_size=1000, flush_secs=60, log_func=None):
+    """
+    Evaluate the grid of axes with pool (set up with init_worker for these
+    axes), streaming the results into a memory-mapped .npy as they arrive.
+
+    The grid points are generated chunk by chunk and evaluated with
+    imap_unordered, so memory stays flat whatever the grid size. The rows are
+    in the order of `grid_points`, rows not evaluated yet are nan, and the
+    file is flushed every flush_secs seconds, so an interrupted search keeps
+    its partial results. log_func, if given, is called with progress messages.
+
+    Returns (ll_grid, best), the memory-mapped ll_grid and the row with the
+    maximum ll_model, tracked while the results arrive.
+    """
+    Ngrid = int(np.prod([len(axis) for axis in axes]))
+    ll_grid = np.lib.format.open_memmap(outnpy, mode='w+', dtype=float, shape=(Ngrid, len(axes)+1))
+    for start in range(0, Ngrid, chunk_size):
+        ll_grid[start:start+chunk_size] = np.nan
+    ll_grid.flush()
+
+    index_ranges = ((start, min(start+chunk_size, Ngrid)) for start in range(0, Ngrid, chunk_size))
+    best, best_index = None, None
+    done, last_flush, last_log = 0, time.time(), 0
+    for start, output in pool.imap_unordered(DFEGridsearchRange, index_ranges):
+        ll_grid[start:start+len(output)] = output
+        # running argmax over the rows received, the first row of ties as np.argmax
+        if not np.all(np.isnan(output[:,-1])):
+            ii = np.nanargmax(output[:,-1])
+            if best is None or output[ii,-1] > best[-1] or (output[ii,-1] == best[-1] and start + ii < best_index):
+                best, best_index = output[ii], start + ii
+        done += len(output)
+        if time.time() - last_flush > flush_secs:
+            ll_grid.flush()
+            last_flush = time.time()
+        if log_func is not None and done*10//Ngrid > last_log:
+            last_log = done*10//Ngrid
+            log_func('Evaluated {0} of {1} grid points, maximum LL so far {2}'.format(done, Ngrid, None if best is None else best[-1]))
+    ll_grid.flush()
+    if best is None:
+        best = np.full(len(axes)+1, np.nan)
+    return ll_grid, best
+
+def adaptive_gridsearch(map_func, lower, upper, Npts, levels=3, lldrop=10., fine=5, nchunks=1, log_axes=None):
+    """
+    Coarse-to-fine grid search of the likelihood surface.
+
+    Evaluate a uniform grid of Npts points per parameter between lower and
+    upper, then zoom levels times: every cell whose point is within lldrop of
+    the current maximum LL is split into 3 cells per parameter. A last, fine
+    local grid splits the cells around the maximum into fine cells per
+    parameter. The points lie on the lattice of the finest level, and no point
+    is evaluated twice. Parameters in log_axes are searched in log space, and
+    parameters with Npts 1 are fixed at lower.
+
+    map_func: map function running DFEGridsearchWorker over a list of chunks
+              of grid points, e.g. `multiprocessing.Pool.map`
+    lower, upper: bounds of each parameter
+    Npts: number of points of the coarse grid, per parameter or for all
+    levels: number of zooms
+    lldrop: LL drop from the maximum of the cells to zoom into
+    fine: odd number of points per cell and parameter of the final local grid
+    nchunks: number of chunks of grid points per map_func call
+    log_axes: if given, whether to search each parameter in log space
+
+    Returns the ll_grid array, one row per grid point with the parameters, the
+    ll_model and the level (0 for the coarse grid) it was evaluated at.
+    """
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    ndim = len(lower)
+    Npts = np.broadcast_to(Npts, ndim)
+    log_axes = np.zeros(ndim, dtype=bool) if log_axes is None else np.asarray(log_axes, dtype=bool)
+    # fixed parameters are kept exactly
+    log_axes = log_axes & (Npts > 1)
+    lower = np.where(log_axes, np.log(lower), lower)
+    upper = np.where(log_axes, np.log(upper), upper)
+    # grid points as integer indices on the lattice of the current level
+    step = (upper - lower)/np.maximum(Npts - 1, 1)
+    nmax = Npts - 1
+    evaluated = {}
+
+    def evaluate(indices, level):
+        # keep the first of duplicated indices, skip those evaluated before
+        todo = [ii for ii in dict.fromkeys(indices) if ii not in evaluated]
+        if len(todo) == 0:
+            return
+        popts = to_params(np.array(todo))
+        chunks = np.array_split(popts, min(nchunks, len(popts)))
+        ll_model = np.concatenate([output[:,-1] for output in map_func(DFEGridsearchWorker, chunks)])
+        for ii, ll in zip(todo, ll_model):
+            evaluated[ii] = (ll, level)
+
+    def zoom(factor):
+        nonlocal step, nmax, evaluated
+        step = step/factor
+        nmax = nmax*factor
+        evaluated = {tuple(factor*kk for kk in ii): value for ii, value in evaluated.items()}
+
+    def around(centers, half):
+        # lattice points within half steps of the centers, inside the bounds
+        offsets = list(itertools.product(range(-half, half+1), repeat=ndim))
+        return [tuple(cc + oo for cc, oo in zip(center, offset))
+                for center in centers for offset in offsets
+                if all(0 <= cc + oo <= nn for cc, oo, nn in zip(center, offset, nmax))]
+
+    def to_params(indices):
+        popts = lower + indices*step
+        return np.where(log_axes, np.exp(popts), popts)
+
+    evaluate(list(itertools.product(*[range(npts) for npts in Npts])), 0)
+    for level in range(1, levels+1):
+        ll_max = np.nanmax([ll for ll, _ in evaluated.values()])
+        centers = [ii for ii, (ll, _) in evaluated.items() if ll >= ll_max - lldrop]
+        zoom(3)
+        evaluate(around([tuple(3*kk for kk in ii) for ii in centers], 1), level)
+
+    # the fine local grid over the cells around the maximum
+    best = max(evaluated, key=lambda ii: np.nan_to_num(evaluated[ii][0], nan=-np.inf))
+    zoom(fine)
+    evaluate(around([tuple(fine*kk for kk in best)], (3*fine)//2), levels+1)
+
+    indices = np.array(list(evaluated.keys()), dtype=float).reshape(-1, ndim)
+    values = np.array(list(evaluated.values()), dtype=float).reshape(-1, 2)
+    return np.column_stack((to_params(indices), values))
@@ -4,10 +4,21 @@ multiprocessing DFE inference worker script
 
 import dadi
 from varDFE.Misc import LoggerDFE, Plotting, Util
-from varDFE.DFE import OutputDFE
+from varDFE.DFE import OutputDFE, Inference2
+
+# reference spectra shared by every task of a worker process, set once by init_worker
+ref_spectra = None
+
+def init_worker(spectra):
+    """
+    Pool initializer. Hand the reference spectra to each worker process once,
+    instead of pickling them into every task.
+    """
+    global ref_spectra
+    ref_spectra = spectra
 
 def DFEInferenceWorker(inputlist):
-    runNum, initval, lowerbound, upperbound, pdfname, optimizer, fs, ref_spectra, pdf, args, maxiter, ns, pdfvars, integrate_methods, optimizer_name = inputlist
+    runNum, initval, lowerbound, upperbound, pdfname, optimizer, fs, pdf, args, maxiter, ns, pdfvars, integrate_methods, optimizer_name = inputlist
     runNumstr=str(runNum).zfill(2) # use this as output file name
     p0_sel = Util.perturb_params(
         params=initval,
@@ -17,11 +28,22 @@ def DFEInferenceWorker(inputlist):
     # multinom=False --> use poisson likelihoood ie. not recalculate theta
     # use optimize function for lognormal distribution. optimize_log for the rest
     # change integrate methods for lourenco distribution
+    # the memo of the reference spectra is shared by every run of this worker,
+    # snapshot it to log the hits and misses of this run only
+    memo0 = ref_spectra.integrate_memo_info()
+    # gradient-based optimizers take the integrate methods returning the Jacobian too,
+    # the other Inference2 optimizers take plain model arrays
+    if optimizer in (Inference2.optimize_lbfgsb_jac, Inference2.optimize_log_lbfgsb_jac):
+        model_func = getattr(ref_spectra, integrate_methods+'_jac')
+    elif optimizer in (Inference2.optimize, Inference2.optimize_log):
+        model_func = getattr(ref_spectra, integrate_methods+'_array')
+    else:
+        model_func = getattr(ref_spectra, integrate_methods)
     if pdfname == 'lourenco_eq':
         popt = optimizer(
             p0=p0_sel,
             data=fs,
-            model_func=ref_spectra.integrate_continuous_pos,
+            model_func=model_func,
             pts=None,
             func_args=[pdf, args['theta_nonsyn']],
             lower_bound=lowerbound,
@@ -42,7 +64,7 @@ def DFEInferenceWorker(inputlist):
         popt = optimizer(
             p0=p0_sel,
             data=fs,
-            model_func=ref_spectra.integrate_continuous_pos,
+            model_func=model_func,
             pts=None,
             func_args=[pdf, args['theta_nonsyn']],
             lower_bound=lowerbound,
@@ -62,7 +84,7 @@ def DFEInferenceWorker(inputlist):
         popt = optimizer(
             p0=p0_sel,
             data=fs,
-            model_func=ref_spectra.integrate,
+            model_func=model_func,
             pts=None,
             func_args=[pdf, args['theta_nonsyn']],
             lower_bound=lowerbound,
@@ -84,6 +106,9 @@ def DFEInferenceWorker(inputlist):
 
     # also get the LL of the data to itself (best possible ll)
     ll_data=dadi.Inference.ll(fs, fs)
+    memo = ref_spectra.integrate_memo_info()
+    LoggerDFE.logINFO('Rep{0}. Integrated spectra memo: {1} hits, {2} misses in this run, {3}/{4} spectra kept by this worker'.format(
+        runNumstr, memo['hits'] - memo0['hits'], memo['misses'] - memo0['misses'], memo['currsize'], memo['maxsize']))
 
     # (un)scale parameters by Na (from NeS to S) if needed
     unscaled_popt = OutputDFE.dfe_unscaling(Nanc=args['Nanc'],popt=popt, pdfname=pdfname)
@@ -101,8 +126,12 @@ def DFEInferenceWorker(inputlist):
 
     ##### Output SFS (same for anymodel)
     model.pop_ids = [fs.pop_ids[0]+'.'+pdfname+runNumstr]
-    model.to_file(outprefix + '_unfolded.expSFS')
-    model_fold = model.fold()
+    if model.folded:
+        # reference spectra stored folded give no unfolded model
+        model_fold = model
+    else:
+        model.to_file(outprefix + '_unfolded.expSFS')
+        model_fold = model.fold()
     model_fold.to_file(outprefix + '_folded.expSFS')
 
     LoggerDFE.logINFO('Rep{0}. Output *_unfolded.expSFS, *_folded.expSFS, *.png, *.txt to {1}'.format(runNumstr, outprefix))
@@ -1,7 +1,9 @@
 """
 Additional Input models of demography + selection.
 """
+import numpy as np
 from dadi import Numerics, Integration, PhiManip, Spectrum
+from varDFE.DFE.Integration2 import one_pop_gammas, from_phi_gammas
 
 def three_epoch(params, ns, pts):
     """Define a three-epoch demography with selection included.
@@ -64,3 +66,55 @@ def four_epoch(params, ns, pts):
     fs = Spectrum.from_phi(phi, ns, (xx,))
     return fs
 
+# Versions of the models above for a block of gammas at once. The last element
+# of params is a 1D array of gammas and a 2D array with one spectrum (data) per
+# gamma is returned, so these are extrapolated with an explicit extrap_x_l
+# (see `Cache1D`). Each row is the same as the single gamma model.
+
+def two_epoch_gammas(params, ns, pts):
+    """
+    `dadi.DFE.DemogSelModels.two_epoch` for a block of gammas.
+
+    params = (nua, Ta, gammas)
+    """
+    nua, Ta, gammas = params
+    gammas = np.atleast_1d(gammas)
+
+    xx = Numerics.default_grid(pts)
+    phi = np.array([PhiManip.phi_1D(xx, gamma=gamma) for gamma in gammas])
+    phi = one_pop_gammas(phi, xx, Ta, nua, gammas=gammas)
+
+    return from_phi_gammas(phi, ns, xx)
+
+def three_epoch_gammas(params, ns, pts):
+    """
+    `three_epoch` for a block of gammas.
+
+    params = (nua, nub, Ta, Tb, gammas)
+    """
+    nua, nub, Ta, Tb, gammas = params
+    gammas = np.atleast_1d(gammas)
+
+    xx = Numerics.default_grid(pts)
+    phi = np.tile(PhiManip.phi_1D(xx), (len(gammas), 1))
+    phi = one_pop_gammas(phi, xx, Ta, nua, gammas=gammas)
+    phi = one_pop_gammas(phi, xx, Tb, nub, gammas=gammas)
+
+    return from_phi_gammas(phi, ns, xx)
+
+def four_epoch_gammas(params, ns, pts):
+    """
+    `four_epoch` for a block of gammas.
+
+    params = (nua, nub, nuc, Ta, Tb, Tc, gammas)
+    """
+    nua, nub, nuc, Ta, Tb, Tc, gammas = params
+    gammas = np.atleast_1d(gammas)
+
+    xx = Numerics.default_grid(pts)
+    phi = np.tile(PhiManip.phi_1D(xx), (len(gammas), 1))
+    phi = one_pop_gammas(phi, xx, Ta, nua, gammas=gammas)
+    phi = one_pop_gammas(phi, xx, Tb, nub, gammas=gammas)
+    phi = one_pop_gammas(phi, xx, Tc, nuc, gammas=gammas)
+
+    return from_phi_gammas(phi, ns, xx)
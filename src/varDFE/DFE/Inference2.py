@@ -0,0 +1,276 @@
+"""
+Optimization of DFE parameters and their uncertainties, with the Poisson
+log-likelihood of `Cache1D_util.PoissonLL`: the data are folded and masked once,
+and the model spectra are plain arrays, e.g. from `Cache1D.integrate_array`.
+
+`optimize`, `optimize_log` and `FIM_uncert` give the same results as their
+dadi.Inference and dadi.Godambe counterparts with the Poisson likelihood
+(multinom=False). The gradient-based optimizers take a model_func returning
+(model, jac) like `Cache1D.integrate_jac`, so the log-likelihood and its exact
+gradient come from the cached spectra without finite differences.
+"""
+
+import os
+import sys
+import numpy as np
+import scipy.optimize
+from dadi import Inference, Godambe, Misc
+from varDFE.Misc import LoggerDFE
+from varDFE.DFE.Cache1D_util import PoissonLL
+
+def _check_data(model_func, data):
+    """
+    Raise ValueError if model_func is a method of a Cache1D whose model spectra
+    cannot be compared to data, see `Cache1D.check_data`.
+    """
+    check_data = getattr(getattr(model_func, '__self__', None), 'check_data', None)
+    if check_data is not None:
+        check_data(data, data.sample_sizes)
+    return None
+
+def _object_func(params, poisson_ll, model_func, pts, ns, lower_bound=None, upper_bound=None,
+                 verbose=0, flush_delay=0, func_args=[], func_kwargs={}, fixed_params=None,
+                 ll_scale=1, output_stream=sys.stdout):
+    """
+    Objective function for optimization, same as `dadi.Inference._object_func`
+    with multinom=False.
+    """
+    Inference._counter += 1
+    params_up = Inference._project_params_up(params, fixed_params)
+
+    # Check our parameter bounds
+    for bound, out_of_bounds in [(lower_bound, np.less), (upper_bound, np.greater)]:
+        if bound is not None:
+            for pval, bb in zip(params_up, bound):
+                if bb is not None and out_of_bounds(pval, bb):
+                    return -Inference._out_of_bounds_val/ll_scale
+
+    func_kwargs = func_kwargs.copy()
+    func_kwargs['pts'] = pts
+    result = poisson_ll(model_func(params_up, ns, *func_args, **func_kwargs))
+
+    # Bad result
+    if np.isnan(result):
+        result = Inference._out_of_bounds_val
+
+    if (verbose > 0) and (Inference._counter % verbose == 0):
+        param_str = 'array([%s])' % (', '.join(['%- 12g'%v for v in params_up]))
+        output_stream.write('%-8i, %-12g, %s%s' % (Inference._counter, result, param_str, os.linesep))
+        Misc.delayed_flush(delay=flush_delay)
+
+    return -result/ll_scale
+
+def _object_func_log(log_params, *args, **kwargs):
+    """
+    Objective function for optimization in log(params).
+    """
+    return _object_func(np.exp(log_params), *args, **kwargs)
+
+def optimize(p0, data, model_func, pts, lower_bound=None, upper_bound=None,
+             verbose=0, flush_delay=0.5, epsilon=1e-3, gtol=1e-5, multinom=False,
+             maxiter=None, full_output=False, func_args=[], func_kwargs={},
+             fixed_params=None, ll_scale=1, output_file=None, log=False):
+    """
+    Optimize params to fit model to data using the BFGS method, same as
+    `dadi.Inference.optimize` with the Poisson likelihood.
+
+    model_func may return a Spectrum or a plain array of the unfolded model
+    spectrum with its corners left out of the likelihood, e.g. `Cache1D.integrate_array`.
+    log: If True, optimize log(params) as `dadi.Inference.optimize_log`
+    The other arguments are the same as for dadi.Inference.optimize.
+    """
+    if multinom:
+        raise ValueError('optimize only supports the Poisson likelihood (multinom=False)')
+    _check_data(model_func, data)
+    if output_file:
+        output_stream = open(output_file, 'w')
+    else:
+        output_stream = sys.stdout
+
+    # fold and mask the data once for every evaluation
+    args = (PoissonLL(data), model_func, pts, data.sample_sizes, lower_bound, upper_bound,
+            verbose, flush_delay, func_args, func_kwargs, fixed_params, ll_scale, output_stream)
+
+    p0 = Inference._project_params_down(p0, fixed_params)
+    outputs = scipy.optimize.fmin_bfgs(_object_func_log if log else _object_func,
+                                       np.log(p0) if log else p0, epsilon=epsilon,
+                                       args=args, gtol=gtol, full_output=True,
+                                       disp=False, maxiter=maxiter)
+    xopt, fopt, gopt, Bopt, func_calls, grad_calls, warnflag = outputs
+    xopt = Inference._project_params_up(np.exp(xopt) if log else xopt, fixed_params)
+
+    if output_file:
+        output_stream.close()
+
+    if not full_output:
+        return xopt
+    else:
+        return xopt, fopt, gopt, Bopt, func_calls, grad_calls, warnflag
+
+def optimize_log(p0, data, model_func, pts, lower_bound=None, upper_bound=None,
+                 verbose=0, flush_delay=0.5, epsilon=1e-3, gtol=1e-5, multinom=False,
+                 maxiter=None, full_output=False, func_args=[], func_kwargs={},
+                 fixed_params=None, ll_scale=1, output_file=None):
+    """
+    Same as `optimize`, optimizing log(params).
+    """
+    return optimize(p0, data, model_func, pts, lower_bound, upper_bound, verbose,
+                    flush_delay, epsilon, gtol, multinom, maxiter, full_output,
+                    func_args, func_kwargs, fixed_params, ll_scale, output_file, log=True)
+
+def FIM_uncert(func_ex, grid_pts, p0, data, log=False, multinom=False, eps=0.01, return_FIM=False):
+    """
+    Parameter uncertainties from the Fisher Information Matrix, same as
+    `dadi.Godambe.FIM_uncert` with the Poisson likelihood (multinom=False).
+
+    func_ex may return a Spectrum or a plain array as the model_func of `optimize`.
+    The other arguments are the same as for dadi.Godambe.FIM_uncert.
+    """
+    if multinom:
+        raise ValueError('FIM_uncert only supports the Poisson likelihood (multinom=False)')
+    _check_data(func_ex, data)
+    poisson_ll = PoissonLL(data)
+    ns = data.sample_sizes
+    # evaluations shared by the hessian elements, as in dadi.Godambe.get_godambe
+    cache = {}
+    def func(params):
+        key = tuple(params)
+        if key not in cache:
+            cache[key] = poisson_ll(func_ex(params, ns, grid_pts))
+        return cache[key]
+    if not log:
+        H = -Godambe.get_hess(func, p0, eps)
+    else:
+        H = -Godambe.get_hess(lambda logparams: func(np.exp(logparams)), np.log(p0), eps)
+    uncerts = np.sqrt(np.diag(np.linalg.inv(H)))
+    if not return_FIM:
+        return uncerts
+    else:
+        return uncerts, H
+
+def _plain_model_func(model_func):
+    """
+    Function returning the model alone for a model_func returning (model, jac).
+    For a bound `Cache1D.<method>_jac` it is `Cache1D.<method>_array`, which
+    does not compute the Jacobian.
+    """
+    owner, name = getattr(model_func, '__self__', None), getattr(model_func, '__name__', '')
+    if owner is not None and name.endswith('_jac') and hasattr(owner, name[:-len('_jac')]+'_array'):
+        return getattr(owner, name[:-len('_jac')]+'_array')
+    return lambda *args, **kwargs: model_func(*args, **kwargs)[0]
+
+def optimize_lbfgsb_jac(p0, data, model_func, pts, lower_bound=None, upper_bound=None,
+                        verbose=0, multinom=False, maxiter=1000, func_args=[], func_kwargs={},
+                        fixed_params=None, log=False, fallback_func=None):
+    """
+    Optimize params to fit model to data with L-BFGS-B, using the gradient of the
+    Poisson log-likelihood.
+
+    p0: Initial parameters
+    data: Spectrum with data
+    model_func: Function returning (model, jac), e.g. `Cache1D.integrate_jac`,
+                called as model_func(params, ns, *func_args, pts=pts, **func_kwargs)
+    pts: Passed to model_func
+    lower_bound, upper_bound: Bounds on the parameters, None entries are unbounded
+    verbose: If > 0, print the log-likelihood every verbose evaluations
+    multinom: Only the Poisson likelihood (multinom=False) is supported
+    maxiter: Maximum number of L-BFGS-B iterations
+    func_args, func_kwargs: Additional arguments to model_func
+    fixed_params: Same as for dadi.Inference.optimize_log
+    log: If True, optimize log(params)
+    fallback_func: Function returning the model alone, for `optimize`. Default:
+                   the `_array` method matching a Cache1D model_func, e.g.
+                   `Cache1D.integrate_array` for `Cache1D.integrate_jac`.
+
+    The log-likelihood is scaled by its value at p0. If L-BFGS-B fails (abnormal
+    termination of its line search, or a non-finite log-likelihood), a warning
+    is logged and `optimize` (BFGS) is run from p0 with fallback_func instead.
+    Reaching maxiter only logs a warning and returns the last params.
+    Params where the model is NaN in any bin of the LL, or the LL or its
+    gradient is not finite, get dadi's penalty for params out of bounds.
+
+    Returns the best-fit params.
+    """
+    if multinom:
+        raise ValueError('optimize_lbfgsb_jac only supports the Poisson likelihood (multinom=False)')
+    _check_data(model_func, data)
+
+    p0_down = np.asarray(Inference._project_params_down(p0, fixed_params), dtype=float)
+    x0 = np.log(p0_down) if log else p0_down
+    # None bounds are unbounded, non-positive bounds are unbounded in log(params)
+    bounds = []
+    for bound, fill in [(lower_bound, -np.inf), (upper_bound, np.inf)]:
+        if bound is None:
+            bound = [None]*len(p0)
+        bound = np.array([fill if bb is None else bb for bb in Inference._project_params_down(bound, fixed_params)], dtype=float)
+        if log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bound = np.where(bound > 0, np.log(bound), -np.inf)
+        bounds.append(bound)
+    bounds = list(zip(*bounds))
+
+    # fold and mask the data once for every evaluation
+    poisson_ll = PoissonLL(data)
+    counter = [0]
+    def ll_grad(xx):
+        counter[0] += 1
+        params = np.exp(xx) if log else xx
+        params_up = Inference._project_params_up(params, fixed_params)
+        model, jac = model_func(params_up, data.sample_sizes, *func_args, pts=pts, **func_kwargs)
+        ll, grad = poisson_ll.ll_grad(model, jac)
+        # the LL skips bins where the model is NaN, as dadi does, which would
+        # make an all-NaN model look like a perfect fit
+        if not np.all(np.isfinite(poisson_ll.fold(model))):
+            ll = np.nan
+        grad = np.asarray(Inference._project_params_down(grad, fixed_params), dtype=float)
+        if log:
+            grad = grad*params
+        if (verbose > 0) and (counter[0] % verbose == 0):
+            param_str = 'array([%s])' % (', '.join(['%- 12g'%v for v in params_up]))
+            sys.stdout.write('%-8i, %-12g, %s\n' % (counter[0], ll, param_str))
+            sys.stdout.flush()
+        return ll, grad
+
+    ll0, grad0 = ll_grad(x0)
+    if not np.isfinite(ll0) or not np.all(np.isfinite(grad0)):
+        raise ValueError('optimize_lbfgsb_jac: the log-likelihood at p0 {0} is not finite'.format(p0))
+    # The raw LL and its gradient scale with the data (~1e4), which makes L-BFGS-B
+    # overshoot to the bounds. Optimize the LL relative to its value at p0 instead.
+    ll_scale = max(abs(ll0), 1.0)
+
+    def object_func(xx):
+        ll, grad = ll_grad(xx)
+        if not np.isfinite(ll) or not np.all(np.isfinite(grad)):
+            # same penalty as dadi for bad parameters (the negative of its LL), growing
+            # away from p0 so that its gradient points back towards p0 and L-BFGS-B
+            # does not take it as converged
+            return -Inference._out_of_bounds_val/ll_scale + 0.5*np.sum((xx - x0)**2), xx - x0
+        return -ll/ll_scale, -grad/ll_scale
+
+    result = scipy.optimize.minimize(object_func, x0, jac=True, method='L-BFGS-B',
+                                     bounds=bounds, options={'maxiter': maxiter})
+    message = str(result.message)
+    if 'ABNORMAL' in message.upper() or not np.isfinite(result.fun):
+        # fall back to BFGS with finite differences on the model arrays,
+        # without computing the Jacobian of every evaluation
+        LoggerDFE.logWARN('L-BFGS-B failed from p0 {0} ({1}), running {2} instead'.format(
+            p0, message, 'optimize_log' if log else 'optimize'))
+        if fallback_func is None:
+            fallback_func = _plain_model_func(model_func)
+        return optimize(p0, data, fallback_func, pts,
+                        lower_bound, upper_bound, verbose=verbose, maxiter=maxiter,
+                        func_args=func_args, func_kwargs=func_kwargs, fixed_params=fixed_params, log=log)
+    if not result.success:
+        LoggerDFE.logWARN('L-BFGS-B did not converge from p0 {0} ({1})'.format(p0, message))
+    xopt = np.exp(result.x) if log else result.x
+    return Inference._project_params_up(xopt, fixed_params)
+
+def optimize_log_lbfgsb_jac(p0, data, model_func, pts, lower_bound=None, upper_bound=None,
+                            verbose=0, multinom=False, maxiter=1000, func_args=[], func_kwargs={},
+                            fixed_params=None, fallback_func=None):
+    """
+    Same as `optimize_lbfgsb_jac`, optimizing log(params).
+    """
+    return optimize_lbfgsb_jac(p0, data, model_func, pts, lower_bound, upper_bound,
+                               verbose, multinom, maxiter, func_args, func_kwargs,
+                               fixed_params, log=True, fallback_func=fallback_func)
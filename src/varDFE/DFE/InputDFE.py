@@ -4,6 +4,7 @@ Input validations for workflow associated with exploring DFE inference.
 
 from varDFE.Misc import LoggerDFE, Util
 from varDFE.DFE.PDFValidation import PDFValidation
+from varDFE.DFE.Cache1D_util import QUADRATURES
 from varDFE.Demography.DemogValidation import DemogValidation
 import argparse
 import os
@@ -27,8 +28,36 @@ def parse_GridSearchArgs():
         help="Use `2NeS` or `S` distribution. default=False -- Use `2NeS`")
 
     parser.add_argument(
-        "--Npts",type=int,required=False,default=250,
-        help="Number of grid points per parameter you want. Keep in mind this can drastically affect run time (e.g. 10 --> 100 calculations). Default: 250.")
+        "--Npts",type=str,required=False,default='250',
+        help="Number of grid points per parameter you want, one value for all parameters or one per parameter separated by comma. Keep in mind this can drastically affect run time (e.g. 10 --> 100 calculations for two parameters). Default: 250.")
+
+    parser.add_argument(
+        "--log_params",type=str,required=False,default=None,
+        help="names of the parameters to space logarithmically instead of linearly, separate by comma (e.g. 'scale'). Their bounds must be positive. Default: all linear.")
+
+    parser.add_argument(
+        "--fixed_params",type=str,required=False,default=None,
+        help="parameters held fixed in the grid, as name=value separated by comma (e.g. 'Ne_dadi=5000'). Their values in --max_bound and --min_bound are ignored. Default: no fixed parameters.")
+
+    parser.add_argument(
+        "--chunk_size",type=int,required=False,default=1000,
+        help="number of grid points evaluated per task. The grid is streamed to the .npy output chunk by chunk, so grids of millions of points are never held in memory. Default: 1000")
+
+    parser.add_argument(
+        "--adaptive",action='store_true',default=False,
+        help="coarse-to-fine grid search: evaluate a coarse grid of Npts per parameter (e.g. 20), zoom --adaptive_levels times into the cells within --adaptive_lldrop of the maximum LL, and finish with a fine local grid around it. Reaches a fine resolution near the MLE with far fewer calculations than a uniform grid. Default: False")
+
+    parser.add_argument(
+        "--adaptive_levels",type=int,required=False,default=3,
+        help="for --adaptive, number of zooms, each splitting the cells into 3 per parameter. Default: 3")
+
+    parser.add_argument(
+        "--adaptive_lldrop",type=float,required=False,default=10,
+        help="for --adaptive, zoom into the cells with LL within adaptive_lldrop of the maximum LL. Default: 10")
+
+    parser.add_argument(
+        "--adaptive_fine",type=int,required=False,default=5,
+        help="for --adaptive, odd number of points per cell and parameter of the final local grid around the maximum. Default: 5")
 
     parser.add_argument(
         "--Nanc",type=float,required=False,
@@ -44,7 +73,7 @@ def parse_GridSearchArgs():
 
     parser.add_argument(
         "ref_spectra",type=Util.ExistingFile,
-        help="path to reference DFE spectra")
+        help="path to reference DFE spectra (*_DFESpectrum.json, or a pickled *.bpkl)")
 
     parser.add_argument(
         "pdfname", type=PDFValidation().ExistingPDF,
@@ -61,9 +90,8 @@ def parse_GridSearchArgs():
     # get args
     args = vars(parser.parse_args())
 
-    # now only gamma distribution
-    if args['pdfname'] not in ['gamma']:
-        raise IOError('Only gamma distribution DFE scaling suport')
+    if args['chunk_size'] < 1:
+        raise IOError('--chunk_size needs to be at least 1')
 
     # convert the values from max and min bounds
     for ii in ['max_bound','min_bound']:
@@ -74,8 +102,53 @@ def parse_GridSearchArgs():
         LoggerDFE.logINFO('DFE {0} : {1}'.format(ii,LoggerDFE.join_zip(pdf_paramdict, sep = ',')))
         args[ii] = pdf_params
 
+    pdfvars = PDFValidation().existing_pdfs[args['pdfname']]
+
+    # fix parameters to one grid value
+    fixed_params = {}
+    if args['fixed_params'] is not None:
+        for item in args['fixed_params'].strip('"').split(','):
+            name, _, value = item.partition('=')
+            if name not in pdfvars or value == '':
+                raise IOError('--fixed_params needs name=value pairs of {0} parameters'.format(args['pdfname']))
+            fixed_params[name] = float(value)
+    for ii, name in enumerate(pdfvars):
+        if name in fixed_params:
+            args['min_bound'][ii] = args['max_bound'][ii] = fixed_params[name]
+    args['fixed_params'] = fixed_params
+
+    # grid points per parameter, a single value for all parameters
+    Npts = list(map(int, args['Npts'].strip('"').split(',')))
+    if len(Npts) == 1:
+        Npts = Npts*len(pdfvars)
+    if len(Npts) != len(pdfvars):
+        raise IOError('--Npts needs one value or one per parameter')
+    args['Npts'] = [1 if name in fixed_params else npts for name, npts in zip(pdfvars, Npts)]
+    if min(args['Npts']) < 1:
+        raise IOError('--Npts needs to be at least 1')
+
+    # linear or log spacing per parameter
+    log_params = [] if args['log_params'] is None else args['log_params'].strip('"').split(',')
+    if not set(log_params) <= set(pdfvars):
+        raise IOError('--log_params needs names of {0} parameters'.format(args['pdfname']))
+    args['log_axes'] = [name in log_params for name in pdfvars]
+    for ii, name in enumerate(pdfvars):
+        if args['log_axes'][ii] and (args['min_bound'][ii] <= 0 or args['max_bound'][ii] <= 0):
+            raise IOError('Bounds of {0} in --log_params must be positive'.format(name))
+
+    if args['adaptive']:
+        if any(npts < 2 for name, npts in zip(pdfvars, args['Npts']) if name not in fixed_params):
+            raise IOError('--adaptive needs --Npts of at least 2')
+        if args['adaptive_fine'] < 1 or args['adaptive_fine'] % 2 == 0:
+            raise IOError('--adaptive_fine needs to be a positive odd number')
+        if args['adaptive_levels'] < 0:
+            raise IOError('--adaptive_levels needs to be at least 0')
+
     # check if Nanc is available if needs unscaling
     if args['dfe_scaling'] is True:
+        # now only gamma distribution
+        if args['pdfname'] not in ['gamma']:
+            raise IOError('Only gamma distribution DFE scaling suport')
         if args['Nanc'] is None:
             raise IOError('Nanc is required for dfe_scaling. Provide Nanc through --Nanc')
     else:
@@ -90,6 +163,67 @@ def parse_GridSearchArgs():
 
     return args
 
+def parse_SurfaceArgs():
+    '''
+    Parse command-line arguments for workflow: DFE1D_surface.py
+    '''
+    parser = argparse.ArgumentParser(description="Query the likelihood surface saved by DFE1D_gridsearch.py (*_surface.json) for profile likelihoods, likelihood-ratio confidence intervals and regions, interpolated LL, or a comparison of two surfaces, without evaluating any spectra.")
+
+    parser.add_argument(
+        "--params",type=str,required=False,default=None,
+        help="parameters to query, separate by comma. Default: all searched parameters.")
+
+    parser.add_argument(
+        "--level",type=float,required=False,default=0.95,
+        help="confidence level for `ci` and `region`. Default: 0.95")
+
+    parser.add_argument(
+        "--points",type=str,required=False,default=None,
+        help="for `interpolate`, points of the searched parameters, values separated by comma and points by semicolon (e.g. '0.2,400;0.3,500')")
+
+    parser.add_argument(
+        "--method",type=str,required=False,default='linear',choices=['linear','cubic'],
+        help="for `interpolate` and `compare`, interpolation between the grid points. Default: 'linear'")
+
+    parser.add_argument(
+        "--other",type=Util.ExistingFile,required=False,default=None,
+        help="for `compare`, the surface (*_surface.json) of another population, with the same pdfname and searched parameters")
+
+    parser.add_argument(
+        "surface",type=Util.ExistingFile,
+        help="path to the likelihood surface (*_surface.json) from DFE1D_gridsearch.py")
+
+    parser.add_argument(
+        "query",type=str,choices=['profile','ci','region','interpolate','compare'],
+        help="profile: profile LL of each of --params. ci: likelihood-ratio confidence interval of each of --params. region: grid points in the joint likelihood-ratio confidence region of --params. interpolate: LL at --points. compare: the MLE of each surface and its LL drop on the other surface.")
+
+    parser.add_argument(
+        "outprefix", type=str,
+        help="Path/NamePrefix to the output file")
+
+    # get args
+    args = vars(parser.parse_args())
+
+    if not 0 < args['level'] < 1:
+        raise IOError('--level needs to be between 0 and 1')
+    if args['params'] is not None:
+        args['params'] = args['params'].strip('"').split(',')
+    if args['query'] == 'interpolate':
+        if args['points'] is None:
+            raise IOError('interpolate needs --points')
+        args['points'] = [list(map(float, point.split(','))) for point in args['points'].strip('"').split(';')]
+    if args['query'] == 'compare' and args['other'] is None:
+        raise IOError('compare needs --other')
+
+    # check if directory exists
+    outdir = os.path.dirname(args['outprefix'])
+    Util.CreateNewDir(outdir)
+
+    # log the input statistics
+    LoggerDFE.print_IO(args)
+
+    return args
+
 def parse_InferenceArgs():
     '''
     Parse command-line arguments for workflow: DFE1D_inferenceFIM.py
@@ -120,13 +254,17 @@ def parse_InferenceArgs():
         "--mask_singleton",action='store_true',default=False,
         help="mask singleton in the input SFS")
 
+    parser.add_argument(
+        "--lbfgsb",action='store_true',default=False,
+        help="optimize with L-BFGS-B using the exact gradient of the likelihood from the reference spectra, instead of the default dadi optimizer")
+
     parser.add_argument(
         "sfs",type=Util.ExistingFile,
         help="path to FOLDED NONSYN SFS in dadi format from easysfs (mask optional)")
 
     parser.add_argument(
         "ref_spectra",type=Util.ExistingFile,
-        help="path to reference DFE spectra")
+        help="path to reference DFE spectra (*_DFESpectrum.json, or a pickled *.bpkl)")
 
     parser.add_argument(
         "pdfname", type=PDFValidation().ExistingPDF,
@@ -180,6 +318,74 @@ def parse_SpectraArgs():
         'ns', type=int,
         help='Number of samples in the SFS to generate')
 
+    parser.add_argument(
+        "--keep_checkpoint",action='store_true',default=False,
+        help="keep the `*_DFESpectrum_checkpoint` directory of finished spectra after the cache is saved. A rerun with the same inputs always reuses the spectra in that directory and only computes the missing gammas.")
+
+    parser.add_argument(
+        "--store",type=str,required=False,default=None,
+        help="directory of a content-addressed store of reference spectra, shared across runs (e.g. ~/.cache/varDFE). If spectra with identical settings were built before, they are reused instead of recomputed. Default: not using a store.")
+
+    parser.add_argument(
+        "--store_max_gb",type=float,required=False,default=50,
+        help="maximum size of --store in GB. The least recently used spectra are removed when it is exceeded. Default: 50.")
+
+    parser.add_argument(
+        "--gamma_bounds",type=str,required=False,default='1e-5,10000',
+        help="range of the absolute values of negative gammas to cache, separate by comma. Default: '1e-5,10000'")
+
+    parser.add_argument(
+        "--gamma_pts",type=int,required=False,default=901,
+        help="number of log-spaced negative gammas. Default: 901")
+
+    parser.add_argument(
+        "--pos_gamma_bounds",type=str,required=False,default='1e-5,100',
+        help="range of positive gammas to cache, separate by comma. Default: '1e-5,100'")
+
+    parser.add_argument(
+        "--pos_gamma_pts",type=int,required=False,default=701,
+        help="number of log-spaced positive gammas. Default: 701")
+
+    parser.add_argument(
+        "--quadrature",type=str,required=False,default='trapz',choices=QUADRATURES,
+        help="rule for integrating over gammas. 'simpson' (Simpson's rule in log(gamma)) and 'gauss' (Gauss-Legendre panels in log(gamma)) reach the accuracy of 'trapz' with several times fewer --gamma_pts and --pos_gamma_pts. Default: 'trapz'")
+
+    parser.add_argument(
+        "--gauss_order",type=int,required=False,default=5,
+        help="number of Gauss-Legendre nodes per panel for --quadrature gauss. Default: 5")
+
+    parser.add_argument(
+        "--refine_tol",type=float,required=False,default=None,
+        help="adaptive gamma grid. If given, --gamma_pts and --pos_gamma_pts are a coarse grid, refined by bisecting (in log gamma) the intervals where the spectra differ from the interpolation of their neighbours by more than refine_tol (relative error, e.g. 0.001) or that are wider than --refine_max_step. Default: not refining.")
+
+    parser.add_argument(
+        "--refine_max_pts",type=int,required=False,default=None,
+        help="budget of gammas for --refine_tol, the intervals with the largest differences are refined first. Default: no budget.")
+
+    parser.add_argument(
+        "--refine_max_step",type=float,required=False,default=0.1,
+        help="for --refine_tol, intervals wider than refine_max_step in log10(gamma) are always refined, so the grid also resolves the DFEs integrated over it. Default: 0.1")
+
+    parser.add_argument(
+        "--lowrank_tol",type=float,required=False,default=None,
+        help="store the spectra as low-rank factors, with the smallest rank reproducing them within lowrank_tol (relative error per frequency bin, e.g. 1e-6). Saves memory and time per integration for large ns and many gammas. Default: full spectra, or the tolerance of the --extend spectra.")
+
+    parser.add_argument(
+        "--fold_spectra",action='store_true',default=False,
+        help="store only the folded spectra, half the size. Enough for the workflows, which always fold the SFS. --extend spectra stored folded stay folded. Default: False")
+
+    parser.add_argument(
+        "--spectra_dtype",type=str,required=False,default=None,choices=['float64','float32'],
+        help="precision of the stored spectra. 'float32' halves the size, the integration over gammas is still done in float64. Default: 'float64', or the precision of the --extend spectra")
+
+    parser.add_argument(
+        "--batch_gammas",action='store_true',default=False,
+        help="solve blocks of gammas at once (see DemogSelModels2.*_gammas), same spectra as solving them one at a time. Only weakly selected gammas share a time step and run faster this way, strongly selected ones can run slower. Default: False")
+
+    parser.add_argument(
+        "--extend",type=Util.ExistingFile,required=False,default=None,
+        help="path to existing reference DFE spectra (*_DFESpectrum.json) with the same demog_model, demog_params and ns. Only the gammas of the new grid missing from it are computed and merged in.")
+
     parser.add_argument(
         "outprefix", type=str,
         help="Path/NamePrefix to the output file")
@@ -199,6 +405,16 @@ def parse_SpectraArgs():
     args['demog_params'] = demog_params
     LoggerDFE.logINFO('Demographic params {0}'.format(LoggerDFE.join_zip(demog_paramdict, sep = ',')))
 
+    if args['refine_tol'] is not None and args['quadrature'] == 'gauss':
+        raise IOError('--refine_tol needs --quadrature trapz or simpson')
+
+    # convert the gamma grid bounds
+    for ii in ['gamma_bounds','pos_gamma_bounds']:
+        bounds = list(map(float, args[ii].strip('"').split(",")))
+        if len(bounds) != 2:
+            raise IOError('{0} needs two values separated by comma'.format(ii))
+        args[ii] = tuple(bounds)
+
     # check if directory exists
     outdir = os.path.dirname(args['outprefix'])
     Util.CreateNewDir(outdir)
@@ -0,0 +1,106 @@
+"""
+Integration of one population for a block of gamma values at once.
+
+Same as `dadi.Integration.one_pop` with constant parameters, but phi is a 2D
+array with one row per gamma. The tridiagonal systems of gammas sharing a time
+step are concatenated into one system, so they are advanced with a single
+tridiagonal solve per step instead of one per gamma. Every gamma keeps the time
+step dadi would use, so each row is identical to `dadi.Integration.one_pop`.
+"""
+
+import numpy as np
+from numpy import newaxis as nuax
+from scipy.special import betainc
+from dadi import Integration
+
+def one_pop_gammas(phi, xx, T, nu=1, gammas=0, h=0.5, theta0=1, beta=1):
+    """
+    Integrate one population with constant parameters for a block of gammas.
+
+    phi: 2D array, one phi per gamma
+    xx: Grid upon (0,1) on which phi is defined
+    T: Time at which to halt integration
+    nu: Population size, constant
+    gammas: 1D array of selection coefficients, one per row of phi
+    h: Dominance coefficient
+    theta0: Proportional to ancestral size. Typically constant.
+    beta: Breeding ratio, beta=Nf/Nm.
+    """
+    if np.any(np.less([T,nu,theta0], 0)):
+        raise ValueError('A time, population size, migration rate, or theta0 '
+                         'is < 0. Has the model been mis-specified?')
+    if np.any(np.equal([nu], 0)):
+        raise ValueError('A population size is 0. Has the model been '
+                         'mis-specified?')
+    gammas = np.atleast_1d(np.asarray(gammas, dtype=float))
+    phi = np.array(phi, dtype=float)
+    if phi.shape != (len(gammas), len(xx)):
+        raise ValueError('phi must have one row of len(xx) per gamma')
+
+    M = Integration._Mfunc1D(xx[nuax,:], gammas[:,nuax], h)
+    MInt = Integration._Mfunc1D(((xx[:-1] + xx[1:])/2)[nuax,:], gammas[:,nuax], h)
+    V = Integration._Vfunc(xx, nu, beta=beta)
+    VInt = Integration._Vfunc((xx[:-1] + xx[1:])/2, nu, beta=beta)
+
+    dx = np.diff(xx)
+    dfactor = Integration._compute_dfactor(dx)
+    delj = Integration._compute_delj(dx, MInt, VInt)
+
+    a = np.zeros(phi.shape)
+    a[:,1:] += dfactor[1:]*(-MInt * delj - V[:-1]/(2*dx))
+
+    c = np.zeros(phi.shape)
+    c[:,:-1] += -dfactor[:-1]*(-MInt * (1-delj) + V[1:]/(2*dx))
+
+    b = np.zeros(phi.shape)
+    b[:,:-1] += -dfactor[:-1]*(-MInt * delj - V[:-1]/(2*dx))
+    b[:,1:] += dfactor[1:]*(-MInt * (1-delj) + V[1:]/(2*dx))
+
+    b[:,0] += np.where(M[:,0] <= 0, (0.5/nu - M[:,0])*2/dx[0], 0)
+    b[:,-1] += np.where(M[:,-1] >= 0, -(-0.5/nu - M[:,-1])*2/dx[-1], 0)
+
+    # Gammas with the same time step (all weak enough that drift sets the time
+    # step) are advanced together. a[:,0] and c[:,-1] are zero, so their
+    # concatenated systems stay decoupled.
+    dt = np.array([Integration._compute_dt(dx, nu, [0], gamma, h) for gamma in gammas])
+    pts = len(xx)
+    for group_dt in np.unique(dt):
+        group = np.nonzero(dt == group_dt)[0]
+        group_phi = phi[group].ravel()
+        group_a, group_b, group_c = a[group].ravel(), b[group].ravel(), c[group].ravel()
+        # the diagonal only changes at the last, shorter step
+        group_bdt = group_b + 1/group_dt
+        current_t = 0
+        while current_t < T:
+            this_dt = min(group_dt, T - current_t)
+            if this_dt != group_dt:
+                group_bdt = group_b + 1/this_dt
+            # same as Integration._inject_mutations_1D
+            group_phi[1::pts] += this_dt/xx[1] * theta0/2 * 2/(xx[2] - xx[0])
+            r = group_phi/this_dt
+            group_phi = Integration.tridiag.tridiag(group_a, group_bdt, group_c, r)
+            current_t += this_dt
+        phi[group] = group_phi.reshape(len(group), pts)
+    return phi
+
+def from_phi_gammas(phi, ns, xx):
+    """
+    Spectra from a block of phi, one row per gamma. Same as
+    `dadi.Spectrum.from_phi` (analytic 1D integration over the piecewise-linear
+    phi), but the incomplete beta functions are shared by all rows.
+    Returns a 2D array of spectra data.
+    """
+    n = ns[0]
+    data = np.zeros((len(phi), n+1))
+
+    xx = np.minimum(np.maximum(xx, 0), 1.0)
+    # Slopes and constant terms of the linear segments, one row per gamma
+    s = (phi[:,1:]-phi[:,:-1])/(xx[1:]-xx[:-1])
+    c1 = (phi[:,:-1] - s*xx[:-1])/(n+1)
+    for d in range(0,n+1):
+        c2 = s*(d+1)/((n+1)*(n+2))
+        beta1 = betainc(d+1,n-d+1,xx)
+        beta2 = betainc(d+2,n-d+1,xx)
+        entries = c1*(beta1[1:]-beta1[:-1]) + c2*(beta2[1:]-beta2[:-1])
+        data[:,d] = np.sum(entries, axis=1)
+    return data
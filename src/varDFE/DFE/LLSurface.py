@@ -0,0 +1,260 @@
+"""
+Read, write and query the likelihood surfaces of the DFE grid search.
+
+The surface is the `.npy` ll_grid of `DFE1D_gridsearch.py`, one row per grid
+point in the order of `DFEGridsearchWorker.grid_points`, saved next to a
+versioned JSON header with the axes of the grid. The ll_model column is indexed
+by the axes, so profile likelihoods, likelihood-ratio confidence intervals and
+regions, and interpolation of the surface are computed from the stored LL
+without evaluating any spectra. The `.npy` is loaded with
+`np.load(mmap_mode='r')`. The profiles and the maximum are reduced slab by slab,
+and linear interpolation reads only the grid points around the queried points,
+so large surfaces are never read into memory at once. Spline interpolation
+(e.g. 'cubic') reads the whole grid.
+"""
+
+import json
+import os
+import warnings
+import numpy as np
+import scipy.interpolate
+import scipy.stats
+
+FORMAT_NAME = 'varDFE.LLSurface'
+FORMAT_VERSION = 1
+
+def surface_path(npyfile):
+    """
+    Path to the `.json` header that belongs to a grid search `.npy` ll_grid.
+    """
+    return os.path.splitext(npyfile)[0] + '_surface.json'
+
+def save_surface(outfile, npyfile, pdfname, pdfvars, axes, log_axes, info=None):
+    """
+    Save the `.json` header (outfile) of the uniform grid search ll_grid saved
+    to npyfile.
+
+    pdfname, pdfvars: the PDF and its parameters, the columns of ll_grid
+    axes: values of each parameter of the grid, see `DFEGridsearchWorker.grid_axes`
+    log_axes: whether each parameter is log-spaced
+    info: dict of other settings of the grid search to keep, e.g. the sfs
+    """
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'll_grid': os.path.basename(npyfile),
+        'pdfname': pdfname,
+        'pdfvars': list(pdfvars),
+        'axes': [np.asarray(axis, dtype=float).tolist() for axis in axes],
+        'log_axes': [bool(log) for log in log_axes],
+        'info': {} if info is None else info
+    }
+    with open(outfile, 'w') as outf:
+        json.dump(header, outf)
+    return None
+
+def load_surface(infile, mmap_mode='r'):
+    """
+    Load an LLSurface saved by `save_surface`.
+    mmap_mode: passed to np.load for the ll_grid. None reads it into memory.
+    """
+    with open(infile, 'r') as inf:
+        header = json.load(inf)
+    if header.get('format') != FORMAT_NAME:
+        raise IOError('{0} is not a varDFE likelihood surface file'.format(infile))
+    if header['version'] > FORMAT_VERSION:
+        raise IOError('{0} has format version {1}, newer than the supported version {2}'.format(
+            infile, header['version'], FORMAT_VERSION))
+
+    ll_grid = np.load(os.path.join(os.path.dirname(infile), header['ll_grid']), mmap_mode=mmap_mode)
+    return LLSurface(
+        ll=ll_grid[:,len(header['pdfvars'])],
+        axes=header['axes'],
+        pdfvars=header['pdfvars'],
+        log_axes=header['log_axes'],
+        pdfname=header['pdfname'],
+        info=header['info'])
+
+class LLSurface():
+    """
+    Log-likelihood surface over the grid of axes, one axis per parameter.
+    Parameters with a single value on their axis are fixed. Grid points not
+    evaluated (e.g. of an interrupted grid search) are nan and ignored.
+    """
+    # approximate number of grid points read at once
+    slab_size = 1000000
+    # interpolation methods using only the grid points around each point
+    local_methods = ('linear', 'nearest', 'slinear')
+
+    def __init__(self, ll, axes, pdfvars, log_axes=None, pdfname=None, info=None):
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.shape = tuple(len(axis) for axis in self.axes)
+        if len(pdfvars) != len(self.axes):
+            raise ValueError('LLSurface needs one axis per parameter')
+        if np.size(ll) != np.prod(self.shape):
+            raise ValueError('LLSurface has {0} values for a grid of {1} points'.format(np.size(ll), np.prod(self.shape)))
+        # a view, memory-mapped arrays stay on disk
+        self.ll = ll.reshape(self.shape)
+        self.pdfvars = list(pdfvars)
+        self.log_axes = [False]*len(self.axes) if log_axes is None else [bool(log) for log in log_axes]
+        self.pdfname = pdfname
+        self.info = {} if info is None else info
+        # parameters searched, the others are fixed
+        self.freevars = [name for name, axis in zip(self.pdfvars, self.axes) if len(axis) > 1]
+
+    def _axis(self, param):
+        if param not in self.freevars:
+            raise ValueError('{0} is not a searched parameter of the surface ({1})'.format(param, ','.join(self.freevars)))
+        return self.pdfvars.index(param)
+
+    def profile_ll(self, params):
+        """
+        Profile log-likelihood of params (names), the maximum LL over the other
+        parameters. Returns an array with one axis per parameter in params, in
+        the order of pdfvars.
+        """
+        keep = [self._axis(param) for param in params]
+        drop = tuple(ii for ii in range(1, len(self.shape)) if ii not in keep)
+        nslab = max(1, self.slab_size//int(np.prod(self.shape[1:])))
+        slabs, result = [], None
+        for start in range(0, self.shape[0], nslab):
+            block = np.asarray(self.ll[start:start+nslab], dtype=float)
+            # all-nan slices (not evaluated) stay nan
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                if len(drop) > 0:
+                    block = np.nanmax(block, axis=drop)
+                if 0 in keep:
+                    slabs.append(block)
+                else:
+                    block = np.nanmax(block, axis=0)
+                    result = block if result is None else np.fmax(result, block)
+        profile = np.concatenate(slabs) if 0 in keep else result
+        return profile.reshape([len(self.axes[ii]) for ii in sorted(keep)])
+
+    def mle(self):
+        """
+        Grid point with the maximum LL, returned as (params, ll_max).
+        """
+        flat = self.ll.reshape(-1)
+        best, ll_max = None, -np.inf
+        for start in range(0, len(flat), self.slab_size):
+            block = np.asarray(flat[start:start+self.slab_size], dtype=float)
+            if np.all(np.isnan(block)):
+                continue
+            ii = np.nanargmax(block)
+            if block[ii] > ll_max:
+                best, ll_max = start + ii, block[ii]
+        if best is None:
+            raise ValueError('LLSurface has no evaluated grid points')
+        index = np.unravel_index(best, self.shape)
+        return np.array([axis[ii] for axis, ii in zip(self.axes, index)]), float(ll_max)
+
+    def profile(self, param):
+        """
+        Profile log-likelihood of one parameter, returned as (values, ll_profile).
+        """
+        return self.axes[self._axis(param)], self.profile_ll([param]).ravel()
+
+    def confidence_interval(self, param, level=0.95):
+        """
+        Likelihood-ratio confidence interval of param from its profile: the
+        values with profile LL within chi2(level, df=1)/2 of the maximum. The
+        ends are interpolated linearly (in log space for log-spaced parameters)
+        between the grid values. An interval ending at the edge of the grid
+        only gives a bound, marked by lower_at_edge or upper_at_edge.
+
+        Returns a dict with mle, lower, upper, lower_at_edge and upper_at_edge.
+        """
+        values, profile = self.profile(param)
+        log = self.log_axes[self._axis(param)]
+        xx = np.log(values) if log else values
+        ll_max = np.nanmax(profile)
+        threshold = ll_max - scipy.stats.chi2.ppf(level, 1)/2
+        inside = np.nonzero(profile >= threshold)[0]
+        imax = np.nanargmax(profile)
+
+        def crossing(ii, jj):
+            # between the grid values ii (inside) and jj (outside)
+            if not np.isfinite(profile[jj]):
+                return xx[ii]
+            frac = (profile[ii] - threshold)/(profile[ii] - profile[jj])
+            return xx[ii] + frac*(xx[jj] - xx[ii])
+
+        lo, hi = inside[0], inside[-1]
+        lower = xx[lo] if lo == 0 else crossing(lo, lo - 1)
+        upper = xx[hi] if hi == len(xx) - 1 else crossing(hi, hi + 1)
+        if log:
+            lower, upper = np.exp(lower), np.exp(upper)
+        return {'param': param, 'level': level, 'mle': float(values[imax]),
+                'lower': float(lower), 'upper': float(upper),
+                'lower_at_edge': bool(lo == 0), 'upper_at_edge': bool(hi == len(xx) - 1)}
+
+    def confidence_region(self, params=None, level=0.95):
+        """
+        Likelihood-ratio confidence region of params (default: all searched
+        parameters): the grid points of their profile LL within
+        chi2(level, df=len(params))/2 of the maximum.
+
+        Returns (points, ll_profile), one row of params values per grid point,
+        in the order of pdfvars.
+        """
+        params = self.freevars if params is None else [param for param in self.freevars if param in params]
+        profile = self.profile_ll(params)
+        threshold = np.nanmax(profile) - scipy.stats.chi2.ppf(level, len(params))/2
+        with np.errstate(invalid='ignore'):
+            index = np.nonzero(profile >= threshold)
+        keep = sorted(self._axis(param) for param in params)
+        points = np.column_stack([self.axes[kk][ii] for kk, ii in zip(keep, index)])
+        return points, profile[index]
+
+    def interpolate(self, points, method='linear'):
+        """
+        Log-likelihood at points, interpolated over the grid (in log space for
+        log-spaced parameters). points: 2D array, one row of values of the
+        searched parameters per point, in the order of pdfvars. Points outside
+        the grid are nan.
+        method: 'linear', 'cubic' or another method of scipy.interpolate.RegularGridInterpolator
+
+        The local methods (local_methods) only read the box of grid points
+        around the points. The others fit splines along whole axes and read
+        the full grid.
+        """
+        free = [self._axis(param) for param in self.freevars]
+        # a copy, the log-spaced columns are converted in place
+        points = np.array(points, dtype=float, ndmin=2)
+        if points.shape[1] != len(free):
+            raise ValueError('points need one value per searched parameter ({0})'.format(','.join(self.freevars)))
+        grid = []
+        for kk, ii in enumerate(free):
+            grid.append(np.log(self.axes[ii]) if self.log_axes[ii] else self.axes[ii])
+            if self.log_axes[ii]:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    points[:,kk] = np.log(points[:,kk])
+        with np.errstate(invalid='ignore'):
+            inside = np.all([(points[:,kk] >= xx.min()) & (points[:,kk] <= xx.max())
+                             for kk, xx in enumerate(grid)], axis=0)
+
+        local = method in self.local_methods
+        if local and not np.any(inside):
+            return np.full(len(points), np.nan)
+
+        # fixed parameters have a single grid value
+        index = [0]*len(self.axes)
+        for kk, ii in enumerate(free):
+            index[ii] = slice(None)
+            if local:
+                # the grid values bracketing the points, at least two
+                xx, values = grid[kk], points[inside,kk]
+                lo, hi = xx[xx <= values.min()].max(), xx[xx >= values.max()].min()
+                box = np.nonzero((xx >= lo) & (xx <= hi))[0]
+                start = min(box[0], len(xx) - 2)
+                index[ii] = slice(start, max(box[-1] + 1, start + 2))
+                grid[kk] = xx[index[ii]]
+        values = np.asarray(self.ll[tuple(index)], dtype=float)
+        for kk, xx in enumerate(grid):
+            if xx[0] > xx[-1]:
+                # RegularGridInterpolator needs ascending axes
+                grid[kk], values = xx[::-1], np.flip(values, axis=kk)
+        interp = scipy.interpolate.RegularGridInterpolator(grid, values, method=method, bounds_error=False)
+        return interp(points)
@@ -117,6 +117,7 @@ def args2comment(args):
 def write_gridsearch_result(args,pdfvars,ll_data,ll_max,ll_griddf,outfile):
     """
     Output DFE grid search results
+    ll_griddf: pd.DataFrame of the grid, or an iterable of its chunks in order
     """
     # organize args as annotations
     outlines = args2comment(args)
@@ -130,7 +131,22 @@ def write_gridsearch_result(args,pdfvars,ll_data,ll_max,ll_griddf,outfile):
         outf.writelines(outlines)
         outf.write("#ll_grid\n")
 
-    ll_griddf.to_csv(outfile, sep='\t',mode='a')
+    if isinstance(ll_griddf, pd.DataFrame):
+        ll_griddf = [ll_griddf]
+    for ii, chunkdf in enumerate(ll_griddf):
+        chunkdf.to_csv(outfile, sep='\t',mode='a',header=(ii == 0))
     return None
 
+def write_surface_query(args,resultdf,outfile):
+    """
+    Output likelihood surface query results
+    """
+    # organize args as annotations
+    outlines = args2comment(args)
 
+    with open(outfile, 'w') as outf:
+        outf.writelines(outlines)
+        outf.write("#{0}\n".format(args['query']))
+
+    resultdf.to_csv(outfile, sep='\t',mode='a',index=False)
+    return None
@@ -3,7 +3,7 @@ Input validations for DFE PDF function forms
 """
 
 from dadi.DFE import PDFs
-from varDFE.DFE import PDFs2
+from varDFE.DFE import PDFs2, Inference2
 import dadi
 
 class PDFValidation():
@@ -32,14 +32,15 @@ class PDFValidation():
             'shifted_gamma': PDFs2.shifted_gamma
         }
 
+        # same as dadi.Inference.optimize(_log) with the Poisson likelihood, on plain model arrays
         self.Inference_optimizer = {
-            'gamma': dadi.Inference.optimize_log,
-            'neugamma': dadi.Inference.optimize_log,
-            'gammalet': dadi.Inference.optimize_log,
-            'neugammalet': dadi.Inference.optimize_log,
-            'lognormal': dadi.Inference.optimize, # mu can be negative, therefore can't use optimize_log
-            'lourenco_eq': dadi.Inference.optimize_log,
-            'shifted_gamma': dadi.Inference.optimize_log
+            'gamma': Inference2.optimize_log,
+            'neugamma': Inference2.optimize_log,
+            'gammalet': Inference2.optimize_log,
+            'neugammalet': Inference2.optimize_log,
+            'lognormal': Inference2.optimize, # mu can be negative, therefore can't use optimize_log
+            'lourenco_eq': Inference2.optimize_log,
+            'shifted_gamma': Inference2.optimize_log
         }
 
         # for information, outputted to the summary
@@ -124,5 +125,3 @@ class PDFValidation():
         optimizer = self.Inference_optimizer[pdfname]
         integrate_methods = self.Spectra_integrate_methods[pdfname]
         return pdf, optimizer, integrate_methods
-
-
@@ -4,6 +4,7 @@ Additional Probability density functions for defining DFEs.
 
 import numpy as np
 import scipy.stats.distributions as ssd
+import scipy.special as sc
 from dadi import DFE
 from mpmath import mp
 mp.dps = 50
@@ -23,7 +24,8 @@ def neugamma(xx, params):
     xx = np.atleast_1d(xx)
     out = (1-pneu)*DFE.PDFs.gamma(xx, (alpha, beta))
     # Assume gamma < 1e-5 is essentially neutral
-    out[np.logical_and(0 <= xx, xx < mins)] += pneu/mins
+    # (added with np.where so that the params can be arrays broadcast against xx)
+    out = out + np.where(np.logical_and(0 <= xx, xx < mins), pneu/mins, 0)
     # Reduce xx back to scalar if it's possible
     return np.squeeze(out)
 
@@ -58,7 +60,7 @@ def neugammalet(xx, params):
     xx = np.atleast_1d(xx)
     out = (1-pneu-plet)*DFE.PDFs.gamma(xx, (alpha, beta))
     # Assume gamma < 1e-5 (at dadi website: 1e-4) is essentially neutral
-    out[np.logical_and(0 <= xx, xx < mins)] += pneu/mins
+    out = out + np.where(np.logical_and(0 <= xx, xx < mins), pneu/mins, 0)
     # Reduce xx back to scalar if it's possible
     return  np.squeeze(out)
 
@@ -77,13 +79,44 @@ def lourenco_eq(xx, params):
     out = float(prob/(2.0*Ne_dadi))
     return out
 
-# wrap around lourenco_eq
+# vectorized lourenco_eq
+# same formula in log space with double precision, the bessel function is
+# taken as log(kve(v, z)) - z so that it does not underflow for large z.
 def lourenco_eq_pdf(xx, params):
-    if isinstance(xx, int) or isinstance(xx, float):
-        return lourenco_eq(xx, params)
-    else:
-        out = [lourenco_eq(x, params) for x in xx]
-        return np.array(out)
+    """
+    Define a FGM based mutation-selection-drift balance DFE, same as `lourenco_eq`
+    for an array of xx. The params can also be arrays broadcast against xx.
+    Elements that are not finite in double precision (e.g. s = 0) fall back
+    to `lourenco_eq`.
+    params: [m, sigma, Ne, Ne_dadi] = [pleiotropy, variation, Ne, Ne_dadi]
+    """
+    m, sigma, Ne, Ne_dadi = params # Ne_dadi is not estimated
+    xx_in = xx
+    xx = np.atleast_1d(np.asarray(xx, dtype=float))
+    s = xx/(2.0*Ne_dadi)
+    abss = np.abs(s)
+    # 1+1/(Ne*sigma^2) = 1+x
+    x = 1/(Ne*np.power(sigma, 2.))
+    sqrtA = np.sqrt(1+x)
+    v = (m-1)/2.
+    z = Ne*abss*sqrtA
+    # -Ne*s - z, without the cancellation for s < 0
+    expo = np.where(s < 0, -Ne*abss*x/(sqrtA+1), -Ne*abss*(1+sqrtA))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore', under='ignore'):
+        logprob = ((1-m)/2.)*np.log(2) + 0.5*np.log(Ne) + v*np.log(abss) + ((1-m)/4.)*np.log1p(x) + \
+            expo + np.log(sc.kve(v, z)) - 0.5*np.log(np.pi) - m*np.log(sigma) - sc.gammaln(m/2.)
+        # the probability is scaled for s, convert to xx
+        out = np.exp(logprob)/(2.0*Ne_dadi)
+    # params may be arrays broadcast against xx, fall back element by element
+    failed = np.argwhere(~np.isfinite(logprob))
+    if len(failed) > 0:
+        xx_b = np.broadcast_to(xx, out.shape)
+        params_b = [np.broadcast_to(pp, out.shape) for pp in (m, sigma, Ne, Ne_dadi)]
+        for ii in map(tuple, failed):
+            out[ii] = lourenco_eq(xx_b[ii], [float(pp[ii]) for pp in params_b])
+    if np.ndim(xx_in) == 0:
+        return float(out[0])
+    return out
 
 # implemented by huber et al. 2017. derived in martin and lenormand 2006 (eq. 5).
 # TOUSERS: THIS FUNCTION IS NOT TESTED AND FULLY IMPLEMENTED, USED AT YOUR OWN RISK.
@@ -95,3 +128,130 @@ def shifted_gamma(xx, params):
     shift, alpha, beta = params
     # need to use `-xx` instead of `+xx` because this included positive gammas and no sign conversion is available for Cache1D.integrate_continuous_pos.
     return((ssd.gamma.pdf((shift - xx)*scal_fac, alpha, scale=beta))/scal_fac)
+
+# cumulative distribution (cdf) and survival (sf) functions of the PDFs above,
+# i.e. integrals of the PDF from -inf to xx and from xx to inf. These do not
+# reach one when the PDF does not integrate to one (e.g. gammalet).
+# registered in cdf_functions below, used by Cache1D for the weights outside the cached gammas.
+def gamma_cdf(xx, params):
+    alpha, beta = params
+    return ssd.gamma.cdf(xx, alpha, scale=beta)
+
+def gamma_sf(xx, params):
+    alpha, beta = params
+    return ssd.gamma.sf(xx, alpha, scale=beta)
+
+def lognormal_cdf(xx, params):
+    mu, sigma = params
+    return ssd.lognorm.cdf(xx, sigma, scale=np.exp(mu))
+
+def lognormal_sf(xx, params):
+    mu, sigma = params
+    return ssd.lognorm.sf(xx, sigma, scale=np.exp(mu))
+
+def neugamma_cdf(xx, params):
+    mins = 1e-5
+    pneu, alpha, beta = params
+    return (1-pneu)*gamma_cdf(xx, (alpha, beta)) + pneu*np.clip(xx/mins, 0, 1)
+
+def neugamma_sf(xx, params):
+    mins = 1e-5
+    pneu, alpha, beta = params
+    return (1-pneu)*gamma_sf(xx, (alpha, beta)) + pneu*np.clip(1-xx/mins, 0, 1)
+
+def gammalet_cdf(xx, params):
+    plet, alpha, beta = params
+    return (1-plet)*gamma_cdf(xx, (alpha, beta))
+
+def gammalet_sf(xx, params):
+    plet, alpha, beta = params
+    return (1-plet)*gamma_sf(xx, (alpha, beta))
+
+def neugammalet_cdf(xx, params):
+    mins = 1e-5
+    plet, pneu, alpha, beta = params
+    return (1-pneu-plet)*gamma_cdf(xx, (alpha, beta)) + pneu*np.clip(xx/mins, 0, 1)
+
+def neugammalet_sf(xx, params):
+    mins = 1e-5
+    plet, pneu, alpha, beta = params
+    return (1-pneu-plet)*gamma_sf(xx, (alpha, beta)) + pneu*np.clip(1-xx/mins, 0, 1)
+
+def shifted_gamma_cdf(xx, params):
+    shift, alpha, beta = params
+    return ssd.gamma.sf(shift - xx, alpha, scale=beta)
+
+def shifted_gamma_sf(xx, params):
+    shift, alpha, beta = params
+    return ssd.gamma.cdf(shift - xx, alpha, scale=beta)
+
+# gradients of the PDFs above with respect to their params, one row per param.
+# registered in grad_functions below, used by Cache1D for the Jacobian of the integrated spectra.
+def gamma_grad(xx, params):
+    alpha, beta = params
+    xx = np.asarray(xx, dtype=float)
+    pdf = DFE.PDFs.gamma(xx, params)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dalpha = pdf*(np.log(xx) - np.log(beta) - sc.digamma(alpha))
+        dbeta = pdf*(xx/beta**2 - alpha/beta)
+    # pdf is zero outside the support
+    return np.where(pdf > 0, np.array([dalpha, dbeta]), 0)
+
+def lognormal_grad(xx, params):
+    mu, sigma = params
+    xx = np.asarray(xx, dtype=float)
+    pdf = DFE.PDFs.lognormal(xx, params)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dmu = pdf*(np.log(xx) - mu)/sigma**2
+        dsigma = pdf*((np.log(xx) - mu)**2/sigma**3 - 1/sigma)
+    return np.where(pdf > 0, np.array([dmu, dsigma]), 0)
+
+def neugamma_grad(xx, params):
+    mins = 1e-5
+    pneu, alpha, beta = params
+    xx = np.asarray(xx, dtype=float)
+    dpneu = -DFE.PDFs.gamma(xx, (alpha, beta)) + np.logical_and(0 <= xx, xx < mins)/mins
+    return np.concatenate(([dpneu], (1-pneu)*gamma_grad(xx, (alpha, beta))))
+
+def gammalet_grad(xx, params):
+    plet, alpha, beta = params
+    xx = np.asarray(xx, dtype=float)
+    dplet = -DFE.PDFs.gamma(xx, (alpha, beta))
+    return np.concatenate(([dplet], (1-plet)*gamma_grad(xx, (alpha, beta))))
+
+def neugammalet_grad(xx, params):
+    mins = 1e-5
+    plet, pneu, alpha, beta = params
+    xx = np.asarray(xx, dtype=float)
+    dplet = -DFE.PDFs.gamma(xx, (alpha, beta))
+    dpneu = dplet + np.logical_and(0 <= xx, xx < mins)/mins
+    return np.concatenate(([dplet, dpneu], (1-pneu-plet)*gamma_grad(xx, (alpha, beta))))
+
+def shifted_gamma_grad(xx, params):
+    shift, alpha, beta = params
+    yy = shift - np.asarray(xx, dtype=float)
+    pdf = ssd.gamma.pdf(yy, alpha, scale=beta)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dshift = pdf*((alpha-1)/yy - 1/beta)
+    return np.where(pdf > 0, np.concatenate(([dshift], gamma_grad(yy, (alpha, beta)))), 0)
+
+# (cdf, sf) and gradient of each PDF, keyed by the PDF function. A PDF missing
+# here has no closed form: Cache1D integrates it numerically and takes finite
+# differences instead.
+cdf_functions = {
+    DFE.PDFs.gamma: (gamma_cdf, gamma_sf),
+    neugamma: (neugamma_cdf, neugamma_sf),
+    gammalet: (gammalet_cdf, gammalet_sf),
+    neugammalet: (neugammalet_cdf, neugammalet_sf),
+    DFE.PDFs.lognormal: (lognormal_cdf, lognormal_sf),
+    shifted_gamma: (shifted_gamma_cdf, shifted_gamma_sf)
+}
+
+grad_functions = {
+    DFE.PDFs.gamma: gamma_grad,
+    neugamma: neugamma_grad,
+    gammalet: gammalet_grad,
+    neugammalet: neugammalet_grad,
+    DFE.PDFs.lognormal: lognormal_grad,
+    shifted_gamma: shifted_gamma_grad
+}
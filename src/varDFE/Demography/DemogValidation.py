@@ -73,6 +73,20 @@ class DemogValidation():
             raise IOError('Wrong demog_model for DFE_func_ex')
         return func_ex
 
+    def get_DFE_batch_func_ex(self, demog_model):
+        '''
+        Version of get_DFE_func_ex(demog_model) for a block of gammas, see Cache1D batch_func
+        '''
+        if demog_model == 'two_epoch':
+            func_ex = DemogSelModels2.two_epoch_gammas
+        elif demog_model == 'three_epoch':
+            func_ex = DemogSelModels2.three_epoch_gammas
+        elif demog_model == 'four_epoch':
+            func_ex = DemogSelModels2.four_epoch_gammas
+        else:
+            raise IOError('Wrong demog_model for DFE_batch_func_ex')
+        return func_ex
+
     def get_Demog_func_ex(self, demog_model):
         if demog_model == 'one_epoch':
             func_ex = Demographics1D.snm
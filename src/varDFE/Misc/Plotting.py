@@ -6,7 +6,7 @@ import dadi
 import pandas as pd
 import numpy as np
 import plotnine
-from plotnine import ggplot, aes, geom_col, theme, theme_bw, element_blank, facet_wrap, geom_tile, labs, geom_line, geom_point, scale_fill_gradientn
+from plotnine import ggplot, aes, geom_col, theme, theme_bw, element_blank, facet_wrap, geom_tile, labs, geom_line, geom_point, scale_fill_gradientn, scale_color_gradientn
 from dadi import Spectrum
 # supress plotnine future warnings
 import warnings
@@ -103,7 +103,8 @@ def ggplot_dfe_pdf(outprefix,pdf,params):
 
 def ggplot_gridsearch(outprefix, ll_griddf, ll_max):
     """
-    ll_griddf: pd.DataFrame object with columns `[var0,var1,ll_model]`
+    ll_griddf: pd.DataFrame object with columns `[var0,var1,ll_model]`,
+    and `level` for the adaptive grid search (plotted as points, not tiles)
     """
     # copy a plotdf
     plotdf = ll_griddf.__deepcopy__()
@@ -111,12 +112,20 @@ def ggplot_gridsearch(outprefix, ll_griddf, ll_max):
     # get maximum values
     bestdf = pd.DataFrame(data = [ll_max], columns=['var0','var1','ll_model'])
     plotdf.rename(columns = {plotdf.columns[0]: 'var0',plotdf.columns[1]: 'var1'}, inplace = True)
+    gradient = dict(colors = ["#606060","#FFFF00FF","#FF8000FF","#FF0000FF"],
+                    breaks = [-30,-100,-1000,-5000],limits = [-5000,-30],trans = 'pseudo_log')
+    # irregular adaptive grids can not be tiled
+    if 'level' in labls:
+        pp=(ggplot(plotdf,aes(x='var0',y='var1',color='ll_model'))+
+            geom_point(size = 1) +
+            scale_color_gradientn(**gradient))
+    else:
+        pp=(ggplot(plotdf,aes(x='var0',y='var1',fill='ll_model'))+
+            geom_tile()+
+            scale_fill_gradientn(**gradient))
     # better plotting
-    pp=(ggplot(plotdf,aes(x='var0',y='var1',fill='ll_model'))+
-        geom_tile()+
+    pp=(pp+
         geom_point(bestdf, shape = "o", size = 5, color = "blue", fill = "blue") +
-        scale_fill_gradientn(colors = ["#606060","#FFFF00FF","#FF8000FF","#FF0000FF"],
-            breaks = [-30,-100,-1000,-5000],limits = [-5000,-30],trans = 'pseudo_log') +
         labs(x=labls[0],y=labls[1])+
         theme_bw()+
         theme(legend_position='top',
@@ -0,0 +1,133 @@
+"""
+Tests of the reference spectra store in varDFE.DFE.Cache1D_io
+"""
+
+import json
+import os
+import pickle
+import time
+import numpy as np
+import pytest
+from dadi.DFE import PDFs
+
+from varDFE.DFE import Cache1D_io
+from varDFE.DFE.Cache1D_mod2 import Cache1D
+from test_cache1d_mod2 import make_cache, NEG_PDFS, THETA
+
+PARAMS = NEG_PDFS[0][1][0]
+
+def round_trip(cache, tmp_path, mmap_mode='r'):
+    header = str(tmp_path / 'spectra.json')
+    Cache1D_io.save_spectra(cache, header)
+    return Cache1D_io.load_spectra(header, mmap_mode=mmap_mode)
+
+@pytest.mark.parametrize('mmap_mode', ['r', None])
+def test_round_trip(tmp_path, mmap_mode):
+    cache = make_cache()
+    loaded = round_trip(cache, tmp_path, mmap_mode)
+    np.testing.assert_array_equal(loaded.gammas, cache.gammas)
+    np.testing.assert_array_equal(loaded.neg_gammas, cache.neg_gammas)
+    np.testing.assert_array_equal(loaded.spectra, cache.spectra)
+    assert not loaded.folded and loaded.spectra_dtype == 'float64'
+    np.testing.assert_array_equal(loaded.integrate(PARAMS, None, PDFs.gamma, THETA),
+                                  cache.integrate(PARAMS, None, PDFs.gamma, THETA))
+
+@pytest.mark.parametrize('fold, dtype', [(True, None), (False, 'float32'), (True, 'float32')])
+def test_round_trip_compact(tmp_path, fold, dtype):
+    cache = make_cache()
+    cache.compact(fold=fold, dtype=dtype)
+    loaded = round_trip(cache, tmp_path)
+    assert loaded.folded == fold
+    assert loaded.spectra.dtype == cache.spectra.dtype
+    assert loaded.neu_spec.folded == fold
+    np.testing.assert_array_equal(loaded.spectra, cache.spectra)
+    np.testing.assert_array_equal(loaded.integrate(PARAMS, None, PDFs.gamma, THETA),
+                                  cache.integrate(PARAMS, None, PDFs.gamma, THETA))
+
+@pytest.mark.parametrize('fold', [False, True])
+def test_round_trip_lowrank(tmp_path, fold):
+    cache = make_cache()
+    cache.compress(1e-3)
+    cache.compact(fold=fold)
+    loaded = round_trip(cache, tmp_path)
+    assert loaded.lowrank == cache.lowrank
+    assert os.path.isfile(Cache1D_io.factor_path(str(tmp_path / 'spectra.json')))
+    for left, right in zip(loaded.spectra_factors, cache.spectra_factors):
+        np.testing.assert_array_equal(left, right)
+    np.testing.assert_array_equal(loaded.integrate(PARAMS, None, PDFs.gamma, THETA),
+                                  cache.integrate(PARAMS, None, PDFs.gamma, THETA))
+
+def test_load_legacy_bpkl(tmp_path, monkeypatch):
+    cache = make_cache()
+    # attributes of a cache pickled before the quadrature, low-rank and folded options
+    legacy = {'params': cache.params, 'ns': cache.ns, 'pts_l': cache.pts_l, 'gammas': cache.gammas,
+              'neg_gammas': cache.neg_gammas, 'spectra': cache.spectra, 'neu_spec': cache.neu_spec}
+    monkeypatch.setattr(Cache1D, '__getstate__', lambda self: legacy)
+    bpkl = str(tmp_path / 'spectra.bpkl')
+    with open(bpkl, 'wb') as outf:
+        pickle.dump(cache, outf)
+    monkeypatch.undo()
+    loaded = Cache1D_io.load_spectra(bpkl)
+    assert loaded.quadrature == 'trapz' and loaded.lowrank is None and not loaded.folded
+    np.testing.assert_array_equal(loaded.spectra, cache.spectra)
+    np.testing.assert_allclose(loaded.integrate(PARAMS, None, PDFs.gamma, THETA),
+                               cache.integrate(PARAMS, None, PDFs.gamma, THETA), rtol=1e-12)
+
+def test_load_newer_version_fails(tmp_path):
+    header = str(tmp_path / 'spectra.json')
+    Cache1D_io.save_spectra(make_cache(), header)
+    with open(header) as inf:
+        settings = json.load(inf)
+    settings['version'] = Cache1D_io.FORMAT_VERSION + 1
+    with open(header, 'w') as outf:
+        json.dump(settings, outf)
+    with pytest.raises(IOError):
+        Cache1D_io.load_spectra(header)
+
+def make_entry(store, key, size):
+    entrydir = os.path.join(store, key)
+    os.makedirs(entrydir)
+    for name in [Cache1D_io.STORE_HEADER, 'spectra.npy']:
+        with open(os.path.join(entrydir, name), 'wb') as outf:
+            outf.write(b'0'*size)
+    return entrydir
+
+def test_evict_store_skips_temporary_dirs(tmp_path):
+    store = str(tmp_path)
+    old = make_entry(store, 'old', 100)
+    os.utime(os.path.join(old, Cache1D_io.STORE_HEADER), (0, 0))
+    new = make_entry(store, 'new', 100)
+    # entry of a concurrent writer before its rename, older than every entry
+    writing = make_entry(store, '.tmp-writing', 100)
+    os.utime(os.path.join(writing, Cache1D_io.STORE_HEADER), (0, 0))
+    Cache1D_io.evict_store(store, 300)
+    assert sorted(os.listdir(store)) == ['.tmp-writing', 'new']
+
+def test_evict_store_removes_stale_temporary_dirs(tmp_path):
+    store = str(tmp_path)
+    stale = make_entry(store, '.tmp-stale', 100)
+    os.utime(stale, (time.time() - 3600, time.time() - 3600))
+    make_entry(store, '.tmp-writing', 100)
+    Cache1D_io.evict_store(store, 10**6, stale_age=60)
+    assert os.listdir(store) == ['.tmp-writing']
+
+def test_load_spectra_for_projects(tmp_path):
+    cache = make_cache()
+    header = str(tmp_path / 'spectra.json')
+    Cache1D_io.save_spectra(cache, header)
+    data = cache.integrate(PARAMS, None, PDFs.gamma, THETA)
+    assert Cache1D_io.load_spectra_for(header, data).ns == cache.ns
+    projected = Cache1D_io.load_spectra_for(header, data.project([6]))
+    assert list(projected.ns) == [6]
+    np.testing.assert_allclose(projected.integrate(PARAMS, None, PDFs.gamma, THETA),
+                               cache.project([6]).integrate(PARAMS, None, PDFs.gamma, THETA), rtol=1e-12)
+
+def test_load_spectra_for_checks_folded(tmp_path):
+    cache = make_cache()
+    data = cache.integrate(PARAMS, None, PDFs.gamma, THETA)
+    cache.compact(fold=True)
+    header = str(tmp_path / 'spectra.json')
+    Cache1D_io.save_spectra(cache, header)
+    with pytest.raises(ValueError):
+        Cache1D_io.load_spectra_for(header, data)
+    assert Cache1D_io.load_spectra_for(header, data.fold().project([6])).folded
@@ -0,0 +1,295 @@
+"""
+Tests of the Cache1D in varDFE.DFE.Cache1D_mod2, on synthetic spectra
+"""
+
+import os
+import pickle
+import numpy as np
+import pytest
+from dadi import Spectrum
+from dadi.DFE import PDFs
+
+from varDFE.DFE import PDFs2, DemogSelModels2
+from varDFE.DFE.Cache1D_mod2 import Cache1D
+from varDFE.DFE.Cache1D_util import gamma_grid, positive_gammas, checkpoint_file, remove_checkpoint
+
+NS = 10
+THETA = 1000.
+
+def make_cache(seed=0, neg_pts=60, pos_pts=20):
+    """
+    Cache1D of random spectra, without solving any PDE.
+    """
+    rng = np.random.default_rng(seed)
+    neg_gammas = -gamma_grid((1e-4, 2000), neg_pts, descending=True)
+    gammas = np.concatenate((neg_gammas, gamma_grid((1e-4, 50), pos_pts)))
+    spectra = rng.random((len(gammas), NS+1))
+    return Cache1D.from_arrays([1.0, 1.0], [NS], [10], gammas, neg_gammas, spectra,
+                               Spectrum(rng.random(NS+1)))
+
+# small three_epoch caches, solving the PDE for every gamma
+DEMOG_PARAMS = [2.0, 0.5, 0.1, 0.05]
+PTS_L = [20, 24, 28]
+POS_GAMMAS = list(positive_gammas((1e-2, 10), 3))
+
+# gammas solved by counting_three_epoch
+SOLVED = []
+
+def counting_three_epoch(params, ns, pts):
+    SOLVED.append(float(params[-1]))
+    return DemogSelModels2.three_epoch(params, ns, pts)
+
+# gamma for which failing_three_epoch raises
+FAILING_GAMMA = float(POS_GAMMAS[1])
+
+def failing_three_epoch(params, ns, pts):
+    if params[-1] == FAILING_GAMMA:
+        raise FloatingPointError('no spectrum for this gamma')
+    return DemogSelModels2.three_epoch(params, ns, pts)
+
+def solve_cache(gamma_bounds=(1e-2, 100), gamma_pts=8, demo_sel_func=DemogSelModels2.three_epoch, **kwargs):
+    return Cache1D(DEMOG_PARAMS, [NS], demo_sel_func, PTS_L, gamma_bounds=gamma_bounds,
+                   gamma_pts=gamma_pts, additional_gammas=POS_GAMMAS, **kwargs)
+
+# [sel_dist, params of three DFEs]
+NEG_PDFS = [
+    (PDFs.gamma, [[0.2, 400.0], [0.3, 1000.0], [1.0, 10.0]]),
+    (PDFs2.neugamma, [[0.1, 0.2, 400.0], [0.2, 0.3, 1000.0], [0.0, 1.0, 10.0]]),
+    (PDFs2.neugammalet, [[0.1, 0.1, 0.2, 400.0], [0.05, 0.2, 0.3, 1000.0], [0.0, 0.0, 1.0, 10.0]]),
+    (PDFs.lognormal, [[1.0, 1.0], [2.0, 0.5], [-1.0, 2.0]]),
+]
+
+POS_PDFS = [
+    (PDFs2.lourenco_eq_pdf, [[0.5, 0.1, 2400, 4000], [2.0, 0.05, 1000, 5000]]),
+    (PDFs2.shifted_gamma, [[0.5, 0.2, 400.0], [1.0, 0.3, 100.0]]),
+]
+
+# every PDF with a registered CDF, [sel_dist, params of three DFEs, negative gammas only]
+CDF_PDFS = NEG_PDFS + [
+    (PDFs2.gammalet, [[0.1, 0.2, 400.0], [0.3, 0.3, 1000.0], [0.0, 1.0, 10.0]]),
+]
+
+@pytest.mark.parametrize('sel_dist, params_matrix', CDF_PDFS)
+def test_exterior_weights_cdf_matches_quad(sel_dist, params_matrix):
+    assert sel_dist in PDFs2.cdf_functions
+    # not registered, so integrated with quad
+    def quad_sel_dist(xx, params):
+        return sel_dist(xx, params)
+    cache = make_cache()
+    # quad only reaches ~1e-11 absolute for the far tails
+    for params in params_matrix:
+        np.testing.assert_allclose(cache._exterior_weights(params, sel_dist),
+                                   cache._exterior_weights(params, quad_sel_dist), rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(cache._exterior_weights_batch(np.array(params_matrix), sel_dist),
+                               cache._exterior_weights_batch(np.array(params_matrix), quad_sel_dist),
+                               rtol=1e-10, atol=1e-10)
+
+@pytest.mark.parametrize('sel_dist, params_matrix', [POS_PDFS[1]])
+def test_exterior_weights_pos_cdf_matches_quad(sel_dist, params_matrix):
+    assert sel_dist in PDFs2.cdf_functions
+    def quad_sel_dist(xx, params):
+        return sel_dist(xx, params)
+    cache = make_cache()
+    np.testing.assert_allclose(cache._exterior_weights_pos_batch(np.array(params_matrix), sel_dist),
+                               cache._exterior_weights_pos_batch(np.array(params_matrix), quad_sel_dist),
+                               rtol=1e-10, atol=1e-10)
+
+@pytest.mark.parametrize('exterior_int', [True, False])
+@pytest.mark.parametrize('sel_dist, params_matrix', NEG_PDFS)
+def test_integrate_batch_matches_integrate(sel_dist, params_matrix, exterior_int):
+    cache = make_cache()
+    expected = [cache.integrate_array(params, None, sel_dist, THETA, exterior_int=exterior_int)
+                for params in params_matrix]
+    models = cache.integrate_batch(np.array(params_matrix), sel_dist, THETA, exterior_int=exterior_int)
+    np.testing.assert_allclose(models, expected, rtol=1e-12)
+
+@pytest.mark.parametrize('sel_dist, params_matrix', POS_PDFS)
+def test_integrate_continuous_pos_batch_matches(sel_dist, params_matrix):
+    cache = make_cache()
+    expected = [cache.integrate_continuous_pos_array(params, None, sel_dist, THETA)
+                for params in params_matrix]
+    models = cache.integrate_continuous_pos_batch(np.array(params_matrix), sel_dist, THETA)
+    np.testing.assert_allclose(models, expected, rtol=1e-12)
+
+def test_integrate_batch_no_broadcast():
+    # a sel_dist that only takes one parameter set is called row by row
+    def sel_dist(xx, params):
+        alpha, beta = [float(pp) for pp in params]
+        return PDFs.gamma(xx, (alpha, beta))
+    cache = make_cache()
+    params_matrix = np.array(NEG_PDFS[0][1])
+    np.testing.assert_allclose(cache.integrate_batch(params_matrix, sel_dist, THETA),
+                               cache.integrate_batch(params_matrix, PDFs.gamma, THETA), rtol=1e-6)
+
+def test_project_matches_spectrum_project():
+    cache = make_cache()
+    projected = cache.project([6])
+    params = NEG_PDFS[0][1][0]
+    expected = cache.integrate(params, None, PDFs.gamma, THETA).project([6])
+    np.testing.assert_allclose(projected.integrate(params, None, PDFs.gamma, THETA), expected, rtol=1e-10)
+
+def test_pickle_drops_projections():
+    cache = make_cache()
+    cache.project([6])
+    assert '_projections' not in cache.__getstate__()
+    assert pickle.loads(pickle.dumps(cache)).project([6]).ns == [6]
+
+def test_integrate_matches_trapz():
+    # dadi's Cache1D.integrate: np.trapz of the weighted spectra plus the exterior weights
+    cache = make_cache()
+    params = NEG_PDFS[0][1][0]
+    weights = PDFs.gamma(-cache.neg_gammas, params)
+    trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+    fs = trapezoid(weights[:,np.newaxis]*cache.spectra[:len(cache.neg_gammas)], cache.neg_gammas, axis=0)
+    weight_neu, weight_del = cache._exterior_weights(params, PDFs.gamma)
+    fs += cache.neu_spec.data*weight_neu + cache.spectra[0]*weight_del
+    np.testing.assert_allclose(cache.integrate_array(params, None, PDFs.gamma, THETA), THETA*fs, rtol=1e-12)
+
+def test_folded_cache_checks_data():
+    cache = make_cache()
+    params = NEG_PDFS[0][1][0]
+    unfolded = cache.integrate(params, None, PDFs.gamma, THETA)
+    cache.compact(fold=True, dtype='float32')
+    folded = cache.integrate(params, None, PDFs.gamma, THETA)
+    np.testing.assert_allclose(folded, unfolded.fold(), rtol=1e-6)
+    for integrate_array in [cache.integrate_array, cache.integrate_continuous_pos_array]:
+        with pytest.raises(ValueError):
+            integrate_array(params, None, PDFs.gamma, THETA, data=unfolded)
+        with pytest.raises(ValueError):
+            integrate_array(params, [NS-2], PDFs.gamma, THETA)
+        integrate_array(params, [NS], PDFs.gamma, THETA, data=unfolded.fold())
+    with pytest.raises(ValueError):
+        cache.integrate_batch([params], PDFs.gamma, THETA, data=unfolded)
+
+@pytest.mark.parametrize('scale_pos', [False, True])
+def test_integrate_point_pos_theta(scale_pos):
+    cache = make_cache()
+    params = NEG_PDFS[0][1][0]
+    gammapos = cache.gammas[-5]
+    model = cache.integrate_point_pos(list(params) + [0.1, gammapos], None, PDFs.gamma, THETA,
+                                      scale_pos=scale_pos)
+    # the cached spectra are for theta=1, only scaled with scale_pos
+    pos = THETA*cache.spectra[-5] if scale_pos else cache.spectra[-5]
+    expected = 0.9*cache.integrate(params, None, PDFs.gamma, THETA) + 0.1*Spectrum(pos)
+    np.testing.assert_allclose(model, expected, rtol=1e-12)
+
+@pytest.mark.parametrize('additional_gammas', [[0.0, 1.0], [-1.0, 1.0], [10.0, 1.0], [1.0, 1.0]])
+def test_bad_gammas_fail_before_computing(additional_gammas):
+    def demo_sel_func(params, ns, pts):
+        raise AssertionError('no spectrum should be computed')
+    with pytest.raises(ValueError):
+        Cache1D([1.0, 1.0], [NS], demo_sel_func, [10], gamma_pts=10, additional_gammas=additional_gammas)
+
+def test_extend_bad_gammas_fail_before_computing():
+    cache = make_cache()
+    def demo_sel_func(params, ns, pts):
+        raise AssertionError('no spectrum should be computed')
+    cache.demo_sel_func = demo_sel_func
+    with pytest.raises(ValueError):
+        cache.extend((1e-4, 2000), 60, additional_gammas=[0.0])
+
+def test_checkpoint_resumes(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    SOLVED.clear()
+    full = solve_cache(demo_sel_func=counting_three_epoch, checkpoint=checkpoint)
+    assert set(SOLVED) == set(full.gammas) | {0.0}
+    # a killed run: the neutral spectrum and two gammas were not saved yet
+    missing = [full.gammas[1], full.gammas[-1]]
+    for gamma in missing + [0.0]:
+        os.remove(checkpoint_file(checkpoint, gamma))
+    SOLVED.clear()
+    resumed = solve_cache(demo_sel_func=counting_three_epoch, checkpoint=checkpoint)
+    assert sorted(set(SOLVED)) == sorted(missing + [0.0])
+    np.testing.assert_array_equal(resumed.spectra, full.spectra)
+    np.testing.assert_array_equal(resumed.neu_spec, full.neu_spec)
+    # nothing left to compute
+    SOLVED.clear()
+    solve_cache(demo_sel_func=counting_three_epoch, checkpoint=checkpoint)
+    assert SOLVED == []
+
+def test_checkpoint_other_settings_fail(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    solve_cache(gamma_pts=3, checkpoint=checkpoint)
+    with pytest.raises(IOError):
+        Cache1D([1.0, 0.5, 0.1, 0.05], [NS], DemogSelModels2.three_epoch, PTS_L, gamma_bounds=(1e-2, 100),
+                gamma_pts=3, checkpoint=checkpoint)
+
+def test_remove_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    solve_cache(gamma_pts=3, checkpoint=checkpoint)
+    assert remove_checkpoint(checkpoint)
+    assert not os.path.exists(checkpoint)
+    # only checkpoint directories are removed
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'spectra.npy').write_bytes(b'0')
+    assert not remove_checkpoint(str(other))
+    assert not remove_checkpoint(checkpoint)
+    assert os.listdir(other) == ['spectra.npy']
+
+@pytest.mark.parametrize('batch_func', [None, DemogSelModels2.three_epoch_gammas])
+def test_multiple_processes_match_single_process(batch_func):
+    single = solve_cache()
+    multiple = solve_cache(mp=True, cpus=2, batch_func=batch_func, batch_size=3)
+    np.testing.assert_array_equal(multiple.gammas, single.gammas)
+    np.testing.assert_array_equal(multiple.spectra, single.spectra)
+    np.testing.assert_array_equal(multiple.neu_spec, single.neu_spec)
+
+def test_multiple_processes_report_failed_gamma(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    with pytest.raises(RuntimeError, match=r'1 gammas: \[{0!r}\]'.format(FAILING_GAMMA)):
+        solve_cache(demo_sel_func=failing_three_epoch, mp=True, cpus=2, checkpoint=checkpoint)
+    # the other gammas are kept for the rerun
+    for gamma in POS_GAMMAS:
+        assert os.path.isfile(checkpoint_file(checkpoint, gamma)) == (gamma != FAILING_GAMMA)
+
+def test_extend_nested_grid_matches_full_build():
+    full_pos = list(positive_gammas((1e-2, 10), 5))
+    full = Cache1D(DEMOG_PARAMS, [NS], DemogSelModels2.three_epoch, PTS_L, gamma_bounds=(1e-2, 100),
+                   gamma_pts=9, additional_gammas=full_pos)
+    cache = solve_cache(gamma_pts=5)
+    SOLVED.clear()
+    cache.demo_sel_func = counting_three_epoch
+    cache.extend((1e-2, 100), 9, additional_gammas=full_pos)
+    # only the gammas between the cached ones are solved
+    assert len(set(SOLVED)) == (9 - 5) + (5 - 3)
+    np.testing.assert_allclose(cache.gammas, full.gammas, rtol=1e-12)
+    np.testing.assert_allclose(cache.neg_gammas, full.neg_gammas, rtol=1e-12)
+    np.testing.assert_allclose(cache.spectra, full.spectra, rtol=1e-10)
+    for sel_dist, params_matrix in NEG_PDFS:
+        np.testing.assert_allclose(cache.integrate(params_matrix[0], None, sel_dist, THETA),
+                                   full.integrate(params_matrix[0], None, sel_dist, THETA), rtol=1e-10)
+
+# the 5+3 gammas have 6 intervals, each round bisects all of them
+@pytest.mark.parametrize('max_pts, max_rounds, npts, nrounds',
+                         [(20, None, 20, 2), (None, 2, 26, 2), (30, 1, 14, 1), (8, None, 8, 0)])
+def test_refine_limits(max_pts, max_rounds, npts, nrounds):
+    cache = solve_cache(gamma_pts=5)
+    # every interval is coarser than the tolerance, until min_step
+    cache.refine(1e-12, max_pts=max_pts, max_step=None, min_step=0.05, max_rounds=max_rounds)
+    assert len(cache.gammas) == npts
+    assert cache.refinement['rounds'] == nrounds
+    assert cache.refinement['max_pts'] == max_pts and cache.refinement['max_rounds'] == max_rounds
+    cache._check_gammas(cache.neg_gammas, cache.gammas[len(cache.neg_gammas):])
+
+def test_integrate_memo_counts_and_evicts():
+    cache = make_cache()
+    cache.integrate_memo_size = 3
+    params_matrix = NEG_PDFS[0][1]
+    models = [cache.integrate_array(params, None, PDFs.gamma, THETA) for params in params_matrix]
+    assert cache.integrate_memo_info() == {'hits': 0, 'misses': 3, 'maxsize': 3, 'currsize': 3}
+    # hits return copies of the same spectra
+    model = cache.integrate_array(params_matrix[0], None, PDFs.gamma, THETA)
+    np.testing.assert_array_equal(model, models[0])
+    model[:] = 0
+    np.testing.assert_array_equal(cache.integrate_array(params_matrix[0], None, PDFs.gamma, THETA), models[0])
+    assert cache.integrate_memo_info() == {'hits': 2, 'misses': 3, 'maxsize': 3, 'currsize': 3}
+    # theta and exterior_int are part of the key; params_matrix[1] is the least recently used
+    cache.integrate_array(params_matrix[0], None, PDFs.gamma, 2*THETA)
+    assert cache.integrate_memo_info()['currsize'] == 3
+    cache.integrate_array(params_matrix[2], None, PDFs.gamma, THETA)
+    cache.integrate_array(params_matrix[1], None, PDFs.gamma, THETA)
+    assert cache.integrate_memo_info() == {'hits': 3, 'misses': 5, 'maxsize': 3, 'currsize': 3}
+    # new quadrature weights reset the memo
+    cache.compact(dtype='float32')
+    assert cache.integrate_memo_info() == {'hits': 0, 'misses': 0, 'maxsize': 3, 'currsize': 0}
@@ -0,0 +1,99 @@
+"""
+Tests of the utilities in varDFE.DFE.Cache1D_util
+"""
+
+import numpy as np
+import scipy.integrate
+import scipy.stats
+import pytest
+from dadi import Inference, Spectrum
+
+from varDFE.DFE import Cache1D_util
+
+@pytest.mark.parametrize('n_from, n_to', [(20, 10), (21, 8), (10, 10), (30, 1)])
+def test_projection_matrix_matches_project(n_from, n_to):
+    rng = np.random.default_rng(n_from)
+    fs = Spectrum(rng.random(n_from+1))
+    expected = fs.project([n_to])
+    projected = np.dot(fs.data, Cache1D_util.projection_matrix(n_from, n_to))
+    np.testing.assert_allclose(projected, expected.data, rtol=1e-10)
+
+def make_data(n, folded, mask_singletons, seed=0):
+    rng = np.random.default_rng(seed)
+    data = Spectrum(rng.poisson(50, n+1).astype(float))
+    if mask_singletons:
+        data.mask[[1, n-1]] = True
+    return data.fold() if folded else data
+
+def make_models(n, seed=1):
+    rng = np.random.default_rng(seed)
+    models = rng.random((4, n+1))*100
+    # bins with a zero model are left out of the likelihood, as in dadi
+    models[1, 3] = 0
+    models[2, [2, n-2]] = 0
+    models[3, n//2] = 0
+    return models
+
+@pytest.mark.parametrize('n', [10, 11])
+@pytest.mark.parametrize('folded', [False, True])
+@pytest.mark.parametrize('mask_singletons', [False, True])
+def test_poisson_ll_matches_dadi(n, folded, mask_singletons):
+    data = make_data(n, folded, mask_singletons)
+    models = make_models(n)
+    # model spectra from Cache1D have their corners masked
+    expected = [Inference.ll(Spectrum(model), data) for model in models]
+    poisson_ll = Cache1D_util.PoissonLL(data)
+    for model, ll in zip(models, expected):
+        assert poisson_ll(model) == pytest.approx(ll, rel=1e-12)
+    np.testing.assert_allclose(Cache1D_util.batch_ll(models, data), expected, rtol=1e-12)
+    np.testing.assert_allclose(Cache1D_util.batch_ll(models, poisson_ll), expected, rtol=1e-12)
+
+@pytest.mark.parametrize('folded', [False, True])
+def test_ll_grad_matches_finite_differences(folded):
+    n = 10
+    data = make_data(n, folded, True)
+    base, direction = make_models(n)[[0, 2]]
+    def model(tt):
+        return base + tt*direction
+    ll, grad = Cache1D_util.ll_grad(model(0.), direction[np.newaxis], data)
+    step = 1e-6
+    poisson_ll = Cache1D_util.PoissonLL(data)
+    assert ll == pytest.approx(poisson_ll(model(0.)), rel=1e-12)
+    assert grad[0] == pytest.approx((poisson_ll(model(step)) - poisson_ll(model(-step)))/(2*step), rel=1e-5)
+
+# np.trapz is np.trapezoid in numpy >= 2
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+@pytest.mark.parametrize('sign', [-1, 1])
+def test_trapz_weights_match_trapz(sign):
+    rng = np.random.default_rng(2)
+    xx = sign*Cache1D_util.gamma_grid((1e-4, 2000), 50, descending=(sign < 0))
+    yy = rng.random((len(xx), 7))
+    weights = Cache1D_util.quad_weights(xx, 'trapz')
+    np.testing.assert_allclose(np.dot(weights, yy), trapezoid(yy, xx, axis=0), rtol=1e-12)
+
+def test_simpson_weights_match_simpson():
+    rng = np.random.default_rng(3)
+    xx = -Cache1D_util.gamma_grid((1e-4, 2000), 51, descending=True)
+    yy = rng.random((len(xx), 7))
+    weights = Cache1D_util.quad_weights(xx, 'simpson')
+    # Simpson's rule in log(|gamma|), d(gamma) = |gamma| d(log(|gamma|))
+    uu = np.log(np.abs(xx))
+    expected = scipy.integrate.simpson(yy*np.abs(xx)[:,np.newaxis], x=uu, axis=0)
+    np.testing.assert_allclose(np.dot(weights, yy), -expected, rtol=1e-10)
+
+@pytest.mark.parametrize('quadrature', ['simpson', 'gauss'])
+def test_quad_weights_integrate_gamma_pdf(quadrature):
+    # a smooth DFE integrates over the grid with far fewer points than trapz
+    xx = Cache1D_util.gamma_grid((1e-4, 2000), 60, quadrature)
+    pdf = scipy.stats.gamma.pdf(xx, 0.3, scale=50)
+    expected = scipy.stats.gamma.cdf(2000, 0.3, scale=50) - scipy.stats.gamma.cdf(1e-4, 0.3, scale=50)
+    assert np.dot(Cache1D_util.quad_weights(xx, quadrature), pdf) == pytest.approx(expected, rel=1e-4)
+
+@pytest.mark.parametrize('n', [10, 11])
+def test_fold_data_matches_fold(n):
+    rng = np.random.default_rng(n)
+    data = rng.random((3, n+1))
+    expected = [Spectrum(row).fold().data[:n//2+1] for row in data]
+    np.testing.assert_allclose(Cache1D_util.fold_data(data, n), expected, rtol=1e-12)
+    np.testing.assert_allclose(np.dot(data, Cache1D_util.fold_matrix(n))[:,:n//2+1], expected, rtol=1e-12)
@@ -0,0 +1,38 @@
+"""
+Tests of the block of gammas models in varDFE.DFE.DemogSelModels2 against the
+single gamma models
+"""
+
+import numpy as np
+import pytest
+from dadi.DFE import DemogSelModels
+
+from varDFE.DFE import DemogSelModels2
+
+NS = [10]
+# drift dominated gammas share a time step, the strongly selected ones do not
+GAMMAS = np.array([-500., -150., -20., -1., -1e-3, 0., 1e-3, 1., 20., 100.])
+
+# dadi renamed two_epoch to two_epoch_sel
+two_epoch = getattr(DemogSelModels, 'two_epoch', None) or DemogSelModels.two_epoch_sel
+
+# [block model, single gamma model, demographic params]
+MODELS = [
+    (DemogSelModels2.two_epoch_gammas, two_epoch, [2.0, 0.1]),
+    (DemogSelModels2.three_epoch_gammas, DemogSelModels2.three_epoch, [2.0, 0.5, 0.1, 0.05]),
+    (DemogSelModels2.four_epoch_gammas, DemogSelModels2.four_epoch, [0.2, 3.0, 1.5, 0.05, 0.1, 0.02]),
+]
+
+@pytest.mark.parametrize('pts', [30, 41])
+@pytest.mark.parametrize('batch_func, func, params', MODELS)
+def test_gammas_match_single_gamma(batch_func, func, params, pts):
+    spectra = batch_func(params + [GAMMAS], NS, pts)
+    assert spectra.shape == (len(GAMMAS), NS[0]+1)
+    for gamma, sfs in zip(GAMMAS, spectra):
+        np.testing.assert_array_equal(sfs, func(params + [gamma], NS, pts).data)
+
+@pytest.mark.parametrize('batch_func, func, params', MODELS)
+def test_gammas_order_does_not_matter(batch_func, func, params):
+    order = np.random.default_rng(0).permutation(len(GAMMAS))
+    spectra = batch_func(params + [GAMMAS], NS, 30)
+    np.testing.assert_array_equal(batch_func(params + [GAMMAS[order]], NS, 30), spectra[order])
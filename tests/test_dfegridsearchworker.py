@@ -0,0 +1,93 @@
+"""
+Tests of the grid search in varDFE.DFE.DFEGridsearchWorker, on an analytic likelihood surface
+"""
+
+import itertools
+import multiprocessing
+import numpy as np
+import pytest
+from dadi import Spectrum
+from dadi.DFE import PDFs
+
+from varDFE.DFE import DFEGridsearchWorker
+from test_cache1d_mod2 import make_cache, THETA
+
+# maximum of the analytic surface, inside the bounds below
+P_MAX = np.array([0.37, 420.0])
+LOWER, UPPER = [0.01, 10.0], [2.0, 1e5]
+
+def analytic_batch(params_matrix, sel_dist, theta, data):
+    # quadratic in (param, log(param)), nan on one corner of the grid
+    xx = np.column_stack((params_matrix[:,0], np.log(params_matrix[:,1])))
+    center = np.array([P_MAX[0], np.log(P_MAX[1])])
+    ll = -1000.*np.sum((xx - center)**2, axis=1)
+    ll[np.all(np.isclose(params_matrix, [LOWER[0], UPPER[1]]), axis=1)] = np.nan
+    return ll
+
+@pytest.fixture
+def analytic_inputs(monkeypatch):
+    monkeypatch.setattr(DFEGridsearchWorker, 'gridsearch_inputs', (analytic_batch, None, 1., None, None))
+
+def test_grid_points_order():
+    axes = DFEGridsearchWorker.grid_axes([0., 1.], [1., 100.], [3, 4], [False, True])
+    np.testing.assert_allclose(axes[1], [1., 10**(2/3), 10**(4/3), 100.])
+    expected = np.array(list(itertools.product(*axes)))
+    np.testing.assert_allclose(DFEGridsearchWorker.grid_points(axes, 0, 12), expected)
+    np.testing.assert_allclose(DFEGridsearchWorker.grid_points(axes, 5, 9), expected[5:9])
+
+def test_adaptive_gridsearch_finds_maximum(analytic_inputs):
+    ll_grid = DFEGridsearchWorker.adaptive_gridsearch(
+        map, LOWER, UPPER, Npts=9, levels=3, lldrop=100., fine=5, nchunks=3, log_axes=[False, True])
+    assert ll_grid.shape[1] == 4
+    # every point is evaluated once, and the nan corner does not win
+    assert len(np.unique(ll_grid[:,:2], axis=0)) == len(ll_grid)
+    assert np.any(np.isnan(ll_grid[:,2]))
+    best = ll_grid[np.nanargmax(ll_grid[:,2])]
+    # the finest lattice is (UPPER-LOWER)/(8*27*5) apart
+    assert best[0] == pytest.approx(P_MAX[0], abs=(UPPER[0]-LOWER[0])/(8*27*5))
+    assert np.log(best[1]) == pytest.approx(np.log(P_MAX[1]), abs=np.log(UPPER[1]/LOWER[1])/(8*27*5))
+    # far fewer points than the uniform grid of the same resolution
+    assert len(ll_grid) < (8*27*5+1)**2/100
+
+def test_adaptive_gridsearch_fixed_parameter(analytic_inputs):
+    ll_grid = DFEGridsearchWorker.adaptive_gridsearch(
+        map, [0.2, 10.0], [2.0, 1e5], Npts=[1, 9], levels=2, log_axes=[False, True])
+    assert np.all(ll_grid[:,0] == 0.2)
+
+class ReversedPool:
+    """
+    Pool whose imap_unordered returns the chunks last first.
+    """
+    def imap_unordered(self, func, iterable):
+        return map(func, reversed(list(iterable)))
+
+def test_stream_gridsearch_matches_batch(tmp_path, monkeypatch):
+    cache = make_cache()
+    data = Spectrum(cache.integrate_array([0.3, 500.0], None, PDFs.gamma, THETA))
+    axes = DFEGridsearchWorker.grid_axes([0.05, 50.0], [1.0, 5000.0], [6, 7], [False, True])
+    points = DFEGridsearchWorker.grid_points(axes, 0, 42)
+    expected = np.column_stack((points, cache.integrate_batch(points, PDFs.gamma, THETA, data=data)))
+    # init_worker in this process for ReversedPool
+    monkeypatch.setattr(DFEGridsearchWorker, 'gridsearch_inputs', None)
+    initargs = (cache, PDFs.gamma, THETA, data, 'integrate', axes)
+    DFEGridsearchWorker.init_worker(*initargs)
+    ll_grid, best = DFEGridsearchWorker.stream_gridsearch(ReversedPool(), axes, str(tmp_path / 'reversed.npy'), chunk_size=5)
+    np.testing.assert_array_equal(ll_grid, expected)
+    np.testing.assert_array_equal(best, expected[np.argmax(expected[:,-1])])
+    with multiprocessing.Pool(processes=2, initializer=DFEGridsearchWorker.init_worker, initargs=initargs) as pool:
+        ll_grid, best = DFEGridsearchWorker.stream_gridsearch(pool, axes, str(tmp_path / 'pool.npy'), chunk_size=4)
+    np.testing.assert_array_equal(ll_grid, expected)
+    np.testing.assert_array_equal(np.load(str(tmp_path / 'pool.npy')), expected)
+    np.testing.assert_array_equal(best, expected[np.argmax(expected[:,-1])])
+
+def test_stream_gridsearch_ties(tmp_path, monkeypatch):
+    # steps of the analytic surface, so the maximum is shared by several rows
+    def step_batch(params_matrix, sel_dist, theta, data):
+        return np.floor(analytic_batch(params_matrix, sel_dist, theta, data)/500.)
+    axes = DFEGridsearchWorker.grid_axes(LOWER, UPPER, [9, 9], [False, True])
+    monkeypatch.setattr(DFEGridsearchWorker, 'gridsearch_inputs', (step_batch, None, 1., None, axes))
+    expected = DFEGridsearchWorker.DFEGridsearchWorker(DFEGridsearchWorker.grid_points(axes, 0, 81))
+    ll_grid, best = DFEGridsearchWorker.stream_gridsearch(ReversedPool(), axes, str(tmp_path / 'll.npy'), chunk_size=10)
+    np.testing.assert_array_equal(ll_grid, expected)
+    assert np.sum(expected[:,-1] == np.nanmax(expected[:,-1])) > 1
+    np.testing.assert_array_equal(best, expected[np.nanargmax(expected[:,-1])])
@@ -0,0 +1,90 @@
+"""
+Tests of the optimizers in varDFE.DFE.Inference2, on synthetic spectra
+"""
+
+import numpy as np
+import pytest
+import scipy.optimize
+from dadi import Spectrum
+from dadi.DFE import PDFs
+
+from varDFE.DFE import Inference2
+from test_cache1d_mod2 import make_cache, THETA
+
+P_TRUE = [0.3, 500.0]
+
+def make_data(cache):
+    return Spectrum(cache.integrate_array(P_TRUE, None, PDFs.gamma, THETA))
+
+def abnormal_result(fun, x0, **kwargs):
+    return scipy.optimize.OptimizeResult(x=x0, fun=1.0, success=False, status=2,
+                                         message='ABNORMAL_TERMINATION_IN_LNSRCH')
+
+def test_lbfgsb_fallback_uses_plain_model(monkeypatch):
+    cache = make_cache()
+    data = make_data(cache)
+    monkeypatch.setattr(scipy.optimize, 'minimize', abnormal_result)
+    calls = {'jac': 0, 'array': 0}
+    integrate_jac, integrate_array = cache.integrate_jac, cache.integrate_array
+    def count_jac(*args, **kwargs):
+        calls['jac'] += 1
+        return integrate_jac(*args, **kwargs)
+    count_jac.__self__, count_jac.__name__ = cache, 'integrate_jac'
+    def count_array(*args, **kwargs):
+        calls['array'] += 1
+        return integrate_array(*args, **kwargs)
+    monkeypatch.setattr(cache, 'integrate_array', count_array)
+    popt = Inference2.optimize_log_lbfgsb_jac([0.2, 1000.0], data, count_jac, None,
+                                              lower_bound=[1e-3, 1e-2], upper_bound=[2.0, 1e6],
+                                              func_args=[PDFs.gamma, THETA], maxiter=50)
+    # only p0 goes through the Jacobian, BFGS uses the plain model
+    assert calls['jac'] == 1
+    assert calls['array'] > 1
+    assert len(popt) == 2
+
+def test_lbfgsb_maxiter_does_not_fall_back(monkeypatch):
+    cache = make_cache()
+    data = make_data(cache)
+    def no_fallback(*args, **kwargs):
+        raise AssertionError('optimize should not run')
+    monkeypatch.setattr(Inference2, 'optimize', no_fallback)
+    popt = Inference2.optimize_log_lbfgsb_jac([0.2, 1000.0], data, cache.integrate_jac, None,
+                                              lower_bound=[1e-3, 1e-2], upper_bound=[2.0, 1e6],
+                                              func_args=[PDFs.gamma, THETA], maxiter=1)
+    assert np.all(np.isfinite(popt))
+
+def test_plain_model_func():
+    cache = make_cache()
+    assert Inference2._plain_model_func(cache.integrate_jac) == cache.integrate_array
+    assert Inference2._plain_model_func(cache.integrate_continuous_pos_jac) == cache.integrate_continuous_pos_array
+
+def test_folded_cache_needs_folded_data():
+    cache = make_cache()
+    data = make_data(cache)
+    cache.compact(fold=True)
+    with pytest.raises(ValueError):
+        Inference2.optimize_log([0.2, 1000.0], data, cache.integrate_array, None,
+                                func_args=[PDFs.gamma, THETA], maxiter=1)
+    with pytest.raises(ValueError):
+        Inference2.FIM_uncert(cache.integrate_array, [], np.array(P_TRUE), data)
+
+@pytest.mark.parametrize('log', [False, True])
+def test_lbfgsb_avoids_nan_region(monkeypatch, log):
+    cache = make_cache()
+    data = make_data(cache)
+    def no_fallback(*args, **kwargs):
+        raise AssertionError('optimize should not run')
+    monkeypatch.setattr(Inference2, 'optimize', no_fallback)
+    # the model is NaN for alpha > 1, e.g. a PDF that fails outside its domain
+    def nan_jac(params, ns, sel_dist, theta, pts=None):
+        model, jac = cache.integrate_jac(params, ns, sel_dist, theta)
+        if params[0] > 1:
+            return model*np.nan, jac*np.nan
+        return model, jac
+    optimizer = Inference2.optimize_log_lbfgsb_jac if log else Inference2.optimize_lbfgsb_jac
+    kwargs = dict(lower_bound=[1e-3, 1e-2], upper_bound=[2.0, 1e6], func_args=[PDFs.gamma, THETA], maxiter=200)
+    popt = optimizer([0.2, 1000.0], data, nan_jac, None, **kwargs)
+    # same fit as without the NaN region, the LL of NaN models is not taken as the optimum
+    np.testing.assert_allclose(popt, optimizer([0.2, 1000.0], data, cache.integrate_jac, None, **kwargs), rtol=1e-3)
+    if log:
+        np.testing.assert_allclose(popt, P_TRUE, rtol=1e-3)
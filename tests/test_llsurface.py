@@ -0,0 +1,117 @@
+"""
+Tests of the likelihood surface queries in varDFE.DFE.LLSurface, on an analytic surface
+"""
+
+import numpy as np
+import pytest
+import scipy.stats
+
+from varDFE.DFE import LLSurface, DFEGridsearchWorker
+
+# gaussian LL in (pneu, log(scale)), the shape is fixed
+PDFVARS = ['pneu', 'shape', 'scale']
+CENTER, SIGMA = [0.3, np.log(400.)], [0.05, 0.2]
+
+def make_surface(slab_size=None, nan_rows=50):
+    axes = DFEGridsearchWorker.grid_axes([0.0, 0.2, 40.], [1.0, 0.2, 4000.], [101, 1, 81], [False, False, True])
+    points = DFEGridsearchWorker.grid_points(axes, 0, 101*81)
+    zz = [(points[:,0] - CENTER[0])/SIGMA[0], (np.log(points[:,2]) - CENTER[1])/SIGMA[1]]
+    ll = -0.5*(zz[0]**2 + zz[1]**2) - 100.
+    # an interrupted grid search leaves nan rows
+    ll[len(ll)-nan_rows:] = np.nan
+    surface = LLSurface.LLSurface(ll, axes, PDFVARS, log_axes=[False, False, True], pdfname='neugamma')
+    if slab_size is not None:
+        surface.slab_size = slab_size
+    return surface, axes, points, ll
+
+@pytest.mark.parametrize('slab_size', [None, 500])
+def test_profile_and_mle(slab_size):
+    surface, axes, points, ll = make_surface(slab_size)
+    params, ll_max = surface.mle()
+    assert ll_max == np.nanmax(ll)
+    np.testing.assert_allclose(params, points[np.nanargmax(ll)])
+    values, profile = surface.profile('pneu')
+    expected = np.nanmax(ll.reshape(101, 81), axis=1)
+    np.testing.assert_allclose(values, axes[0])
+    np.testing.assert_allclose(profile, expected)
+    np.testing.assert_allclose(surface.profile_ll(['pneu', 'scale']), ll.reshape(101, 81))
+    with pytest.raises(ValueError):
+        surface.profile('shape')
+
+def test_confidence_interval():
+    surface = make_surface()[0]
+    # the gaussian LL gives the normal interval
+    half = np.sqrt(scipy.stats.chi2.ppf(0.95, 1))
+    ci = surface.confidence_interval('pneu')
+    assert ci['mle'] == pytest.approx(CENTER[0])
+    assert ci['lower'] == pytest.approx(CENTER[0] - half*SIGMA[0], abs=2e-3)
+    assert ci['upper'] == pytest.approx(CENTER[0] + half*SIGMA[0], abs=2e-3)
+    assert not ci['lower_at_edge'] and not ci['upper_at_edge']
+    ci = surface.confidence_interval('scale')
+    assert np.log(ci['lower']) == pytest.approx(CENTER[1] - half*SIGMA[1], abs=1e-2)
+    assert np.log(ci['upper']) == pytest.approx(CENTER[1] + half*SIGMA[1], abs=1e-2)
+
+def test_confidence_region():
+    surface, axes, points, ll = make_surface()
+    region, ll_region = surface.confidence_region(level=0.95)
+    threshold = np.nanmax(ll) - scipy.stats.chi2.ppf(0.95, 2)/2
+    with np.errstate(invalid='ignore'):
+        inside = ll >= threshold
+    np.testing.assert_allclose(region, points[inside][:,[0, 2]])
+    np.testing.assert_allclose(ll_region, ll[inside])
+
+def test_interpolate():
+    surface = make_surface()[0]
+    # linear in (pneu, log(scale)) between the grid points
+    xx = np.array([[0.305, 410.], [2.0, 400.]])
+    out = surface.interpolate(xx)
+    expected = -0.5*(((xx[0,0] - CENTER[0])/SIGMA[0])**2 + ((np.log(xx[0,1]) - CENTER[1])/SIGMA[1])**2) - 100.
+    assert out[0] == pytest.approx(expected, abs=0.05)
+    assert np.isnan(out[1])
+    # the points are not modified
+    assert xx[0,1] == 410.
+
+def test_save_load_surface(tmp_path):
+    surface, axes, points, ll = make_surface()
+    npyfile = str(tmp_path/'gridsearch.npy')
+    np.save(npyfile, np.column_stack((points, ll)))
+    jsonfile = LLSurface.surface_path(npyfile)
+    LLSurface.save_surface(jsonfile, npyfile, 'neugamma', PDFVARS, axes, [False, False, True], info={'sfs': 'MIS.sfs'})
+    loaded = LLSurface.load_surface(jsonfile)
+    assert loaded.pdfname == 'neugamma' and loaded.info == {'sfs': 'MIS.sfs'}
+    assert loaded.freevars == ['pneu', 'scale']
+    np.testing.assert_allclose(loaded.mle()[0], surface.mle()[0])
+    assert loaded.mle()[1] == surface.mle()[1]
+    assert loaded.confidence_interval('scale') == surface.confidence_interval('scale')
+
+class RecordingGrid:
+    """
+    Grid of LL values recording the number of values read.
+    """
+    def __init__(self, ll):
+        self.ll, self.read = ll, 0
+    def __getitem__(self, index):
+        values = self.ll[index]
+        self.read += np.size(values)
+        return values
+
+@pytest.mark.parametrize('method', ['linear', 'nearest', 'slinear', 'cubic'])
+def test_interpolate_matches_full_grid(method):
+    # splines need a grid without nan
+    surface, axes, points, ll = make_surface(nan_rows=50 if method in ('linear', 'nearest') else 0)
+    # grid points, between grid points, the last grid value and outside the grid
+    xx = np.array([[0.3, axes[2][40]], [0.305, 410.], [0.312, 395.], [1.0, 4000.], [0.2, 5000.]])
+    grid = [axes[0], np.log(axes[2])]
+    full = scipy.interpolate.RegularGridInterpolator(grid, ll.reshape(101, 81), method=method, bounds_error=False)
+    expected = full(np.column_stack((xx[:,0], np.log(xx[:,1]))))
+    np.testing.assert_allclose(surface.interpolate(xx, method), expected, rtol=1e-12, equal_nan=True)
+    # a box of grid points around the points away from the nan rows
+    surface.ll = RecordingGrid(surface.ll)
+    np.testing.assert_allclose(surface.interpolate(xx[:3], method), expected[:3], rtol=1e-12)
+    if method in surface.local_methods:
+        assert surface.ll.read == 3*3
+    else:
+        assert surface.ll.read == ll.size
+    surface.ll.read = 0
+    assert np.all(np.isnan(surface.interpolate(xx[4:], method)))
+    assert surface.ll.read == (0 if method in surface.local_methods else ll.size)
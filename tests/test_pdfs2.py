@@ -0,0 +1,64 @@
+"""
+Tests of the PDFs in varDFE.DFE.PDFs2
+"""
+
+import numpy as np
+import pytest
+
+from varDFE.DFE import PDFs2
+
+# [m, sigma, Ne, Ne_dadi]
+LOURENCO_PARAMS = [
+    [2.0, 0.05, 1000, 5000],
+    [1.0, 0.1, 5000, 5000],
+    [5.0, 0.3, 200, 2000],
+    [0.5, 0.02, 10000, 5000],
+    [3.5, 1.0, 50, 1000],
+]
+
+# negative and positive gammas, and gamma = 0 (s = 0)
+GAMMAS = np.concatenate([-np.logspace(-5, 4, 37), [0.0], np.logspace(-5, 2, 29)])
+
+@pytest.mark.parametrize('params', LOURENCO_PARAMS)
+def test_lourenco_eq_pdf_matches_lourenco_eq(params):
+    expected = np.array([PDFs2.lourenco_eq(xx, params) for xx in GAMMAS])
+    np.testing.assert_allclose(PDFs2.lourenco_eq_pdf(GAMMAS, params), expected, rtol=1e-10, atol=0, equal_nan=True)
+
+@pytest.mark.parametrize('params', LOURENCO_PARAMS)
+def test_lourenco_eq_pdf_scalar(params):
+    for xx in [-50.0, 0.5]:
+        out = PDFs2.lourenco_eq_pdf(xx, params)
+        assert isinstance(out, float)
+        assert out == pytest.approx(PDFs2.lourenco_eq(xx, params), rel=1e-10)
+
+def test_lourenco_eq_pdf_mpmath_fallback(monkeypatch):
+    # s = 0 is not finite in double precision and falls back to lourenco_eq
+    calls = []
+    lourenco_eq = PDFs2.lourenco_eq
+    def spy(xx, params):
+        calls.append(xx)
+        return lourenco_eq(xx, params)
+    monkeypatch.setattr(PDFs2, 'lourenco_eq', spy)
+
+    params = [1.0, 0.1, 5000, 5000]
+    xx = np.array([-10.0, 0.0, 10.0])
+    out = PDFs2.lourenco_eq_pdf(xx, params)
+    assert calls == [0.0]
+    assert out[1] == lourenco_eq(0.0, params)
+    np.testing.assert_allclose(out[[0, 2]], [lourenco_eq(-10.0, params), lourenco_eq(10.0, params)], rtol=1e-10)
+
+# [pdf, params of two DFEs]
+BROADCAST_PDFS = [
+    (PDFs2.neugamma, [[0.1, 0.2, 400.0], [0.3, 0.5, 1000.0]]),
+    (PDFs2.gammalet, [[0.1, 0.2, 400.0], [0.3, 0.5, 1000.0]]),
+    (PDFs2.neugammalet, [[0.1, 0.1, 0.2, 400.0], [0.05, 0.3, 0.5, 1000.0]]),
+    (PDFs2.shifted_gamma, [[0.5, 0.2, 400.0], [1.0, 0.3, 100.0]]),
+    (PDFs2.lourenco_eq_pdf, [[2.0, 0.05, 1000, 5000], [1.0, 0.1, 5000, 5000]]),
+]
+
+@pytest.mark.parametrize('pdf, params_matrix', BROADCAST_PDFS)
+def test_pdfs_broadcast_params(pdf, params_matrix):
+    # params as arrays of shape (N, 1) give one row of the PDF per parameter set
+    columns = np.array(params_matrix).T[:,:,np.newaxis]
+    expected = np.array([pdf(GAMMAS, params) for params in params_matrix])
+    np.testing.assert_allclose(pdf(GAMMAS, columns), expected, rtol=1e-12, atol=0)
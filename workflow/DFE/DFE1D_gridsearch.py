@@ -8,26 +8,30 @@ Date: 2023-05-10 15:23:07
 Example usage:
 python3 DFE1D_gridsearch.py [-h] --max_bound '0.5,2000' --min_bound '1e-5,1e-2'
     [--dfe_scaling] [--Npts 20] [--Nanc 3000] [--mask_singleton]
+    [--log_params scale] [--fixed_params Ne_dadi=5000] [--chunk_size 1000]
+    [--adaptive] [--adaptive_levels 3] [--adaptive_lldrop 10] [--adaptive_fine 5]
     ref_spectra pdfname theta_nonsyn outprefix
+The uniform grid is also saved as a likelihood surface (*_surface.json) for DFE1D_surface.py.
 '''
 
 ################################################################################
 ## import packages
 import sys
 import dadi
-import pickle
 import multiprocessing
 import pandas as pd
 import numpy as np
 
 from varDFE.DFE.PDFValidation import PDFValidation
 from varDFE.Misc import LoggerDFE, Plotting, Util
-from varDFE.DFE import InputDFE, OutputDFE
-from varDFE.DFE.DFEGridsearchWorker import DFEGridsearchWorker
+from varDFE.DFE import InputDFE, OutputDFE, Cache1D_io, LLSurface
+from varDFE.DFE.DFEGridsearchWorker import init_worker, adaptive_gridsearch, grid_axes, stream_gridsearch
 
 ################################################################################
 ## def variables
 cputouse = min(multiprocessing.cpu_count()-1, 20)
+# largest grid drawn in the surface plot
+max_plot_pts = 250**2
 
 ################################################################################
 ## main
@@ -41,66 +45,82 @@ def main():
 
     ##### Input data
     fs=Util.LoadFoldSFS(sfs=args['sfs'],mask1=args['mask_singleton'])
-    ref_spectra=pickle.load(open(args['ref_spectra'],'rb'))
+    # spectra cached at a larger sample size are projected down to the data
+    ref_spectra=Cache1D_io.load_spectra_for(args['ref_spectra'], fs)
 
     ##### Set up Specific Model and Parameter grids
     pdf, optimizer, integrate_methods = PDFValidation().get_DFE_pdf(pdfname=pdfname)
     pdfvars=PDFValidation().existing_pdfs[pdfname]
+    # names of the parameters searched, the others are fixed
+    freevars=[name for name, npts in zip(pdfvars, args['Npts']) if npts > 1]
+    columns=pdfvars+['ll_model']+(['level'] if args['adaptive'] else [])
 
-
+    # values of each parameter, linear or log-spaced
+    axes=grid_axes(args['min_bound'], args['max_bound'], args['Npts'], args['log_axes'])
     # If needs to scale up to population level (reverse to dfe_unscaling)
     if args['dfe_scaling'] is True:
-        # Use linear grid space
-        var0_us = np.linspace(args['min_bound'][0],args['max_bound'][0],args['Npts'])
-        var1_us = np.linspace(args['min_bound'][1],args['max_bound'][1],args['Npts'])
         # Currently only supports gamma
         if pdfname == 'gamma':
-            var0 = var0_us.copy()
-            var1 = var1_us.copy()*(2*args['Nanc'])
-        else:
-            raise IOError('Only gamma distribution DFE scaling suport')
-    else:
-        var0 = np.linspace(args['min_bound'][0],args['max_bound'][0],args['Npts'])
-        var1 = np.linspace(args['min_bound'][1],args['max_bound'][1],args['Npts'])
-        # Do not calculate var0_us and var1_us if testing NeS scenarios
-        if pdfname == 'gamma':
-            pass
-            # var0_us = var0.copy()
-            # var1_us = var1.copy()/(2*args['Nanc'])
+            axes[1] = axes[1]*(2*args['Nanc'])
         else:
             raise IOError('Only gamma distribution DFE scaling suport')
 
     #### Start running the grid search
-    # TIPS: 3**2 is 3^2. Using all scaled values (var0, var1) as inputs.
-    # setup worker input list
-    listofinputs=[]
-    for var0ii in var0:
-        for var0jj in var1:
-            popt = np.array([var0ii,var0jj])
-            Gridsearchinputs = [ref_spectra, popt, pdf, args['theta_nonsyn'], fs]
-            listofinputs.append(Gridsearchinputs)
-    with multiprocessing.Pool(processes=cputouse) as pool:
-        ll_grid0 = pool.map(DFEGridsearchWorker, listofinputs)
-    ll_grid = np.array(ll_grid0)
+    # TIPS: 3**2 is 3^2. Using all scaled values as inputs.
+    # ref_spectra is handed to each worker once through the pool initializer
+    with multiprocessing.Pool(processes=cputouse, initializer=init_worker,
+                              initargs=(ref_spectra, pdf, args['theta_nonsyn'], fs, integrate_methods, axes)) as pool:
+        if args['adaptive']:
+            # same coarse grid, then zoom into the cells near the maximum LL
+            # the level each grid point was evaluated at is the last column
+            ll_grid = adaptive_gridsearch(
+                pool.map, lower=[axis[0] for axis in axes], upper=[axis[-1] for axis in axes],
+                Npts=args['Npts'], levels=args['adaptive_levels'],
+                lldrop=args['adaptive_lldrop'], fine=args['adaptive_fine'],
+                nchunks=4*cputouse, log_axes=args['log_axes'])
+            LoggerDFE.logINFO('Adaptive grid search evaluated {0} grid points, {1} in the coarse grid'.format(
+                len(ll_grid), int(np.sum(ll_grid[:,-1] == 0))))
+            np.save(file = outnpy, arr = ll_grid)
+            # get the mle
+            ll_max=ll_grid[np.nanargmax(ll_grid[:,len(pdfvars)])][:len(pdfvars)+1]
+        else:
+            # stream chunks of grid points into the memory-mapped numpy array,
+            # which keeps the rows evaluated so far if the search is interrupted
+            LoggerDFE.logINFO('Grid search of {0} grid points over {1}'.format(
+                int(np.prod([len(axis) for axis in axes])), ','.join(freevars)))
+            ll_grid, ll_max = stream_gridsearch(pool, axes, outnpy, chunk_size=args['chunk_size'],
+                                                log_func=LoggerDFE.logINFO)
 
     # also get the LL of the data to itself (best possible ll)
     ll_data=dadi.Inference.ll(fs, fs)
 
-    # get the mle
-    ll_max=ll_grid[np.argmax(ll_grid, axis=0)[2]]
     LoggerDFE.logINFO('Maximum LL in grid search ([parameters, ll_model]) = {0}'.format(ll_max))
 
     ##### Write output file
-    # save the numpy array (didn't save var0_us and var1_us since easily reestimated)
-    np.save(file = outnpy, arr = ll_grid)
+    # the numpy array is saved above (didn't save unscaled values since easily reestimated)
+    # write the text files (headers as annotations), chunk by chunk
+    def ll_griddf_chunks(chunk_size=100000):
+        for start in range(0, len(ll_grid), chunk_size):
+            chunk = np.asarray(ll_grid[start:start+chunk_size])
+            yield pd.DataFrame(data = chunk, columns = columns, index = range(start, start+len(chunk)))
 
-    # write the text files (headers as annotations)
-    ll_griddf = pd.DataFrame(data = ll_grid, columns = pdfvars+['ll_model'])
+    OutputDFE.write_gridsearch_result(args,pdfvars,ll_data,ll_max,ll_griddf_chunks(), outtxt)
 
-    OutputDFE.write_gridsearch_result(args,pdfvars,ll_data,ll_max,ll_griddf, outtxt)
+    # index the uniform grid by its axes for DFE1D_surface.py queries
+    if not args['adaptive']:
+        info = {key: args[key] for key in ['sfs','ref_spectra','theta_nonsyn','mask_singleton','dfe_scaling','Nanc']}
+        info['ll_data'] = float(ll_data)
+        LLSurface.save_surface(LLSurface.surface_path(outnpy), outnpy, pdfname, pdfvars, axes, args['log_axes'], info)
 
     ##### Output plot
-    pp = Plotting.ggplot_gridsearch(args['outprefix'], ll_griddf, ll_max)
+    # only surfaces of two parameters, small enough to draw
+    if len(freevars) == 2 and len(ll_grid) <= max_plot_pts:
+        ll_griddf = pd.DataFrame(data = np.asarray(ll_grid), columns = columns)
+        plotcols = freevars+['ll_model']+(['level'] if args['adaptive'] else [])
+        pp = Plotting.ggplot_gridsearch(args['outprefix'], ll_griddf[plotcols],
+                                        ll_max[[pdfvars.index(name) for name in freevars]+[len(pdfvars)]])
+    else:
+        LoggerDFE.logINFO('Surface plot skipped, it needs two searched parameters and at most {0} grid points'.format(max_plot_pts))
 
     LoggerDFE.logEND('DFE grid search')
 
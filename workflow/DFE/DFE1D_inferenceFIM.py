@@ -5,7 +5,7 @@ Author: Meixi Lin
 Date: 2022-04-22 11:26:01
 Example usage:
 python3 DFE1D_inferenceFIM.py [-h] [--Nrun 20] --pop 'HS100' --mu '2.5e-8' --Lcds '19089129'
-    --NS_S_scaling NS_S_SCALING '2.31' [--mask_singleton]
+    --NS_S_scaling NS_S_SCALING '2.31' [--mask_singleton] [--lbfgsb]
     sfs ref_spectra pdfname theta_syn outdir
 Before commit id: fe712c33dc57c9d3f0be82ff32df8680ff2bc256. The DFE1D_inferenceFIM was single threaded. Now this workflow is multiprocess by default.
 '''
@@ -15,15 +15,14 @@ Before commit id: fe712c33dc57c9d3f0be82ff32df8680ff2bc256. The DFE1D_inferenceF
 import sys
 import os
 import dadi
-import pickle
 import multiprocessing
 import pandas as pd
 import numpy as np
 
 from varDFE.DFE.PDFValidation import PDFValidation
 from varDFE.Misc import LoggerDFE, Plotting, Util
-from varDFE.DFE import InputDFE, OutputDFE
-from varDFE.DFE.DFEInferenceWorker import DFEInferenceWorker
+from varDFE.DFE import InputDFE, OutputDFE, Cache1D_io, Inference2
+from varDFE.DFE.DFEInferenceWorker import DFEInferenceWorker, init_worker
 
 ################################################################################
 ## def variables
@@ -40,10 +39,14 @@ def main():
     ##### Input data
     fs=Util.LoadFoldSFS(sfs=args['sfs'],mask1=args['mask_singleton'])
     ns=fs.sample_sizes
-    ref_spectra=pickle.load(open(args['ref_spectra'],'rb'))
+    # spectra cached at a larger sample size are projected down to the data
+    ref_spectra=Cache1D_io.load_spectra_for(args['ref_spectra'], fs)
 
     ##### Set up Specific Model
     pdf, optimizer, integrate_methods =PDFValidation().get_DFE_pdf(pdfname=pdfname)
+    if args['lbfgsb']:
+        # gradient-based optimizer, in log(params) if the default optimizer is
+        optimizer = Inference2.optimize_log_lbfgsb_jac if optimizer is Inference2.optimize_log else Inference2.optimize_lbfgsb_jac
     optimizer_name = Util.GetFuncName(optimizer)
     pdfvars=PDFValidation().existing_pdfs[pdfname]
     upperbound, lowerbound, initval = PDFValidation().query_params(pdfname=pdfname)
@@ -52,12 +55,14 @@ def main():
 
     ##### Carry out optimization
     # setup worker input list
+    # ref_spectra is handed to each worker once through the pool initializer
     listofinputs=[]
     for runNum in range(args['Nrun']):
-        DFEinputs = [runNum, initval, lowerbound, upperbound, pdfname, optimizer, fs, ref_spectra, pdf, args, maxiter, ns, pdfvars, integrate_methods, optimizer_name]
+        DFEinputs = [runNum, initval, lowerbound, upperbound, pdfname, optimizer, fs, pdf, args, maxiter, ns, pdfvars, integrate_methods, optimizer_name]
         listofinputs.append(DFEinputs)
     # run optimization in cputosue processes
-    with multiprocessing.Pool(processes=cputouse) as pool:
+    with multiprocessing.Pool(processes=cputouse, initializer=init_worker,
+                              initargs=(ref_spectra,)) as pool:
         listofresults0 = pool.map(DFEInferenceWorker, listofinputs)
     # obtain the output_data and output_names
     listofresults = [result[0] for result in listofresults0]
@@ -97,13 +102,14 @@ def main():
     Plotting.ggplot_dfe_pdf(outprefix=sumprefix+'PDF',pdf=pdf,params=np.array(best_params))
 
     #### Fisher's Information Matrix (func_ex in demography).
-    # Some input for lambda was not accessed (i.e. ns, grid_pts)`params, ns, grid_pts` because you need these for Godambe.py to get correct number of inputs.
-    integrate_func = lambda params, ns, grid_pts: ref_spectra.integrate(params=params, ns=None, sel_dist=pdf, theta=args['theta_nonsyn'])
+    # Some input for lambda was not accessed (i.e. grid_pts)`params, ns, grid_pts` because you need these for Godambe.py to get correct number of inputs.
+    # ns and fs are checked against folded reference spectra.
+    integrate_func = lambda params, ns, grid_pts: ref_spectra.integrate_array(params=params, ns=ns, sel_dist=pdf, theta=args['theta_nonsyn'], data=fs)
 
     # get standard deviation of the best parameter values
     # sometimes you get nan --> model not optimized
     # https://groups.google.com/g/dadi-user/c/IvSRXjmAcwc/m/WOy6tTDlBgAJ
-    fim_sd = dadi.Godambe.FIM_uncert(
+    fim_sd = Inference2.FIM_uncert(
         func_ex=integrate_func,
         grid_pts=[],
         p0=np.array(best_params),
@@ -5,7 +5,11 @@ Generate a demographics informed precomputed spectra for each species/population
 Author: Meixi Lin
 Date: 2022-04-10 11:19:27
 Example usage:
-python3 DFE1D_refspectra.py [-h] demog_model demog_params ns outprefix
+python3 DFE1D_refspectra.py [-h] [--keep_checkpoint] [--store STORE] [--store_max_gb 50]
+    [--gamma_bounds '1e-5,10000'] [--gamma_pts 901] [--pos_gamma_bounds '1e-5,100'] [--pos_gamma_pts 701]
+    [--quadrature trapz] [--gauss_order 5] [--refine_tol 0.001] [--refine_max_pts 400] [--refine_max_step 0.1]
+    [--lowrank_tol 1e-6] [--fold_spectra] [--spectra_dtype {float64,float32}]
+    [--batch_gammas] [--extend EXISTING_DFESpectrum.json] demog_model demog_params ns outprefix
 '''
 
 ################################################################################
@@ -13,12 +17,11 @@ python3 DFE1D_refspectra.py [-h] demog_model demog_params ns outprefix
 import sys
 import os
 import dadi
-import pickle
 
-from varDFE.DFE import Cache1D_mod2, InputDFE
-from varDFE.DFE.Cache1D_util import positive_gammas, dict_spectra
+from varDFE.DFE import Cache1D_mod2, Cache1D_io, InputDFE
+from varDFE.DFE.Cache1D_util import positive_gammas, dict_spectra, remove_checkpoint
 from varDFE.Demography.DemogValidation import DemogValidation
-from varDFE.Misc import LoggerDFE, Plotting
+from varDFE.Misc import LoggerDFE, Plotting, Util
 
 ################################################################################
 ## main
@@ -26,33 +29,90 @@ def main():
     # parse arguments
     args = InputDFE.parse_SpectraArgs()
 
+    # read the spectra to extend before the output file could be removed
+    if args['extend'] is not None:
+        ref_spectra = Cache1D_io.load_spectra(args['extend'], mmap_mode=None)
+
     # prepare for output file
-    outfile = '{0}_DFESpectrum.bpkl'.format(args['outprefix'])
-    if os.path.isfile(outfile):
-        LoggerDFE.logWARN("Removing {0}".format(outfile))
-        os.remove(outfile)
+    outfile = '{0}_DFESpectrum.json'.format(args['outprefix'])
+    for ii in [outfile, Cache1D_io.spectra_path(outfile), Cache1D_io.factor_path(outfile)]:
+        if os.path.isfile(ii):
+            LoggerDFE.logWARN("Removing {0}".format(ii))
+            os.remove(ii)
+    # finished spectra are saved here as they are computed, rerun to resume
+    checkpoint = '{0}_DFESpectrum_checkpoint'.format(args['outprefix'])
     # find the demographic model with selection
     # note that in Cache1D it creates a extrap function
     func = DemogValidation().get_DFE_func_ex(demog_model = args['demog_model'])
+    # same model for a block of gammas at once, same spectra, only faster for weakly selected gammas
+    batch_func = None
+    if args['batch_gammas']:
+        batch_func = DemogValidation().get_DFE_batch_func_ex(demog_model = args['demog_model'])
     LoggerDFE.logINFO('Beginning reference spectra using DFE_demog_function {0}.'.format(func))
     # generate spectra (negative spectra + neutral + positive)
-    # numbers here is to make sure the step size is 0.01 in both positive and negative spectras
-    pos_gammas = positive_gammas(pos_gamma_bounds=(1e-5,100),pos_gamma_pts=701)
-    ref_spectra = Cache1D_mod2.Cache1D(
+    # default numbers here is to make sure the step size is 0.01 in both positive and negative spectras
+    # simpson or gauss quadrature reach the same accuracy with several times fewer gammas
+    pos_gammas = positive_gammas(pos_gamma_bounds=args['pos_gamma_bounds'],pos_gamma_pts=args['pos_gamma_pts'],
+        quadrature=args['quadrature'], gauss_order=args['gauss_order'])
+    cache_settings = dict(
         params = args['demog_params'],
         ns = [args['ns']],
         demo_sel_func = func,
         pts_l= [1000,1200,1400],
-        gamma_bounds=(1e-5, 10000),
+        gamma_bounds=args['gamma_bounds'],
         additional_gammas=pos_gammas,
-        gamma_pts=901,
-        verbose=True, mp=True)
+        gamma_pts=args['gamma_pts'],
+        quadrature=args['quadrature'],
+        gauss_order=args['gauss_order'],
+        refine_tol=args['refine_tol'],
+        refine_max_pts=args['refine_max_pts'],
+        refine_max_step=args['refine_max_step'],
+        lowrank_tol=args['lowrank_tol'],
+        fold_spectra=args['fold_spectra'],
+        spectra_dtype=args['spectra_dtype'] or 'float64',
+        verbose=True, mp=True, checkpoint=checkpoint, batch_func=batch_func)
+    if args['extend'] is not None:
+        # only compute the gammas missing from the existing spectra
+        if list(ref_spectra.params) != list(args['demog_params']) or list(ref_spectra.ns) != [args['ns']] or \
+            ref_spectra.demo_sel_func is None or Util.GetFuncName(ref_spectra.demo_sel_func) != Util.GetFuncName(func):
+            raise IOError('{0} was not generated with the same demog_model, demog_params and ns'.format(args['extend']))
+        if ref_spectra.quadrature != args['quadrature'] or args['quadrature'] == 'gauss':
+            raise IOError('{0} can only be extended with the same --quadrature, trapz or simpson'.format(args['extend']))
+        LoggerDFE.logINFO('Extending reference spectra {0}'.format(args['extend']))
+        # the new spectra are stored in full, compress them again like the existing ones
+        lowrank_tol = args['lowrank_tol']
+        if lowrank_tol is None and ref_spectra.lowrank is not None:
+            lowrank_tol = ref_spectra.lowrank['tol']
+        ref_spectra.extend(gamma_bounds=args['gamma_bounds'], gamma_pts=args['gamma_pts'],
+            additional_gammas=pos_gammas, verbose=True, mp=True, checkpoint=checkpoint, batch_func=batch_func)
+        if args['refine_tol'] is not None:
+            ref_spectra.refine(tol=args['refine_tol'], max_pts=args['refine_max_pts'], max_step=args['refine_max_step'],
+                verbose=True, mp=True, checkpoint=checkpoint, batch_func=batch_func)
+        # keep the storage of the existing spectra unless the flags change it
+        ref_spectra.compact(fold=args['fold_spectra'] or ref_spectra.folded,
+            dtype=args['spectra_dtype'] or ref_spectra.spectra_dtype)
+        if lowrank_tol is not None:
+            ref_spectra.compress(tol=lowrank_tol, verbose=True)
+    elif args['store'] is None:
+        ref_spectra = Cache1D_mod2.Cache1D(**cache_settings)
+    else:
+        # reuse the spectra if the same settings were built before
+        ref_spectra = Cache1D_io.cached_Cache1D(
+            store=args['store'], max_size=args['store_max_gb']*1e9, **cache_settings)
 
     # summary info
     LoggerDFE.logINFO('Number of negative gammas: {0}. Number of all gammas: {1}'.format(ref_spectra.neg_gammas.shape,ref_spectra.gammas.shape))
+    LoggerDFE.logINFO('Stored spectra: folded={0}, dtype={1}'.format(ref_spectra.folded, ref_spectra.spectra_dtype))
+    if ref_spectra.refinement is not None:
+        LoggerDFE.logINFO('Adaptive gamma grid refinement: {0}'.format(ref_spectra.refinement))
+    if ref_spectra.lowrank is not None:
+        # accuracy lost by the low-rank spectra
+        LoggerDFE.logINFO('Low-rank spectra: {0}'.format(ref_spectra.lowrank))
 
     # save spectra first
-    pickle.dump(ref_spectra, open(outfile,'wb'))
+    Cache1D_io.save_spectra(ref_spectra, outfile)
+    if not args['keep_checkpoint'] and remove_checkpoint(checkpoint):
+        LoggerDFE.logINFO('Removed checkpoint {0}'.format(checkpoint))
 
     # plot the most beneficial, neutral and deleterious variations
     pp = Plotting.ggplot_ref_spectra_1d(outprefix=args['outprefix']+'_DFESpectrum_QC',
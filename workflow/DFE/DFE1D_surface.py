@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Title: Query the likelihood surface of a DFE grid search
+Profile likelihoods, likelihood-ratio confidence intervals and regions, and the
+interpolated LL are computed from the surface saved by DFE1D_gridsearch.py.
+No spectra are evaluated, so surfaces of many populations can be queried and
+compared without rerunning the grid search.
+Example usage:
+python3 DFE1D_surface.py [-h] [--params shape] [--level 0.95]
+    [--points '0.2,400;0.3,500'] [--method linear] [--other B_surface.json]
+    surface {profile,ci,region,interpolate,compare} outprefix
+'''
+
+################################################################################
+## import packages
+import sys
+import pandas as pd
+import numpy as np
+import scipy.stats
+
+from varDFE.Misc import LoggerDFE
+from varDFE.DFE import InputDFE, OutputDFE, LLSurface
+
+################################################################################
+## main
+def main():
+    # parse arguments
+    args = InputDFE.parse_SurfaceArgs()
+    outtxt = args['outprefix'] + '.txt'
+
+    ##### Input surface
+    surface = LLSurface.load_surface(args['surface'])
+    params = surface.freevars if args['params'] is None else args['params']
+    if not set(params) <= set(surface.freevars):
+        raise IOError('--params needs searched parameters of the surface ({0})'.format(','.join(surface.freevars)))
+    LoggerDFE.logINFO('Likelihood surface of {0} over {1}, {2} grid points'.format(
+        surface.pdfname, LoggerDFE.join_zip(zip(surface.pdfvars, surface.shape), sep = ','), int(np.prod(surface.shape))))
+
+    ##### Run the query
+    if args['query'] == 'profile':
+        resultdf = pd.concat([pd.DataFrame({'param': param, 'value': values, 'll_profile': profile})
+                              for param, (values, profile) in zip(params, map(surface.profile, params))])
+    elif args['query'] == 'ci':
+        resultdf = pd.DataFrame([surface.confidence_interval(param, args['level']) for param in params])
+        for row in resultdf.itertuples():
+            if row.lower_at_edge or row.upper_at_edge:
+                LoggerDFE.logWARN('Confidence interval of {0} reaches the edge of the grid, widen the grid search bounds'.format(row.param))
+    elif args['query'] == 'region':
+        points, profile = surface.confidence_region(params, args['level'])
+        resultdf = pd.DataFrame(points, columns = [param for param in surface.freevars if param in params])
+        resultdf['ll_profile'] = profile
+        LoggerDFE.logINFO('{0} grid points in the {1} confidence region'.format(len(resultdf), args['level']))
+    elif args['query'] == 'interpolate':
+        resultdf = pd.DataFrame(args['points'], columns = surface.freevars)
+        resultdf['ll_model'] = surface.interpolate(args['points'], args['method'])
+    else:
+        # the MLE of each surface, and the LL drop at the MLE of the other surface
+        other = LLSurface.load_surface(args['other'])
+        if other.pdfname != surface.pdfname or other.freevars != surface.freevars:
+            raise IOError('compare needs surfaces of the same pdfname and searched parameters')
+        free = [surface.pdfvars.index(param) for param in surface.freevars]
+        rows = []
+        for name, this, that in [(args['surface'], surface, other), (args['other'], other, surface)]:
+            mle, ll_max = this.mle()
+            _, that_ll_max = that.mle()
+            ll_at = float(that.interpolate([mle[free]], args['method'])[0])
+            lrt = 2*(that_ll_max - ll_at)
+            rows.append([name] + mle[free].tolist() + [ll_max, ll_at, that_ll_max, lrt,
+                         scipy.stats.chi2.sf(lrt, len(free))])
+        resultdf = pd.DataFrame(rows, columns = ['surface'] + surface.freevars +
+                                ['ll_max', 'll_other_at_mle', 'll_max_other', 'lrt_other', 'p_other'])
+
+    ##### Write output file
+    OutputDFE.write_surface_query(args, resultdf, outtxt)
+
+    LoggerDFE.logEND('DFE likelihood surface query')
+
+
+if __name__ == "__main__":
+    sys.exit(main())